@@ -36,16 +36,31 @@ def runCommand(taskname, *args, **kwargs):
         for db in settings.DATABASES:
             settings.DATABASES[db]["NAME"] = settings.DATABASES[db]["TEST"]["NAME"]
 
+    # Allow the task to be canceled cooperatively
+    from .execute.models import Task, TaskCanceled
+
+    taskid = kwargs.get("task", None)
+    Task.installCancelHandler(taskid, database)
+
     # Run the command
     try:
         from django.core import management
 
         management.call_command(taskname, *args, **kwargs)
+    except TaskCanceled:
+        if taskid:
+            from datetime import datetime
+
+            now = datetime.now()
+            Task.objects.all().using(database).filter(pk=taskid).update(
+                status="Canceled",
+                message="Canceled process",
+                finished=now,
+                processid=None,
+            )
     except Exception as e:
-        taskid = kwargs.get("task", None)
         if taskid:
             from datetime import datetime
-            from .execute.models import Task
 
             task = Task.objects.all().using(database).get(pk=taskid)
             task.status = "Failed"
@@ -95,6 +110,33 @@ def runFunction(func, *args, **kwargs):
     getattr(mod, func_name).start(*args, **kwargs)
 
 
+def initWorker(database):
+    """
+    Auxilary method to initialize a process of a pool of workers of the
+    multiprocessing module.
+
+    The code is put here, such that a child process loads only
+    a minimum of other python modules.
+    """
+    # Initialize django
+    import os
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "data_admin.settings")
+    import django
+
+    django.setup()
+
+    # Be sure to use the correct database
+    from django.conf import settings
+    from .common.middleware import _thread_locals
+
+    setattr(_thread_locals, "database", database)
+    if "FREPPLE_TEST" in os.environ:
+        settings.EMAIL_BACKEND = "django.core.mail.backends.dummy.EmailBackend"
+        for db in settings.DATABASES:
+            settings.DATABASES[db]["NAME"] = settings.DATABASES[db]["TEST"]["NAME"]
+
+
 def execute_from_command_line(argv=None):
     import os
     import sys
@@ -46,16 +46,16 @@ class frepplePermissionClass(permissions.DjangoModelPermissions):
             return False
         request.user._state.db = request.database
 
-        # Django is not checking if user is active or superuser on the scenario
-        try:
-            thisuser = (
-                User.objects.all().using(request.database).get(username=request.user)
-            )
-            request.user.is_active = thisuser.is_active
-            request.user.is_superuser = thisuser.is_superuser
-        except Exception:
-            request.user.is_active = False
-            request.user.is_superuser = False
+        # Django is not checking if user is active or superuser on the scenario.
+        # These flags are always read from the database: the cached list of
+        # scenarios can be outdated in other web server processes.
+        flags = (
+            User.objects.using(request.database)
+            .filter(username=request.user.username)
+            .values_list("is_active", "is_superuser")
+            .first()
+        )
+        request.user.is_active, request.user.is_superuser = flags or (False, False)
 
         return super().has_permission(request, view)
 
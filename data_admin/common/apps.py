@@ -77,3 +77,8 @@ class CommonConfig(AppConfig):
             raise ImproperlyConfigured(
                 "Missing required apps in INSTALLED_APPS: %s" % ", ".join(missing)
             )
+
+        # Build the dependency graph between the models once
+        from .report import GridReport
+
+        GridReport.getModelGraph()
@@ -1,11 +1,13 @@
 import base64
 import jwt
 import time
+from uuid import uuid4
 
 from django.conf import settings
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import Permission
+from django.core.cache import cache
 from django.core.validators import validate_email
 from django.core.exceptions import ValidationError
 from django.db import DEFAULT_DB_ALIAS
@@ -32,9 +34,70 @@ class MultiDBBackend(ModelBackend):
     """
 
     @staticmethod
-    def getScenarios(user):
+    def _scenarioCacheKey(user_id):
+        # The version is changed to invalidate the cached lists of all users
+        return "scenarios_%s_%s" % (
+            cache.get_or_set("scenarios_version", lambda: uuid4().hex, None),
+            user_id,
+        )
+
+    @staticmethod
+    def clearScenarioCache(user=None):
+        """
+        Invalidates the cached scenario list of a user, or of all users.
+        """
+        if user:
+            cache.delete(MultiDBBackend._scenarioCacheKey(user.pk))
+        else:
+            cache.set("scenarios_version", uuid4().hex, None)
+
+    # Minimum number of seconds between two refreshes of the scenario list of a
+    # user, triggered by a request for a scenario missing in the list
+    scenarioRefreshInterval = 30
+
+    @staticmethod
+    def refreshScenarios(user):
+        """
+        Refreshes the cached scenario list of a user, unless it was already
+        refreshed in the last scenarioRefreshInterval seconds. A change of the
+        scenarios version allows an immediate refresh.
+        """
+        if cache.add(
+            "%s_refresh" % MultiDBBackend._scenarioCacheKey(user.pk),
+            True,
+            MultiDBBackend.scenarioRefreshInterval,
+        ):
+            MultiDBBackend.getScenarios(user, refresh=True)
+
+    @staticmethod
+    def getScenarioStatus():
+        """
+        Returns a dictionary with the status of all scenarios.
+        """
+        key = MultiDBBackend._scenarioCacheKey("status")
+        status = cache.get(key)
+        if status is None:
+            status = {
+                name: st
+                for name, st in Scenario.objects.using(DEFAULT_DB_ALIAS).values_list(
+                    "name", "status"
+                )
+            }
+            cache.set(key, status, getattr(settings, "SCENARIO_CACHE_TIMEOUT", 60))
+        return status
+
+    @staticmethod
+    def getScenarios(user, refresh=False):
         # Populate a dictionary with scenarios in which the user is active, and
         # whether he's a superuser in them.
+        # The list is cached for SCENARIO_CACHE_TIMEOUT seconds, which avoids
+        # querying all scenario databases on every request.
+        key = MultiDBBackend._scenarioCacheKey(user.pk)
+        if not refresh:
+            scenarios = cache.get(key)
+            if scenarios is not None:
+                user.scenarios = scenarios
+                return
         user.scenarios = []
         for db in Scenario.objects.using(DEFAULT_DB_ALIAS).filter(
             Q(status="In use") | Q(name=DEFAULT_DB_ALIAS)
@@ -54,6 +117,7 @@ class MultiDBBackend(ModelBackend):
                 except Exception:
                     # Silently ignore errors. Eg user doesn't exist in scenario
                     pass
+        cache.set(key, user.scenarios, getattr(settings, "SCENARIO_CACHE_TIMEOUT", 60))
 
     def authenticate(self, request, username=None, password=None):
         try:
@@ -107,24 +171,57 @@ class MultiDBBackend(ModelBackend):
 
         perm_cache_name = "_%s_perm_cache_%s" % (from_name, user_obj._state.db)
         if not hasattr(user_obj, perm_cache_name):
-            if user_obj.is_superuser:
-                perms = Permission.objects.using(user_obj._state.db).all()
-            else:
-                perms = getattr(self, "_get_%s_permissions" % from_name)(user_obj)
-            perms = perms.values_list("content_type__app_label", "codename").order_by()
-            setattr(
-                user_obj,
-                perm_cache_name,
-                set("%s.%s" % (ct, name) for ct, name in perms),
+            # The permissions are also cached across requests
+            key = "perms_%s_%s_%s_%s_%s" % (
+                user_obj._state.db,
+                self.getPermissionVersion(user_obj._state.db),
+                user_obj.pk,
+                from_name,
+                user_obj.is_superuser,
             )
+            perms = cache.get(key)
+            if perms is None:
+                if user_obj.is_superuser:
+                    perms = Permission.objects.using(user_obj._state.db).all()
+                else:
+                    perms = getattr(self, "_get_%s_permissions" % from_name)(user_obj)
+                perms = perms.values_list(
+                    "content_type__app_label", "codename"
+                ).order_by()
+                perms = set("%s.%s" % (ct, name) for ct, name in perms)
+                cache.set(
+                    key, perms, getattr(settings, "PERMISSION_CACHE_TIMEOUT", 60)
+                )
+            setattr(user_obj, perm_cache_name, perms)
         return getattr(user_obj, perm_cache_name)
 
+    @staticmethod
+    def getPermissionVersion(database=DEFAULT_DB_ALIAS):
+        """
+        Returns an identifier that changes when permissions change in a scenario.
+        """
+        return cache.get_or_set(
+            "perms_version_%s" % database, lambda: uuid4().hex, None
+        )
+
+    @staticmethod
+    def clearPermissionCache(database=None):
+        """
+        Invalidates the cached permissions of all users in a scenario, or in
+        all scenarios.
+        """
+        for db in [database] if database else settings.DATABASES:
+            cache.set("perms_version_%s" % db, uuid4().hex, None)
+
     def get_all_permissions(self, user_obj, obj=None):
         if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
             return set()
-        if not hasattr(user_obj, "_perm_cache_%s" % user_obj._state.db):
-            user_obj._perm_cache = self.get_user_permissions(user_obj)
-            user_obj._perm_cache.update(self.get_group_permissions(user_obj))
+        perm_cache_name = "_perm_cache_%s" % user_obj._state.db
+        if not hasattr(user_obj, perm_cache_name):
+            perms = set(self.get_user_permissions(user_obj))
+            perms.update(self.get_group_permissions(user_obj))
+            setattr(user_obj, perm_cache_name, perms)
+        user_obj._perm_cache = getattr(user_obj, perm_cache_name)
         return user_obj._perm_cache
 
     def get_user(self, user_id):
@@ -1,11 +1,18 @@
+from concurrent.futures import ProcessPoolExecutor, wait
 from datetime import timedelta, datetime
 from decimal import Decimal
 from logging import INFO, ERROR, WARNING, DEBUG
+import multiprocessing
+from threading import Lock
+
+from openpyxl import load_workbook
 
 from django import forms
+from django.apps import apps
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.core.validators import EMPTY_VALUES
-from django.db import DEFAULT_DB_ALIAS
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
 from django.db.models.fields import (
     IntegerField,
     AutoField,
@@ -27,7 +34,9 @@ from django.utils.translation import gettext_lazy as _
 from django.utils.encoding import force_text
 from django.utils.text import get_text_list
 
-from .models import Comment
+from .. import initWorker
+from .models import Comment, TablePresence, User
+from ..execute.models import Task
 
 
 def parseExcelWorksheet(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False):
@@ -243,6 +252,124 @@ def parseCSVdata(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False):
         return _parseData(model, data, MappedRow, user, database, ping)
 
 
+# Pools of worker processes loading worksheets, reused for all uploads
+_executors = {}
+_executors_lock = Lock()
+
+
+def _getExecutor(database, jobs):
+    """
+    Returns a pool of worker processes for a database. The pool is created on
+    first use and kept for later uploads, since starting a worker is expensive.
+    The setting IMPORT_PYTHON overrides the python interpreter the workers run
+    in, which is needed when the web server embeds python.
+    """
+    with _executors_lock:
+        executor = _executors.get((database, jobs), None)
+        if executor and getattr(executor, "_broken", False):
+            executor.shutdown(wait=False)
+            executor = None
+        if not executor:
+            context = multiprocessing.get_context("spawn")
+            python = getattr(settings, "IMPORT_PYTHON", None)
+            if python:
+                context.set_executable(python)
+            executor = ProcessPoolExecutor(
+                max_workers=jobs,
+                mp_context=context,
+                initializer=initWorker,
+                initargs=(database,),
+            )
+            _executors[(database, jobs)] = executor
+        return executor
+
+
+def loadWorkbook(
+    wb, models, filename=None, user=None, database=DEFAULT_DB_ALIAS, jobs=1, ping=False
+):
+    """
+    Loads the worksheets of a workbook, and generates a tuple (worksheet name,
+    message) for every message of the parser. The first message of every
+    worksheet is None.
+
+    The models are a list of tuples (worksheet name, model, content type id,
+    dependent models), which are loaded in waves of independent models.
+    With more than 1 job and a filename, the worksheets of a wave are loaded in
+    parallel worker processes, each reading only its own worksheet from the file.
+    The messages of such a worksheet are generated when it is complete, and a
+    DEBUG message pings the caller every second meanwhile.
+    Every worksheet is loaded in its own transaction. When the caller stops
+    early, we still wait for the worksheets being loaded by the workers.
+    """
+    from .report import GridReport
+
+    futures = []
+    try:
+        for wave in GridReport.group_models(models):
+            if jobs > 1 and filename and len(wave) > 1:
+                executor = _getExecutor(database, jobs)
+                futures = [
+                    executor.submit(
+                        _loadWorksheet,
+                        filename,
+                        ws_name,
+                        model._meta.label,
+                        user.pk if user else None,
+                        database,
+                        translation.get_language(),
+                    )
+                    for ws_name, model, contenttype_id, dependencies in wave
+                ]
+                for (ws_name, model, contenttype_id, dependencies), f in zip(
+                    wave, futures
+                ):
+                    yield ws_name, None
+                    while not wait([f], timeout=1).done:
+                        if ping:
+                            yield ws_name, (DEBUG, None, None, None, None)
+                    for error in f.result():
+                        yield ws_name, error
+                futures = []
+                # The workers can't refresh the cache of this process
+                TablePresence.invalidate(database)
+            else:
+                for ws_name, model, contenttype_id, dependencies in wave:
+                    yield ws_name, None
+                    with transaction.atomic(using=database):
+                        for error in parseExcelWorksheet(
+                            model, wb[ws_name], user=user, database=database, ping=ping
+                        ):
+                            yield ws_name, error
+    finally:
+        if futures:
+            for f in futures:
+                f.cancel()
+            wait(futures)
+            TablePresence.invalidate(database)
+
+
+def _loadWorksheet(filename, ws_name, model, user, database, language):
+    """
+    Loads a worksheet in a worker process, and returns the list of messages.
+    """
+    wb = load_workbook(filename=filename, read_only=True, data_only=True)
+    try:
+        if user:
+            user = User.objects.using(database).get(pk=user)
+        with translation.override(language), transaction.atomic(using=database):
+            return [
+                error[:4] + (force_text(error[4]),)
+                for error in parseExcelWorksheet(
+                    apps.get_model(model), wb[ws_name], user=user, database=database
+                )
+                if error[0] != DEBUG
+            ]
+    finally:
+        wb.close()
+        # Don't keep a connection open while the worker is idle
+        connections[database].close()
+
+
 def _parseData(model, data, rowmapper, user, database, ping):
 
     selfReferencing = []
@@ -395,6 +522,9 @@ def _parseData(model, data, rowmapper, user, database, ping):
 
         # Case 3: Process a data row
         else:
+            # Stop at a batch boundary when the task is canceled
+            if rownumber % 50 == 0:
+                Task.checkCancel()
             try:
                 # Step 1: Send a ping-alive message to make the upload interruptable
                 if ping:
@@ -498,6 +628,9 @@ def _parseData(model, data, rowmapper, user, database, ping):
                 errors += 1
                 yield (ERROR, None, None, None, "Exception during upload: %s" % e)
 
+    if changed or added:
+        TablePresence.invalidate(database)
+
     yield (
         INFO,
         None,
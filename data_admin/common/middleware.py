@@ -10,7 +10,6 @@ from django.contrib.auth.models import AnonymousUser
 from django.middleware.locale import LocaleMiddleware as DjangoLocaleMiddleware
 from django.utils import translation
 from django.db import DEFAULT_DB_ALIAS
-from django.db.models import Q
 from django.http import HttpResponseNotFound
 from django.http.response import HttpResponseForbidden, HttpResponseRedirect
 
@@ -188,8 +187,10 @@ class MultiDBMiddleware:
             for i in settings.DATABASES:
                 try:
                     if settings.DATABASES[i]["regexp"].match(request.path):
-                        scenario = Scenario.objects.using(DEFAULT_DB_ALIAS).get(name=i)
-                        if scenario.status != "In use":
+                        status = MultiDBBackend.getScenarioStatus()
+                        if i not in status:
+                            continue
+                        if status[i] != "In use":
                             return HttpResponseNotFound("Scenario not in use")
                         request.prefix = "/%s" % i
                         request.path_info = request.path_info[len(request.prefix) :]
@@ -213,6 +214,13 @@ class MultiDBMiddleware:
             # A list of scenarios is already available
             if request.user.is_anonymous:
                 return self.get_response(request)
+            for i in settings.DATABASES:
+                if settings.DATABASES[i]["regexp"].match(request.path):
+                    if i not in [j.name for j in request.user.scenarios]:
+                        # The cached scenario list can be outdated, eg after
+                        # copying a new scenario
+                        MultiDBBackend.refreshScenarios(request.user)
+                    break
             default_scenario = None
             for i in request.user.scenarios:
                 if i.name == DEFAULT_DB_ALIAS:
@@ -269,27 +277,7 @@ class AutoLoginAsAdminUser:
                 user = User.objects.get(username="admin")
                 user.backend = settings.AUTHENTICATION_BACKENDS[0]
                 login(request, user)
-                request.user.scenarios = []
-                for db in Scenario.objects.using(DEFAULT_DB_ALIAS).filter(
-                    Q(status="In use") | Q(name=DEFAULT_DB_ALIAS)
-                ):
-                    if not db.description:
-                        db.description = db.name
-                    if db.name == DEFAULT_DB_ALIAS:
-                        if request.user.is_active:
-                            db.is_superuser = request.user.is_superuser
-                            request.user.scenarios.append(db)
-                    else:
-                        try:
-                            user2 = User.objects.using(db.name).get(
-                                username=request.user.username
-                            )
-                            if user2.is_active:
-                                db.is_superuser = user2.is_superuser
-                                request.user.scenarios.append(db)
-                        except Exception:
-                            # Silently ignore errors. Eg user doesn't exist in scenario
-                            pass
+                MultiDBBackend.getScenarios(request.user)
             except User.DoesNotExist:
                 pass
         return self.get_response(request)
@@ -0,0 +1,92 @@
+import datetime
+
+import data_admin.common.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("common", "0001_initial")]
+
+    operations = [
+        migrations.CreateModel(
+            name="MailQueue",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        primary_key=True, serialize=False, verbose_name="identifier"
+                    ),
+                ),
+                ("subject", models.TextField(verbose_name="subject")),
+                ("body", models.TextField(blank=True, verbose_name="body")),
+                (
+                    "html",
+                    models.TextField(blank=True, null=True, verbose_name="html body"),
+                ),
+                (
+                    "from_email",
+                    models.CharField(
+                        blank=True, max_length=300, null=True, verbose_name="sender"
+                    ),
+                ),
+                (
+                    "recipients",
+                    data_admin.common.fields.JSONBField(verbose_name="recipients"),
+                ),
+                (
+                    "attachments",
+                    data_admin.common.fields.JSONBField(
+                        blank=True, null=True, verbose_name="attachments"
+                    ),
+                ),
+                (
+                    "attachment_data",
+                    models.BinaryField(
+                        blank=True, null=True, verbose_name="attachment data"
+                    ),
+                ),
+                (
+                    "task",
+                    models.IntegerField(blank=True, null=True, verbose_name="task"),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[("Q", "queued"), ("F", "failed")],
+                        default="Q",
+                        max_length=5,
+                        verbose_name="status",
+                    ),
+                ),
+                ("attempts", models.IntegerField(default=0, verbose_name="attempts")),
+                (
+                    "created",
+                    models.DateTimeField(auto_now_add=True, verbose_name="created"),
+                ),
+                (
+                    "next_attempt",
+                    models.DateTimeField(
+                        default=datetime.datetime.now, verbose_name="next attempt"
+                    ),
+                ),
+                (
+                    "message",
+                    models.TextField(blank=True, null=True, verbose_name="message"),
+                ),
+            ],
+            options={
+                "verbose_name": "queued email",
+                "verbose_name_plural": "queued emails",
+                "db_table": "common_mailqueue",
+            },
+        ),
+        migrations.AddIndex(
+            model_name="mailqueue",
+            index=models.Index(
+                condition=models.Q(status="Q"),
+                fields=["next_attempt"],
+                name="common_mailqueue_due",
+            ),
+        ),
+    ]
@@ -0,0 +1,76 @@
+import datetime
+
+import data_admin.common.fields
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("common", "0002_mailqueue")]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserChange",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        primary_key=True, serialize=False, verbose_name="identifier"
+                    ),
+                ),
+                (
+                    "fields",
+                    data_admin.common.fields.JSONBField(
+                        editable=False, verbose_name="fields"
+                    ),
+                ),
+                (
+                    "scenarios",
+                    data_admin.common.fields.JSONBField(
+                        editable=False, null=True, verbose_name="scenarios"
+                    ),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[("Q", "queued"), ("F", "failed")],
+                        default="Q",
+                        editable=False,
+                        max_length=5,
+                        verbose_name="status",
+                    ),
+                ),
+                (
+                    "attempts",
+                    models.IntegerField(
+                        default=0, editable=False, verbose_name="attempts"
+                    ),
+                ),
+                (
+                    "next_attempt",
+                    models.DateTimeField(
+                        default=datetime.datetime.now,
+                        editable=False,
+                        verbose_name="next attempt",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        editable=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="user",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "user change",
+                "verbose_name_plural": "user changes",
+                "db_table": "common_userchange",
+                "default_permissions": [],
+            },
+        ),
+    ]
@@ -1,4 +1,11 @@
-from datetime import datetime
+from bisect import bisect_left, bisect_right
+from copy import deepcopy
+from datetime import datetime, timedelta
+from dateutil.parser import parse
+from email import message_from_bytes
+from email.message import Message
+from email.mime.base import MIMEBase
+from email.policy import compat32
 from importlib import import_module
 import inspect
 import json
@@ -6,19 +13,29 @@ import logging
 from multiprocessing import Process
 from psycopg2.extras import execute_batch
 import sys
+from threading import Thread
 import time
+from uuid import uuid4
 
+from django.apps import apps
 from django.conf import settings
 from django.contrib.admin.utils import quote
-from django.contrib.auth.models import AbstractUser, Group
+from django.contrib.auth.models import AbstractUser, Group, Permission
+from django.contrib.auth.signals import user_logged_in
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.core import mail
 from django.core.validators import FileExtensionValidator
 from django.db import models, DEFAULT_DB_ALIAS, connections, transaction
-from django.db.models import Q
-from django.db.models.signals import pre_delete
+from django.db.models import Q, prefetch_related_objects
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_delete,
+)
 from django.dispatch.dispatcher import receiver
 from django import forms
 from django.forms.models import modelform_factory
@@ -346,6 +363,64 @@ class Scenario(models.Model):
         ordering = ["name"]
 
 
+class TablePresence:
+    """
+    Cache of the tables that contain data in a scenario.
+
+    The set of non-empty tables is computed with a single query, and kept in
+    the Django cache for TABLE_PRESENCE_CACHE_TIMEOUT seconds. The commands and
+    uploads that add or remove data invalidate it.
+    Every computation gets a new version identifier, which other cache keys
+    depending on the table contents can include.
+    """
+
+    @staticmethod
+    def get(database=DEFAULT_DB_ALIAS):
+        """
+        Returns a tuple with the version and a set of non-empty table names.
+        """
+        key = "tables_%s" % database
+        result = cache.get(key)
+        if result is None:
+            with connections[database].cursor() as cursor:
+                cursor.execute(
+                    """
+                    select table_name from (
+                      select table_name,
+                        query_to_xml(
+                          format('select 1 as cnt from %I.%I limit 1', table_schema, table_name),
+                          false, true, ''
+                          ) as xml_count
+                      from information_schema.tables
+                      where table_schema = 'public' and table_type = 'BASE TABLE'
+                      ) s
+                    where xml_count is document
+                    """
+                )
+                result = (uuid4().hex, frozenset(i[0] for i in cursor))
+            cache.set(
+                key, result, getattr(settings, "TABLE_PRESENCE_CACHE_TIMEOUT", 60)
+            )
+        return result
+
+    @staticmethod
+    def invalidate(database=DEFAULT_DB_ALIAS):
+        """
+        Clears the cache when the current transaction commits. Clearing it earlier
+        would let another request cache the uncommitted contents again.
+        """
+        transaction.on_commit(
+            lambda: cache.delete("tables_%s" % database), using=database
+        )
+
+
+@receiver([post_save, post_delete], sender=Scenario)
+def scenario_changed(sender, instance, **kwargs):
+    from .auth import MultiDBBackend
+
+    MultiDBBackend.clearScenarioCache()
+
+
 class User(AbstractUser):
     languageList = tuple(
         [("auto", _("Detect automatically"))] + list(settings.LANGUAGES)
@@ -385,12 +460,29 @@ class User(AbstractUser):
         db_index=True,
     )
 
+    # Fields that are replicated asynchronously to the other scenarios
+    deferredfields = (
+        "last_login",
+        "horizonbuckets",
+        "horizonstart",
+        "horizonend",
+        "horizontype",
+        "horizonlength",
+        "horizonbefore",
+        "horizonunit",
+        "lastmodified",
+    )
+
     def save(
         self, force_insert=False, force_update=False, using=None, update_fields=None
     ):
         """
         Every change to a user model is saved to all active scenarios.
 
+        A save that only updates fields from the deferredfields list doesn't
+        update the other scenarios immediately. The change is logged instead, and
+        replicated asynchronously by the UserSync worker.
+
         The is_superuser and is_active fields can be different in each scenario.
         All other fields are expected to be identical in each database.
 
@@ -466,11 +558,25 @@ class User(AbstractUser):
             ]
         else:
             # Important is NOT to save the is_active and is_superuser fields.
-            update_fields2 = update_fields[:]  # Copy!
+            update_fields2 = list(update_fields)  # Copy!
             if "is_active" in update_fields2:
                 update_fields2.remove("is_active")
             if "is_superuser" in update_fields:
                 update_fields2.remove("is_superuser")
+            if (
+                not newuser
+                and update_fields2
+                and set(update_fields2).issubset(self.deferredfields)
+            ):
+                # These fields are replicated asynchronously
+                if any(db != using for db in scenarios):
+                    UserChange(user_id=self.id, fields=update_fields2).save(
+                        using=using
+                    )
+                    transaction.on_commit(
+                        lambda: UserSync.launchWorker(using), using=using
+                    )
+                update_fields2 = None
         if update_fields2 or newuser:
             for db in scenarios:
                 if db == using:
@@ -523,6 +629,10 @@ class User(AbstractUser):
                 .get_or_create(name=settings.DEFAULT_USER_GROUP)[0]
             )
             self.groups.add(grp.id)
+        if not update_fields or not set(update_fields).issubset(self.deferredfields):
+            from .auth import MultiDBBackend
+
+            MultiDBBackend.clearScenarioCache(self)
         return usr
 
     def joined_age(self):
@@ -541,25 +651,68 @@ class User(AbstractUser):
         verbose_name = _("user")
         verbose_name_plural = _("users")
 
-    def getPreference(self, prop, default=None, database=DEFAULT_DB_ALIAS):
-        try:
-            result = None
-            for p in (
+    @staticmethod
+    def _preferenceCacheKey(user_id, database):
+        # The version is changed when global preferences change
+        return "prefs_%s_%s_%s" % (
+            database,
+            cache.get_or_set("prefs_version_%s" % database, lambda: uuid4().hex, None),
+            user_id,
+        )
+
+    @staticmethod
+    def clearPreferenceCache(database=DEFAULT_DB_ALIAS):
+        """
+        Invalidates the cached preferences of all users in a scenario.
+        """
+        cache.set("prefs_version_%s" % database, uuid4().hex, None)
+
+    def getPreferences(self, database=DEFAULT_DB_ALIAS):
+        """
+        Returns a dictionary with all preferences of the user, merged with the
+        global preferences.
+        All preferences are read with a single query, and are cached for
+        PREFERENCE_CACHE_TIMEOUT seconds.
+        """
+        attr = "_preferences_%s" % database
+        if hasattr(self, attr):
+            return getattr(self, attr)
+        key = self._preferenceCacheKey(self.id, database)
+        result = cache.get(key)
+        if result is None:
+            values = {}
+            for prop, value in (
                 UserPreference.objects.all()
                 .using(database)
-                .filter(property=prop)
                 .filter(Q(user__isnull=True) | Q(user=self.id))
-                .order_by("-user")
-                .only("user", "value")
+                .order_by("property", "-user")
+                .values_list("property", "value")
             ):
-                if result:
-                    result.update(p.value)
-                else:
-                    result = p.value
-            return result if result else default
-        except ValueError:
-            logger.error("Invalid preference '%s' of user '%s'" % (prop, self.username))
-            return default
+                values.setdefault(prop, []).append(value)
+            result = {}
+            for prop, vals in values.items():
+                try:
+                    merged = None
+                    for v in vals:
+                        if merged:
+                            merged.update(v)
+                        else:
+                            merged = v
+                    result[prop] = merged
+                except Exception:
+                    logger.error(
+                        "Invalid preference '%s' of user '%s'" % (prop, self.username)
+                    )
+            cache.set(
+                key, result, getattr(settings, "PREFERENCE_CACHE_TIMEOUT", 60)
+            )
+        setattr(self, attr, result)
+        return result
+
+    def getPreference(self, prop, default=None, database=DEFAULT_DB_ALIAS):
+        try:
+            result = self.getPreferences(database).get(prop, None)
+            return deepcopy(result) if result else default
         except Exception:
             return default
 
@@ -614,6 +767,13 @@ class User(AbstractUser):
                     t = json.dumps(val)
                     cursor.execute(sql, (self.id, prop, t, t))
 
+        # Invalidate the cached preferences
+        if prop in settings.GLOBAL_PREFERENCES and self.is_superuser:
+            self.clearPreferenceCache(database)
+        else:
+            cache.delete(self._preferenceCacheKey(self.id, database))
+        self.__dict__.pop("_preferences_%s" % database, None)
+
 
 class UserPreference(models.Model):
     class UserPreferenceManager(models.Manager):
@@ -646,11 +806,238 @@ class UserPreference(models.Model):
         default_permissions = []
 
 
+class UserChange(models.Model):
+    """
+    Log of user changes that still need to be replicated to the other
+    scenarios. See the UserSync class.
+    """
+
+    status_list = (("Q", "queued"), ("F", "failed"))
+
+    id = models.AutoField(_("identifier"), primary_key=True)
+    user = models.ForeignKey(
+        User, verbose_name=_("user"), editable=False, on_delete=models.CASCADE
+    )
+    fields = JSONBField(_("fields"), editable=False)
+    # Scenarios that still need the change after a failed attempt. The value
+    # null means all active scenarios.
+    scenarios = JSONBField(_("scenarios"), null=True, editable=False)
+    status = models.CharField(
+        _("status"), max_length=5, default="Q", choices=status_list, editable=False
+    )
+    attempts = models.IntegerField(_("attempts"), default=0, editable=False)
+    next_attempt = models.DateTimeField(
+        _("next attempt"), default=datetime.now, editable=False
+    )
+
+    class Meta:
+        db_table = "common_userchange"
+        verbose_name = _("user change")
+        verbose_name_plural = _("user changes")
+        default_permissions = []
+
+
+class UserSync:
+    """
+    Replicates the logged user changes of a database to all other active
+    scenarios.
+
+    Every server process will have at most 1 worker process for each database.
+    The changes are processed in batches: the changes of a user are merged,
+    users with the same changed fields are updated with a single batched
+    statement, and the scenario databases are updated in parallel.
+    A change that can't be replicated to a scenario is retried for that
+    scenario only, with an exponential backoff. After the number of attempts in
+    the USER_SYNC_RETRIES setting it is marked as failed and no longer retried.
+    """
+
+    _workers = {}
+
+    # Number of changes processed in a single transaction
+    batchsize = 1000
+
+    @classmethod
+    def launchWorker(cls, database=DEFAULT_DB_ALIAS):
+        worker = cls._workers.get(database, None)
+        if worker and not worker.is_alive():
+            worker = None
+            del cls._workers[database]
+        if not worker:
+            p = Process(
+                target=runFunction,
+                args=["data_admin.common.models.UserSync"],
+                kwargs={"database": database},
+                daemon=True,
+            )
+            cls._workers[database] = p
+            p.start()
+
+    @classmethod
+    def start(cls, database=DEFAULT_DB_ALIAS):
+        try:
+            idle_loop_done = False
+            while True:
+                if cls.synchronize(database):
+                    idle_loop_done = False
+                elif idle_loop_done and not cls.pending(database):
+                    break
+                else:
+                    idle_loop_done = True
+                    if "test" not in sys.argv:
+                        # Wait 5 seconds for new changes or retries
+                        time.sleep(5)
+        finally:
+            for db in settings.DATABASES:
+                connections[db].close()
+
+    @staticmethod
+    def pending(database=DEFAULT_DB_ALIAS):
+        """
+        Returns true when changes wait to be replicated, now or in a retry.
+        """
+        return UserChange.objects.using(database).filter(status="Q").exists()
+
+    @classmethod
+    def synchronize(cls, database=DEFAULT_DB_ALIAS):
+        """
+        Replicates a batch of logged changes that are due.
+        Returns the number of changes processed.
+        """
+        with transaction.atomic(using=database):
+            changes = list(
+                UserChange.objects.using(database)
+                .filter(status="Q", next_attempt__lte=datetime.now())
+                .order_by("id")
+                .select_for_update(skip_locked=True)[: cls.batchsize]
+            )
+            if not changes:
+                return 0
+
+            active = [
+                i
+                for i in Scenario.objects.using(DEFAULT_DB_ALIAS)
+                .filter(status="In use")
+                .values_list("name", flat=True)
+                if i in settings.DATABASES and i != database
+            ]
+
+            # Merge the changes of a user for every scenario, and group users
+            # with the same fields
+            targets = {}
+            changed = {}
+            for c in changes:
+                targets[c.id] = [
+                    db for db in active if c.scenarios is None or db in c.scenarios
+                ]
+                for db in targets[c.id]:
+                    changed.setdefault(db, {}).setdefault(c.user_id, set()).update(
+                        c.fields
+                    )
+            updates = {}
+            for db, users in changed.items():
+                groups = {}
+                for user_id, fields in users.items():
+                    groups.setdefault(tuple(sorted(fields)), []).append(user_id)
+                updates[db] = [
+                    (
+                        [User._meta.get_field(f).column for f in fields],
+                        [
+                            rec[1:] + (rec[0],)
+                            for rec in User.objects.using(database)
+                            .filter(id__in=user_ids)
+                            .values_list("id", *fields)
+                        ],
+                    )
+                    for fields, user_ids in groups.items()
+                ]
+
+            failed = []
+            threads = [
+                Thread(target=cls._update, args=(db, upd, failed))
+                for db, upd in updates.items()
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            # Changes are kept only for the scenarios that failed
+            done = []
+            for c in changes:
+                remaining = [db for db in targets[c.id] if db in failed]
+                if not remaining:
+                    done.append(c.id)
+                    continue
+                c.scenarios = remaining
+                c.attempts += 1
+                if c.attempts >= getattr(settings, "USER_SYNC_RETRIES", 5):
+                    logger.error(
+                        "Giving up synchronizing user %s in scenarios %s"
+                        % (c.user_id, ", ".join(remaining))
+                    )
+                    c.status = "F"
+                c.next_attempt = datetime.now() + timedelta(
+                    seconds=getattr(settings, "USER_SYNC_RETRY_DELAY", 60)
+                    * 2 ** (c.attempts - 1)
+                )
+                c.save(
+                    using=database,
+                    update_fields=["scenarios", "attempts", "status", "next_attempt"],
+                )
+            UserChange.objects.using(database).filter(id__in=done).delete()
+        return len(changes)
+
+    @staticmethod
+    def _update(database, updates, failed):
+        # Runs in a separate thread, with its own database connection.
+        # A database that can't be updated is appended to the failed list.
+        try:
+            with transaction.atomic(using=database):
+                with connections[database].cursor() as cursor:
+                    for columns, rows in updates:
+                        execute_batch(
+                            cursor,
+                            "update common_user set %s where id = %%s"
+                            % ", ".join(
+                                "%s = %%s" % connections[database].ops.quote_name(c)
+                                for c in columns
+                            ),
+                            rows,
+                        )
+        except Exception as e:
+            logger.warning(
+                "Can't synchronize users in scenario '%s': %s" % (database, e)
+            )
+            failed.append(database)
+        finally:
+            connections[database].close()
+
+
 @receiver(pre_delete, sender=User)
 def delete_user(sender, instance, **kwargs):
     raise PermissionDenied
 
 
+@receiver(user_logged_in)
+def prefetch_preferences(sender, request, user, **kwargs):
+    # Load all preferences of the user in the cache
+    try:
+        user.getPreferences(getattr(request, "database", DEFAULT_DB_ALIAS))
+    except Exception as e:
+        logger.warning("Can't load preferences of user '%s': %s" % (user, e))
+
+
+@receiver([post_save, post_delete], sender=Group)
+@receiver([post_save, post_delete], sender=Permission)
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=Group.permissions.through)
+def permissions_changed(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    from .auth import MultiDBBackend
+
+    MultiDBBackend.clearPermissionCache(using)
+
+
 class Comment(models.Model):
     type_list = (
         ("add", _("Add")),
@@ -697,6 +1084,29 @@ class Comment(models.Model):
     )
     processed = models.BooleanField("processed", default=False, db_index=True)
 
+    @classmethod
+    def erase(cls, content_types, types=None, database=DEFAULT_DB_ALIAS):
+        """
+        Deletes the comments of a list of content type identifiers, optionally
+        limited to some comment types. Their notifications are deleted as well.
+        The statements are set-based, and don't load any record in memory.
+        """
+        condition = "content_type_id = any(%s)"
+        args = [list(content_types)]
+        if types:
+            condition += " and type = any(%s)"
+            args.append(list(types))
+        with connections[database].cursor() as cursor:
+            cursor.execute(
+                """
+                delete from common_notification
+                where comment_id in (select id from common_comment where %s)
+                """
+                % condition,
+                args,
+            )
+            cursor.execute("delete from common_comment where %s" % condition, args)
+
     def model_name(self):
         m = self.content_type.model_class()
         return "%s.%s" % (m._meta.app_label, m._meta.model_name)
@@ -722,15 +1132,31 @@ class Comment(models.Model):
             update_fields=update_fields,
         )
         if update_fields != ["processed"]:
-            req = getattr(_thread_locals, "request", None)
-            NotificationFactory.launchWorker(
-                database=using,
-                url="%s://%s" % ("https" if req.is_secure() else "http", req.get_host())
-                if req
-                else None,
-            )
+            self._notify(using)
         return tmp
 
+    @classmethod
+    def bulkCreate(cls, comments, database=DEFAULT_DB_ALIAS):
+        """
+        Inserts a list of comments with a single statement, and launches the
+        notification worker only once.
+        """
+        if comments:
+            cls.objects.using(database).bulk_create(comments)
+            cls._notify(database)
+
+    @staticmethod
+    def _notify(database):
+        from .middleware import _thread_locals
+
+        req = getattr(_thread_locals, "request", None)
+        NotificationFactory.launchWorker(
+            database=database,
+            url="%s://%s" % ("https" if req.is_secure() else "http", req.get_host())
+            if req
+            else None,
+        )
+
     def attachmentlink(self):
         if self.attachment:
             return mark_safe(
@@ -1006,9 +1432,249 @@ class Notification(models.Model):
         db_table = "common_notification"
 
 
+class _MIMEPart(MIMEBase):
+    """
+    A MIME attachment read back from its serialized form.
+    """
+
+    def __init__(self, policy=None):
+        Message.__init__(self, policy=policy or compat32)
+
+
+class MailQueue(models.Model):
+    """
+    Outbound emails.
+
+    Emails are queued in the same transaction as the data they are about, and
+    delivered afterwards by the flush method. A failed delivery is retried with
+    an exponential backoff, until the MAIL_RETRIES setting is exceeded. The task
+    that queued the email is then marked as failed. Failed emails are kept for
+    MAIL_FAILED_DAYS days.
+    """
+
+    status_list = (("Q", "queued"), ("F", "failed"))
+
+    # Number of emails delivered in a single flush
+    batchsize = 100
+
+    # Number of seconds an email is reserved for the process delivering it
+    lease = 600
+
+    id = models.AutoField(_("identifier"), primary_key=True)
+    subject = models.TextField(_("subject"))
+    body = models.TextField(_("body"), blank=True)
+    html = models.TextField(_("html body"), null=True, blank=True)
+    from_email = models.CharField(_("sender"), max_length=300, null=True, blank=True)
+    recipients = JSONBField(_("recipients"))
+    attachments = JSONBField(_("attachments"), null=True, blank=True)
+    attachment_data = models.BinaryField(_("attachment data"), null=True, blank=True)
+    task = models.IntegerField(_("task"), null=True, blank=True)
+    status = models.CharField(
+        _("status"), max_length=5, null=False, default="Q", choices=status_list
+    )
+    attempts = models.IntegerField(_("attempts"), default=0)
+    created = models.DateTimeField(_("created"), auto_now_add=True)
+    next_attempt = models.DateTimeField(_("next attempt"), default=datetime.now)
+    message = models.TextField(_("message"), null=True, blank=True)
+
+    def __str__(self):
+        return "%s: %s" % (self.id, self.subject)
+
+    @classmethod
+    def enqueue(cls, email, database=DEFAULT_DB_ALIAS, task=None):
+        """
+        Stores an EmailMessage in the queue.
+        The contents of all attachments are concatenated in the attachment_data
+        field, and the attachments field describes them: either a name, mime type
+        and size, or the size of a complete MIME part.
+        """
+        html = None
+        for content, mimetype in getattr(email, "alternatives", []):
+            if mimetype == "text/html":
+                html = content
+        attachments = []
+        data = []
+        for attachment in email.attachments:
+            if isinstance(attachment, MIMEBase):
+                content = attachment.as_bytes()
+                attachments.append({"mime": True, "size": len(content)})
+            else:
+                name, content, mimetype = attachment
+                if isinstance(content, str):
+                    content = content.encode("utf-8")
+                attachments.append(
+                    {"name": name, "mimetype": mimetype, "size": len(content)}
+                )
+            data.append(content)
+        m = cls(
+            subject=email.subject,
+            body=email.body,
+            html=html,
+            from_email=email.from_email,
+            recipients={
+                "to": list(email.to),
+                "cc": list(email.cc),
+                "bcc": list(email.bcc),
+            },
+            attachments=attachments or None,
+            attachment_data=b"".join(data) if data else None,
+            task=task,
+        )
+        m.save(using=database)
+        return m
+
+    @classmethod
+    def send(cls, email, database=DEFAULT_DB_ALIAS, task=None):
+        """
+        Queues an EmailMessage and tries to deliver it right away.
+        Returns None when the email is delivered, and the error message when it
+        stays in the queue to be retried.
+        """
+        m = cls.enqueue(email, database, task)
+        cls.flush(database, ids=[m.id])
+        return (
+            cls.objects.using(database)
+            .filter(id=m.id)
+            .values_list("message", flat=True)
+            .first()
+        )
+
+    @classmethod
+    def pending(cls, database=DEFAULT_DB_ALIAS):
+        """
+        Returns true when emails wait to be delivered.
+        """
+        return cls.objects.using(database).filter(status="Q").exists()
+
+    def getEmail(self):
+        """
+        Returns an EmailMessage for this queued email.
+        """
+        email = mail.EmailMultiAlternatives(
+            self.subject,
+            self.body,
+            self.from_email or settings.DEFAULT_FROM_EMAIL,
+            to=self.recipients.get("to", []),
+            cc=self.recipients.get("cc", []),
+            bcc=self.recipients.get("bcc", []),
+        )
+        if self.html:
+            email.attach_alternative(self.html, "text/html")
+        data = bytes(self.attachment_data or b"")
+        offset = 0
+        for attachment in self.attachments or []:
+            content = data[offset : offset + attachment["size"]]
+            offset += attachment["size"]
+            if attachment.get("mime"):
+                email.attach(message_from_bytes(content, _class=_MIMEPart))
+            else:
+                email.attach(attachment["name"], content, attachment["mimetype"])
+        return email
+
+    @classmethod
+    def flush(cls, database=DEFAULT_DB_ALIAS, connection=None, ids=None):
+        """
+        Delivers the queued emails that are due, or only the ones with the
+        identifiers passed.
+
+        All emails are sent over a single connection. A caller sending mails
+        regularly can pass an open connection to keep reusing it.
+        Returns the number of emails that were delivered.
+        """
+        if ids is None:
+            cls.objects.using(database).filter(
+                status="F",
+                created__lt=datetime.now()
+                - timedelta(days=getattr(settings, "MAIL_FAILED_DAYS", 30)),
+            ).delete()
+        sent = 0
+        while True:
+            now = datetime.now()
+            with transaction.atomic(using=database):
+                emails = cls.objects.using(database).filter(
+                    status="Q", next_attempt__lte=now
+                )
+                if ids is not None:
+                    emails = emails.filter(id__in=ids)
+                emails = list(
+                    emails.order_by("id").select_for_update(skip_locked=True)[
+                        : cls.batchsize
+                    ]
+                )
+                if not emails:
+                    break
+                # Reserve the emails, so other processes skip them
+                cls.objects.using(database).filter(
+                    id__in=[m.id for m in emails]
+                ).update(next_attempt=now + timedelta(seconds=cls.lease))
+            if not connection:
+                connection = mail.get_connection()
+                own_connection = True
+            else:
+                own_connection = False
+            try:
+                for m in emails:
+                    try:
+                        connection.send_messages([m.getEmail()])
+                        m.delete(using=database)
+                        sent += 1
+                    except Exception as e:
+                        m.failed(e, database)
+                        # The connection will be reopened for the next email
+                        try:
+                            connection.close()
+                        except Exception:
+                            pass
+            finally:
+                if own_connection:
+                    connection.close()
+                    connection = None
+        return sent
+
+    def failed(self, error, database=DEFAULT_DB_ALIAS):
+        """
+        Records a failed delivery, and schedules the next attempt.
+        After the last attempt, the task that queued the email is marked failed.
+        """
+        self.attempts += 1
+        self.message = str(error)
+        if self.attempts >= getattr(settings, "MAIL_RETRIES", 5):
+            logger.error("Error mailing message %s: %s" % (self.id, error))
+            self.status = "F"
+            if self.task:
+                apps.get_model("execute", "Task").objects.using(database).filter(
+                    id=self.task
+                ).update(
+                    status="Failed", message="Email delivery failed: %s" % error
+                )
+        else:
+            logger.warning("Error mailing message %s, retrying: %s" % (self.id, error))
+        self.next_attempt = datetime.now() + timedelta(
+            seconds=getattr(settings, "MAIL_RETRY_DELAY", 60)
+            * 2 ** (self.attempts - 1)
+        )
+        self.save(
+            using=database,
+            update_fields=["attempts", "message", "status", "next_attempt"],
+        )
+
+    class Meta:
+        verbose_name = _("queued email")
+        verbose_name_plural = _("queued emails")
+        db_table = "common_mailqueue"
+        indexes = [
+            models.Index(
+                fields=["next_attempt"],
+                name="common_mailqueue_due",
+                condition=Q(status="Q"),
+            )
+        ]
+
+
 class NotificationFactory:
     _workers = {}
     _reg = {}
+    _url = None
 
     @classmethod
     def launchWorker(cls, database=DEFAULT_DB_ALIAS, url=None):
@@ -1027,7 +1693,20 @@ class NotificationFactory:
             p.start()
 
     @classmethod
-    def register(cls, followerclass, messageclasses):
+    def register(cls, followerclass, messageclasses, match=None):
+        """
+        Decorator to register a notification function.
+
+        The optional match argument is a dictionary that maps message classes to
+        a field (or a field path with double underscores) on the message object.
+        A follower of the follower class can only be interested in a message on
+        such a class when the object name of the follower is equal to the value
+        of that field. The value "pk" stands for the message object itself.
+        These matches are computed with a single query for a batch of messages,
+        and the notification function is only called for the matching pairs to
+        evaluate any remaining conditions.
+        """
+
         def decorator(func):
             if not inspect.isclass(followerclass):
                 raise Exception("NotificationFactory needs a class as first argument")
@@ -1040,8 +1719,15 @@ class NotificationFactory:
                     cls._reg[m].append(func)
                 else:
                     cls._reg[m] = [func]
+            if match:
+                for m in match:
+                    if m not in messageclasses:
+                        raise Exception(
+                            "NotificationFactory can only match on message classes"
+                        )
             func.messages = messageclasses
             func.follower = followerclass
+            func.match = match or {}
             return func
 
         return decorator
@@ -1062,13 +1748,193 @@ class NotificationFactory:
                 ):
                     raise e
 
+    # Number of comments processed in a single transaction
+    batchsize = 500
+
+    @classmethod
+    def _getCandidates(cls, model, followers, cache):
+        """
+        Returns the followers that can be interested in messages on a model,
+        together with the notification functions to evaluate for them.
+        The result is an ordered list of (follower, functions) tuples, which is
+        computed only once per model.
+        """
+        if model not in cache:
+            candidates = []
+            meta = cls._reg.get(model, None)
+            if meta:
+                for flw in followers:
+                    funcs = [c for c in meta if flw._model in c.messages]
+                    if funcs:
+                        candidates.append((flw, funcs))
+            cache[model] = candidates
+        return cache[model]
+
+    @classmethod
+    def _getMatches(cls, func, model, msgs, objects, database):
+        """
+        Returns the set of (comment id, follower id) pairs that satisfy the
+        match declared by a notification function for a model.
+        """
+        matches = set()
+        flws = objects.get(func.follower, None)
+        if not flws:
+            return matches
+        field = func.match[model]
+        if field == "pk":
+            for msg in msgs:
+                for flw in flws.get(msg.object_pk, []):
+                    matches.add((msg.id, flw.id))
+            return matches
+        keys = {}
+        for msg in msgs:
+            keys.setdefault(msg.object_pk, []).append(msg.id)
+        for pk, value in (
+            model.objects.using(database)
+            .filter(pk__in=list(keys.keys()))
+            .values_list("pk", field)
+        ):
+            if value is None:
+                continue
+            for flw in flws.get(str(value), []):
+                for msg_id in keys.get(str(pk), []):
+                    matches.add((msg_id, flw.id))
+        return matches
+
+    @classmethod
+    def _processBatch(
+        cls, messages, followers, candidates, objects, permissions, database
+    ):
+        """
+        Creates the notifications for a batch of comments.
+        Returns the list of emails to send.
+        """
+        notifications = []
+        emails = []
+
+        def has_perm(user, perm):
+            key = (user.id, perm)
+            if key not in permissions:
+                permissions[key] = user.has_perm(perm)
+            return permissions[key]
+
+        # Group the messages by content type
+        groups = {}
+        for msg in messages:
+            groups.setdefault(msg.content_type_id, []).append(msg)
+
+        for msgs in groups.values():
+            try:
+                model = msgs[0].content_type.model_class()
+                view_permission = (
+                    "%s.view_%s" % (model._meta.app_label, model._meta.model_name)
+                    if "view" in model._meta.default_permissions
+                    else None
+                )
+                flws = cls._getCandidates(model, followers, candidates)
+            except Exception as e:
+                logger.error("Couldn't create nofications for messages: %s" % e)
+                continue
+            if not flws:
+                continue
+            # Evaluate the declared matches for the complete group at once
+            matches = {}
+            for c in cls._reg[model]:
+                if model in c.match:
+                    try:
+                        matches[c] = cls._getMatches(c, model, msgs, objects, database)
+                    except Exception as e:
+                        # Fall back to calling the function for every message
+                        logger.error(
+                            "Exception matching notification function %s: %s"
+                            % (c, e)
+                        )
+            try:
+                # Load all related objects in a single query
+                prefetch_related_objects(msgs, "content_object")
+            except Exception:
+                # The objects will be loaded one by one
+                pass
+            for msg in msgs:
+                recipients = set()
+                created = set()
+                for flw, funcs in flws:
+                    if flw.user_id in created:
+                        continue
+                    if view_permission and not has_perm(flw.user, view_permission):
+                        continue
+                    for c in funcs:
+                        try:
+                            if flw.object_pk == "all":
+                                found = True
+                            elif c in matches and flw._model == c.follower:
+                                # The function is only called for pairs that
+                                # already match on the declared field
+                                found = (msg.id, flw.id) in matches[c] and c(flw, msg)
+                            else:
+                                found = c(flw, msg)
+                        except Exception as e:
+                            logger.error(
+                                "Exception in notification function %s: %s" % (c, e)
+                            )
+                            continue
+                        if found:
+                            notifications.append(
+                                Notification(
+                                    comment=msg,
+                                    user=flw.user,
+                                    type=flw.type,
+                                    follower=flw,
+                                )
+                            )
+                            if (
+                                flw.type == "M"
+                                and flw.user.email
+                                and settings.EMAIL_HOST
+                            ):
+                                recipients.add(flw.user.email)
+                            created.add(flw.user_id)
+                            break
+                if recipients:
+                    try:
+                        data = msg.getMail(cls._url, database)
+                        email = mail.EmailMultiAlternatives(
+                            data[0],
+                            data[1],
+                            settings.DEFAULT_FROM_EMAIL,
+                            recipients,
+                        )
+                        if data[2]:
+                            email.attach_alternative(data[2], "text/html")
+                        emails.append(email)
+                    except Exception as e:
+                        logger.error(
+                            "Couldn't create email for message %s: %s" % (msg.id, e)
+                        )
+        if notifications:
+            Notification.objects.using(database).bulk_create(
+                notifications, batch_size=1000
+            )
+        return emails
+
     @classmethod
     def start(cls, url=None, database=DEFAULT_DB_ALIAS):
         """
         Every server process will have at most 1 worker processes for each database.
         The worker process is spawned by the multiprocessing module and runs this method.
+
+        Comments are processed in batches:
+          - the followers are loaded once, and indexed by the model of the messages
+            they can be interested in
+          - permission checks are cached per user
+          - notifications are inserted in bulk
+          - the comments are marked processed with a single update statement
+          - emails are queued in the same transaction, and delivered after the
+            commit over a single SMTP connection
         """
         cls._buildRegistry()
+        cls._url = url
+        smtp = None
         try:
             from .middleware import _thread_locals
 
@@ -1077,101 +1943,50 @@ class NotificationFactory:
                 Follower.objects.all()
                 .using(database)
                 .filter(user__is_active=True)
+                .select_related("user", "content_type")
                 .order_by("id")
             )
+            # Index the followers by model and object name
+            objects = {}
+            for flw in followers:
+                flw._model = flw.content_type.model_class()
+                objects.setdefault(flw._model, {}).setdefault(
+                    flw.object_pk, []
+                ).append(flw)
+            candidates = {}
+            permissions = {}
             idle_loop_done = False
             while True:
                 with transaction.atomic(using=database):
                     empty = True
                     emails = []
                     if followers:
-                        for msg in (
+                        messages = list(
                             Comment.objects.all()
                             .using(database)
                             .filter(processed=False)
                             .order_by("id")
                             .select_related("content_type")
-                            .select_for_update(skip_locked=True, of=("self",))[:50]
-                        ):
+                            .select_for_update(skip_locked=True, of=("self",))[
+                                : cls.batchsize
+                            ]
+                        )
+                        if messages:
                             empty = False
-                            recipients = set()
-                            try:
-                                created = set()
-                                model = msg.content_type.model_class()
-                                view_permission = (
-                                    "%s.view_%s"
-                                    % (model._meta.app_label, model._meta.model_name)
-                                    if "view" in model._meta.default_permissions
-                                    else None
-                                )
-                                meta = cls._reg.get(model, None)
-                                if meta:
-                                    for flw in followers:
-                                        for c in meta:
-                                            try:
-                                                if (
-                                                    flw.user not in created
-                                                    and flw.content_type.model_class()
-                                                    in c.messages
-                                                    and (
-                                                        flw.object_pk == "all"
-                                                        or c(flw, msg)
-                                                    )
-                                                    and (
-                                                        not view_permission
-                                                        or flw.user.has_perm(
-                                                            view_permission
-                                                        )
-                                                    )
-                                                ):
-                                                    Notification(
-                                                        comment=msg,
-                                                        user=flw.user,
-                                                        type=flw.type,
-                                                        follower=flw,
-                                                    ).save(database)
-                                                    if (
-                                                        flw.type == "M"
-                                                        and flw.user.email
-                                                        and settings.EMAIL_HOST
-                                                    ):
-                                                        recipients.add(flw.user.email)
-                                                    created.add(flw.user)
-                                                    break
-                                            except Exception as e:
-                                                logger.error(
-                                                    "Exception in notification function %s: %s"
-                                                    % (c, e)
-                                                )
-                                msg.processed = True
-                                msg.save(update_fields=["processed"], using=database)
-                                if recipients:
-                                    data = msg.getMail(url, database)
-                                    email = mail.EmailMultiAlternatives(
-                                        data[0],
-                                        data[1],
-                                        settings.DEFAULT_FROM_EMAIL,
-                                        recipients,
-                                    )
-                                    if data[2]:
-                                        email.attach_alternative(data[2], "text/html")
-                                    emails.append(email)
-                            except Exception as e:
-                                logger.error(
-                                    "Couldn't create nofications for message %s: %s"
-                                    % (msg.id, e)
-                                )
-                        if emails:
-                            connection = None
-                            try:
-                                connection = mail.get_connection()
-                                connection.open()
-                                connection.send_messages(emails)
-                            except Exception as e:
-                                logger.error("Error mailing messages: %s" % e)
-                            finally:
-                                if connection:
-                                    connection.close()
+                            emails = cls._processBatch(
+                                messages,
+                                followers,
+                                candidates,
+                                objects,
+                                permissions,
+                                database,
+                            )
+                            Comment.objects.using(database).filter(
+                                id__in=[msg.id for msg in messages]
+                            ).update(processed=True)
+                        for email in emails:
+                            # Queued in the same transaction as the notifications
+                            MailQueue.enqueue(email, database)
                     else:
                         # No followers at all -> All messages can immediately be marked processed
                         recs = (
@@ -1192,7 +2007,27 @@ class NotificationFactory:
                                 # the test suite, we try again 5 seconds later before shutting
                                 # down the worker.
                                 time.sleep(5)
+                if emails:
+                    # Deliver the emails after committing, reusing the same
+                    # SMTP connection for all batches
+                    try:
+                        if not smtp:
+                            smtp = mail.get_connection()
+                            smtp.open()
+                        MailQueue.flush(database, connection=smtp)
+                    except Exception as e:
+                        logger.error("Error mailing messages: %s" % e)
+            if MailQueue.pending(database):
+                # A worker process delivers the emails that need a retry
+                from ..execute.management.commands.runworker import launchWorker
+
+                launchWorker(database)
         finally:
+            if smtp:
+                try:
+                    smtp.close()
+                except Exception:
+                    pass
             for db in settings.DATABASES:
                 connections[db].close()
 
@@ -1440,3 +2275,113 @@ class BucketDetail(AuditModel):
         db_table = "common_bucketdetail"
         unique_together = (("bucket", "startdate"),)
         ordering = ["bucket", "startdate"]
+
+
+class BucketCalendar:
+    """
+    In-memory copy of the time buckets of a scenario.
+
+    The buckets, their dates and the current date parameter are loaded with
+    3 queries. The copy is kept until the buckets or the current date change,
+    or until BUCKET_CACHE_TIMEOUT seconds have passed.
+    The dates of a bucket are stored as sorted lists, such that the dates in a
+    horizon are found with a binary search.
+    """
+
+    _calendars = {}
+
+    @classmethod
+    def get(cls, database=DEFAULT_DB_ALIAS):
+        version = cache.get_or_set(
+            "buckets_version_%s" % database, lambda: uuid4().hex, None
+        )
+        cal = cls._calendars.get(database, None)
+        if not cal or cal.version != version or cal.expires < time.time():
+            cal = cls(database, version)
+            cls._calendars[database] = cal
+        return cal
+
+    @staticmethod
+    def invalidate(database=DEFAULT_DB_ALIAS):
+        cache.set("buckets_version_%s" % database, uuid4().hex, None)
+
+    def __init__(self, database, version):
+        self.version = version
+        self.expires = time.time() + getattr(settings, "BUCKET_CACHE_TIMEOUT", 60)
+        self.buckets = list(
+            Bucket.objects.using(database)
+            .order_by("-level", "name")
+            .values_list("name", "level")
+        )
+        self.dates = {}
+        for bucket, name, startdate, enddate in (
+            BucketDetail.objects.using(database)
+            .order_by("bucket", "startdate")
+            .values_list("bucket", "name", "startdate", "enddate")
+        ):
+            d = self.dates.get(bucket, None)
+            if not d:
+                d = self.dates[bucket] = ([], [], [])
+            d[0].append(startdate)
+            d[1].append(enddate)
+            d[2].append(name)
+        # A binary search on the end dates requires them to be sorted as well
+        self.sorted = {
+            b: all(d[1][i] <= d[1][i + 1] for i in range(len(d[1]) - 1))
+            for b, d in self.dates.items()
+        }
+        try:
+            self.currentdate = parse(
+                Parameter.objects.using(database).get(name="currentdate").value
+            )
+        except Exception:
+            self.currentdate = None
+
+    def getBucketNames(self, minlevel=-999, maxlevel=999):
+        """
+        Returns the names of the buckets between two levels, most detailed first.
+        """
+        return [n for n, lvl in self.buckets if minlevel <= lvl <= maxlevel]
+
+    def hasBucket(self, name, minlevel=-999, maxlevel=999):
+        return name in self.getBucketNames(minlevel, maxlevel)
+
+    def getDates(self, bucket, start=None, end=None, current=None):
+        """
+        Returns a list of dictionaries with the name, start date, end date and
+        history flag of the dates of a bucket that overlap with a horizon.
+        """
+        d = self.dates.get(bucket, None)
+        if not d:
+            return []
+        if self.sorted[bucket]:
+            lo = bisect_right(d[1], start) if start else 0
+            hi = bisect_left(d[0], end) if end else len(d[0])
+            idx = range(lo, hi)
+        else:
+            idx = [
+                i
+                for i in range(len(d[0]))
+                if (not start or d[1][i] > start) and (not end or d[0][i] < end)
+            ]
+        return [
+            {
+                "name": d[2][i],
+                "startdate": d[0][i],
+                "enddate": d[1][i],
+                "history": 1 if current and d[1][i] < current else 0,
+            }
+            for i in idx
+        ]
+
+
+@receiver([post_save, post_delete], sender=Bucket)
+@receiver([post_save, post_delete], sender=BucketDetail)
+def buckets_changed(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    BucketCalendar.invalidate(using)
+
+
+@receiver([post_save, post_delete], sender=Parameter)
+def parameter_changed(sender, instance, using=DEFAULT_DB_ALIAS, **kwargs):
+    if instance.name == "currentdate":
+        BucketCalendar.invalidate(using)
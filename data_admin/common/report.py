@@ -33,6 +33,8 @@ import csv
 from datetime import date, datetime, timedelta, time
 from decimal import Decimal
 import functools
+import heapq
+import itertools
 import logging
 import math
 import operator
@@ -45,11 +47,10 @@ from openpyxl import load_workbook, Workbook
 from openpyxl.utils import get_column_letter
 from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import NamedStyle, PatternFill
-from dateutil.parser import parse
 from openpyxl.comments import Comment as CellComment
 
-from django.db.models import Model, Lookup
-from django.db.models.expressions import RawSQL
+from django.apps import apps
+from django.db.models import Model, Lookup, signals
 from django.db.utils import DEFAULT_DB_ALIAS, load_backend
 from django.contrib.auth.models import Group
 from django.contrib.auth import get_permission_codename
@@ -59,7 +60,6 @@ from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.admin.utils import unquote, quote
 from django.core.exceptions import ValidationError
-from django.core.management.color import no_style
 from django.db import connections, transaction, models
 from django.db.models.fields import CharField, AutoField
 from django.db.models.fields.related import RelatedField
@@ -79,10 +79,14 @@ from django.views.generic.base import View
 
 from ..boot import getAttributeFields
 from .models import (
+    AuditModel,
+    BucketCalendar,
     User,
     Comment,
     HierarchyModel,
     NotificationFactory,
+    Parameter,
+    TablePresence,
 )
 from .dataload import parseExcelWorksheet, parseCSVdata
 
@@ -182,13 +186,60 @@ def matchesModelName(name, model):
                 return False
 
 
+def _normalizedNames(model):
+    return [
+        re.sub(separatorpattern, "", str(n).lower())
+        for n in (
+            model._meta.model_name,
+            model._meta.verbose_name,
+            model._meta.verbose_name_plural,
+        )
+    ]
+
+
+@functools.lru_cache(maxsize=None)
+def _getModelNames(language):
+    """
+    Returns a dictionary from normalized model names to the model, for a language
+    and English.
+    """
+    models = apps.get_models()
+    with translation.override(language):
+        localized = [_normalizedNames(m) for m in models]
+    with translation.override("en"):
+        english = [_normalizedNames(m) for m in models]
+    names = {}
+    for m, loc, eng in zip(models, localized, english):
+        for n in loc + eng:
+            names.setdefault(n, m)
+    return names
+
+
+def getModelByName(name, database=DEFAULT_DB_ALIAS):
+    """
+    Returns a tuple with the model matching a name and its content type
+    identifier in a database, or (None, None) when no model matches.
+    The matching rules are the same as for the matchesModelName method. The names
+    of all models are only computed once for every language. The content type
+    identifiers are cached per database by the ContentType manager.
+    """
+    model = _getModelNames(translation.get_language()).get(
+        re.sub(separatorpattern, "", name.lower())
+    )
+    if not model:
+        return (None, None)
+    return (
+        model,
+        ContentType.objects.db_manager(database)
+        .get_for_model(model, for_concrete_model=False)
+        .pk,
+    )
+
+
 def getHorizon(request, future_only=False):
     # Pick up the current date
-    try:
-        current = parse(
-            Parameter.objects.using(request.database).get(name="currentdate").value
-        )
-    except Exception:
+    current = BucketCalendar.get(request.database).currentdate
+    if not current:
         current = datetime.now()
         current = current.replace(microsecond=0)
 
@@ -669,7 +720,7 @@ class GridReport(View):
 
     @staticmethod
     def _getJSONValue(data, field=None, request=None):
-        if isinstance(data, str) or isinstance(data, (list, tuple)):
+        if isinstance(data, str) or isinstance(data, (list, tuple, dict)):
             return json.dumps(data)
         elif isinstance(data, timedelta):
             return data.total_seconds()
@@ -733,29 +784,17 @@ class GridReport(View):
         else:
             minlvl = cls.minBucketLevel
         arg_buckets = request.GET.get("buckets", None)
-        try:
-            bucket = (
-                Bucket.objects.using(request.database)
-                .get(
-                    name=arg_buckets or request.user.horizonbuckets,
-                    level__lte=maxlvl,
-                    level__gte=minlvl,
-                )
-                .name
-            )
-        except Exception:
-            try:
-                bucket = (
-                    Bucket.objects.using(request.database)
-                    .filter(level__lte=maxlvl, level__gte=minlvl)
-                    .order_by("-level")[0]
-                    .name
-                )
-            except Exception:
-                bucket = None
+        calendar = BucketCalendar.get(request.database)
+        bucketnames = calendar.getBucketNames(minlvl, maxlvl)
+        if (arg_buckets or request.user.horizonbuckets) in bucketnames:
+            bucket = arg_buckets or request.user.horizonbuckets
+        elif bucketnames:
+            bucket = bucketnames[0]
+        else:
+            bucket = None
         if not arg_buckets and not request.user.horizonbuckets and bucket:
             request.user.horizonbuckets = bucket
-            request.user.save()
+            request.user.save(update_fields=["horizonbuckets", "lastmodified"])
 
         # Get the report horizon
         current, start, end = getHorizon(
@@ -767,15 +806,9 @@ class GridReport(View):
         request.report_startdate = start
         request.report_enddate = end
         request.report_bucket = str(bucket)
+        request.report_bucketnames = bucketnames
         if bucket:
-            res = BucketDetail.objects.using(request.database).filter(bucket=bucket)
-            if start:
-                res = res.filter(enddate__gt=start)
-            if end:
-                res = res.filter(startdate__lt=end)
-            request.report_bucketlist = res.annotate(
-                history=RawSQL("case when enddate < %s then 1 else 0 end", [current])
-            ).values("name", "startdate", "enddate", "history")
+            request.report_bucketlist = calendar.getDates(bucket, start, end, current)
         else:
             request.report_bucketlist = []
 
@@ -1595,20 +1628,7 @@ class GridReport(View):
         # Pick up the list of time buckets
         if cls.hasTimeBuckets:
             cls.getBuckets(request, args, kwargs)
-            bucketnames = Bucket.objects.using(request.database)
-            if cls.maxBucketLevel:
-                if callable(cls.maxBucketLevel):
-                    maxlvl = cls.maxBucketLevel(request)
-                    bucketnames = bucketnames.filter(level__lte=maxlvl)
-                else:
-                    bucketnames = bucketnames.filter(level__lte=cls.maxBucketLevel)
-            if cls.minBucketLevel:
-                if callable(cls.minBucketLevel):
-                    minlvl = cls.minBucketLevel(request)
-                    bucketnames = bucketnames.filter(level__gte=minlvl)
-                else:
-                    bucketnames = bucketnames.filter(level__gte=cls.minBucketLevel)
-            bucketnames = bucketnames.order_by("-level").values_list("name", flat=True)
+            bucketnames = request.report_bucketnames
         else:
             bucketnames = None
         fmt = request.GET.get("format", None)
@@ -1840,9 +1860,17 @@ class GridReport(View):
             content_type_id = ContentType.objects.get_for_model(
                 cls.model, for_concrete_model=False
             ).pk
+            edits = []
             for rec in json.JSONDecoder().decode(
                 request.read().decode(request.encoding or settings.DEFAULT_CHARSET)
             ):
+                if "delete" not in rec and "copy" not in rec:
+                    # Editing records are saved in batches
+                    edits.append(rec)
+                    continue
+                if edits:
+                    ok = cls._saveEdits(request, edits, content_type_id, resp) and ok
+                    edits = []
                 if "delete" in rec:
                     # Deleting records
                     for key in rec["delete"]:
@@ -1869,7 +1897,8 @@ class GridReport(View):
                             ok = False
                             resp.write(escape(e))
                             resp.write("<br>")
-                elif "copy" in rec:
+                    TablePresence.invalidate(request.database)
+                else:
                     # Copying records
                     for key in rec["copy"]:
                         sid = transaction.savepoint(using=request.database)
@@ -1906,145 +1935,310 @@ class GridReport(View):
                             ok = False
                             resp.write(escape(e))
                             resp.write("<br>")
-                else:
-                    # Editing records
-                    pk = rec["id"]
-                    sid = transaction.savepoint(using=request.database)
-                    try:
-                        obj = cls.model.objects.using(request.database).get(
-                            pk=rec["id"]
+            if edits:
+                ok = cls._saveEdits(request, edits, content_type_id, resp) and ok
+        if ok:
+            resp.write("OK")
+        resp.status_code = ok and 200 or 500
+        return resp
+
+    @classmethod
+    def _saveEdits(cls, request, recs, content_type_id, resp):
+        """
+        Saves a batch of edited records.
+        The records are read with a single query, and validated with a form class
+        per set of fields. Models without custom save logic are updated with a
+        bulk update per set of changed fields. The records are saved one by one
+        when the bulk update fails, or when the model has custom save logic.
+        Returns False when some records couldn't be saved.
+        """
+        ok = True
+        pkfield = cls.model._meta.pk
+        keys = {}
+        for rec in recs:
+            for i in rec:
+                if rec[i] == "\xa0":
+                    # Workaround for Jqgrid issue: date field can't be set to blank
+                    rec[i] = None
+            try:
+                keys[rec["id"]] = pkfield.to_python(rec["id"])
+            except ValidationError:
+                pass
+        objects = cls.model.objects.using(request.database).in_bulk(
+            list(keys.values())
+        )
+
+        # Validate the changes
+        forms = {}
+        changed = []
+        for rec in recs:
+            pk = rec.pop("id")
+            obj = objects.get(keys.get(pk))
+            if obj is None:
+                ok = False
+                resp.write(escape(_("Can't find %s" % pk)))
+                resp.write("<br>")
+                continue
+            form = None
+            try:
+                fields = tuple(rec.keys())
+                if fields not in forms:
+                    if hasattr(cls.model, "getModelForm"):
+                        forms[fields] = cls.model.getModelForm(
+                            fields, database=request.database
                         )
-                        del rec["id"]
-                        for i in rec:
-                            if (
-                                rec[i] == "\xa0"
-                            ):  # Workaround for Jqgrid issue: date field can't be set to blank
-                                rec[i] = None
-                        if hasattr(cls.model, "getModelForm"):
-                            UploadForm = cls.model.getModelForm(
-                                tuple(rec.keys()), database=request.database
+                    else:
+                        forms[fields] = modelform_factory(
+                            cls.model,
+                            fields=fields,
+                            formfield_callback=lambda f: (
+                                isinstance(f, RelatedField)
+                                and f.formfield(using=request.database)
                             )
-                        else:
-                            UploadForm = modelform_factory(
-                                cls.model,
-                                fields=tuple(rec.keys()),
-                                formfield_callback=lambda f: (
-                                    isinstance(f, RelatedField)
-                                    and f.formfield(using=request.database)
+                            or f.formfield(),
+                        )
+                form = forms[fields](rec, instance=obj)
+                if form.has_changed():
+                    changed.append((form.save(commit=False), form.changed_data))
+            except (ValidationError, ValueError):
+                ok = False
+                if form:
+                    for error in form.non_field_errors():
+                        resp.write(escape("%s: %s" % (pk, error)))
+                        resp.write("<br>")
+                    for field in form:
+                        for error in field.errors:
+                            resp.write(
+                                escape(
+                                    "%s %s: %s: %s"
+                                    % (obj.pk, field.name, rec[field.name], error)
                                 )
-                                or f.formfield(),
                             )
-                        form = UploadForm(rec, instance=obj)
-                        if form.has_changed():
-                            obj = form.save(commit=False)
-                            obj.save(using=request.database)
-                            Comment(
-                                user_id=request.user.pk,
-                                content_type_id=content_type_id,
-                                object_pk=obj.pk,
-                                object_repr=force_str(obj),
-                                type="change",
-                                comment="Changed %s."
-                                % get_text_list(form.changed_data, "and"),
-                            ).save(using=request.database)
-                        transaction.savepoint_commit(sid)
-                    except cls.model.DoesNotExist:
-                        transaction.savepoint_rollback(sid)
-                        ok = False
-                        resp.write(escape(_("Can't find %s" % pk)))
-                        resp.write("<br>")
-                    except (ValidationError, ValueError):
-                        transaction.savepoint_rollback(sid)
-                        ok = False
-                        for error in form.non_field_errors():
-                            resp.write(escape("%s: %s" % (pk, error)))
                             resp.write("<br>")
-                        for field in form:
-                            for error in field.errors:
-                                resp.write(
-                                    escape(
-                                        "%s %s: %s: %s"
-                                        % (obj.pk, field.name, rec[field.name], error)
-                                    )
-                                )
-                                resp.write("<br>")
-                    except Exception as e:
-                        transaction.savepoint_rollback(sid)
-                        ok = False
-                        resp.write(escape(e))
-                        resp.write("<br>")
-        if ok:
-            resp.write("OK")
-        resp.status_code = ok and 200 or 500
-        return resp
+            except Exception as e:
+                ok = False
+                resp.write(escape(e))
+                resp.write("<br>")
+
+        # Bulk updates bypass the save method and the signals
+        saved = []
+        pending = []
+        if (
+            cls.model.save in (models.Model.save, AuditModel.save)
+            and not signals.pre_save.has_listeners(cls.model)
+            and not signals.post_save.has_listeners(cls.model)
+        ):
+            groups = {}
+            for obj, fields in changed:
+                if pkfield.name in fields:
+                    # Changing the primary key creates a new record
+                    pending.append((obj, fields))
+                else:
+                    groups.setdefault(tuple(fields), []).append((obj, fields))
+            sid = transaction.savepoint(using=request.database)
+            try:
+                now = datetime.now()
+                for fields, objs in groups.items():
+                    if issubclass(cls.model, AuditModel):
+                        for obj, f in objs:
+                            obj.lastmodified = now
+                        fields += ("lastmodified",)
+                    cls.model.objects.using(request.database).bulk_update(
+                        [obj for obj, f in objs], fields, batch_size=1000
+                    )
+                    saved.extend(objs)
+                transaction.savepoint_commit(sid)
+            except Exception:
+                # Retry one by one, to find the faulty records
+                transaction.savepoint_rollback(sid)
+                pending = changed
+                saved = []
+        else:
+            pending = changed
+        for obj, fields in pending:
+            sid = transaction.savepoint(using=request.database)
+            try:
+                obj.save(using=request.database)
+                transaction.savepoint_commit(sid)
+                saved.append((obj, fields))
+            except Exception as e:
+                transaction.savepoint_rollback(sid)
+                ok = False
+                resp.write(escape(e))
+                resp.write("<br>")
+
+        # Log the changes
+        Comment.bulkCreate(
+            [
+                Comment(
+                    user_id=request.user.pk,
+                    content_type_id=content_type_id,
+                    object_pk=obj.pk,
+                    object_repr=force_str(obj)[:200],
+                    type="change",
+                    comment="Changed %s." % get_text_list(fields, "and"),
+                )
+                for obj, fields in saved
+            ],
+            database=request.database,
+        )
+        return ok
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def getModelGraph():
+        """
+        Returns a dictionary with, for every model, a tuple of the models directly
+        referring to it. Every entry is a pair of a referring model and its
+        subclasses.
+        The model relations don't change at runtime, so the graph is built only
+        once. The application configuration already builds it at startup.
+        """
+        graph = {}
+        for m in apps.get_models(include_auto_created=True):
+            graph[m] = tuple(
+                (f.related_model, tuple(f.related_model.__subclasses__()))
+                for f in m._meta.get_fields()
+                if f.is_relation and f.auto_created and f.related_model != m
+            )
+        return graph
 
     @staticmethod
     def dependent_models(m, found):
         """ An auxilary method that constructs a set of all dependent models"""
-        for f in m._meta.get_fields():
-            if (
-                f.is_relation
-                and f.auto_created
-                and f.related_model != m
-                and f.related_model not in found
-            ):
-                for sub in f.related_model.__subclasses__():
-                    # if sub not in found:
-                    found.update([sub])
-                found.update([f.related_model])
-                GridReport.dependent_models(f.related_model, found)
+        found.update(GridReport.getDependentModels(m))
 
     @staticmethod
-    def sort_models(models):
+    @functools.lru_cache(maxsize=None)
+    def getDependentModels(m):
+        """
+        Returns a frozenset with a model and all models depending on it.
+        The model relations don't change at runtime, so the result is cached.
+        """
+        graph = GridReport.getModelGraph()
+        found = set([m])
+        todo = [m]
+        while todo:
+            for dep, subclasses in graph.get(todo.pop(), ()):
+                if dep not in found:
+                    found.update(subclasses)
+                    found.add(dep)
+                    todo.append(dep)
+        return frozenset(found)
+
+    @staticmethod
+    def _concreteBase(model):
+        base = model.__base__
+        return None if base == Model or base._meta.abstract else base
+
+    @staticmethod
+    def _dependencyGraph(models):
+        """
+        Returns, for every entry in a list of tuples (name, model, content type id,
+        dependent models), the set of entries it depends on, and the set of
+        entries it shares a table with.
+        Models inheriting from each other, or from the same concrete model, share a
+        table and are not ordered on their dependencies.
+        """
         # Inject additional dependencies that are not reflected in database constraints
+        deps = [set(m[3]) for m in models]
         for m in models:
             for e in getattr(m[1], "extra_dependencies", []):
-                for m2 in models:
+                for idx, m2 in enumerate(models):
                     if m2[1] == e:
-                        m2[3].update([m[1]])
+                        deps[idx].add(m[1])
 
-        # Sort the list of models, based on dependencies between models
-        models.sort(key=lambda m: (m[1].__name__, m[0].upper()))
         cnt = len(models)
-        ok = False
-        while not ok:
-            ok = True
-            for i in range(cnt):
-                j = i + 1
-                while j < cnt and ok:
-                    if models[i][1] != models[j][1] and models[i][1] in models[j][3]:
-                        i_base = models[i][1].__base__
-                        if i_base == Model or i_base._meta.abstract:
-                            i_base = None
-                        j_base = models[j][1].__base__
-                        if j_base == Model or j_base._meta.abstract:
-                            j_base = None
-                        if i_base == j_base and i_base and j_base:
-                            j += 1
-                            continue
-                        if i_base == models[j][1] or j_base == models[i][1]:
-                            j += 1
-                            continue
-                        models.append(models.pop(i))
-                        while j < cnt:
-                            if models[i][1] == models[j][1]:
-                                models.append(models.pop(j))
-                            j += 1
-                        ok = False
-                        break
-                    elif (
-                        models[i][1] == models[j][1]
-                        and models[i][0].upper() > models[j][0].upper()
-                    ):
-                        models[i], models[j] = models[j], models[i]
-                        ok = False
-                    j += 1
-        return models
+        bases = [GridReport._concreteBase(m[1]) for m in models]
+        predecessors = [set() for m in models]
+        shared = [set() for m in models]
+        for i in range(cnt):
+            for j in range(cnt):
+                if i == j:
+                    continue
+                if (
+                    models[i][1] == models[j][1]
+                    or (bases[i] and bases[i] == bases[j])
+                    or bases[i] == models[j][1]
+                    or bases[j] == models[i][1]
+                ):
+                    shared[i].add(j)
+                elif models[i][1] in deps[j]:
+                    predecessors[i].add(j)
+        return predecessors, shared
+
+    @staticmethod
+    def sort_models(models):
+        """
+        Sorts a list of tuples (name, model, content type id, dependent models)
+        such that every model comes after the models it depends on.
+        Independent models are sorted on their class name and their name.
+        Models with circular dependencies are logged, and appended at the end.
+        """
+        predecessors, shared = GridReport._dependencyGraph(models)
+        cnt = len(models)
+        successors = [[] for m in models]
+        incoming = [len(p) for p in predecessors]
+        for i in range(cnt):
+            for j in predecessors[i]:
+                successors[j].append(i)
+
+        # Topological sort
+        def key(i):
+            return (models[i][1].__name__, models[i][0].upper(), i)
+
+        ready = [key(i) for i in range(cnt) if not incoming[i]]
+        heapq.heapify(ready)
+        result = []
+        while ready:
+            i = heapq.heappop(ready)[2]
+            result.append(i)
+            for s in successors[i]:
+                incoming[s] -= 1
+                if not incoming[s]:
+                    heapq.heappush(ready, key(s))
+        if len(result) < cnt:
+            cycle = sorted((i for i in range(cnt) if incoming[i]), key=key)
+            logger.warning(
+                "Can't order models with circular dependencies: %s"
+                % ", ".join(models[i][0] for i in cycle)
+            )
+            result.extend(cycle)
+        return [models[i] for i in result]
+
+    @staticmethod
+    def group_models(models):
+        """
+        Sorts a list of tuples (name, model, content type id, dependent models)
+        and groups them in waves.
+        A model only depends on models in earlier waves, and the models in a wave
+        don't share any table. All models in a wave can thus be loaded in
+        parallel.
+        """
+        models = GridReport.sort_models(models)
+        predecessors, shared = GridReport._dependencyGraph(models)
+        waves = []
+        level = []
+        for i in range(len(models)):
+            # Models in a cycle depend on a model further in the list: we only look
+            # at the previous ones to keep them in sequence.
+            lvl = max(
+                (
+                    level[j] + 1
+                    for j in range(i)
+                    if j in predecessors[i] or j in shared[i]
+                ),
+                default=0,
+            )
+            level.append(lvl)
+            if lvl == len(waves):
+                waves.append([])
+            waves[lvl].append(models[i])
+        return waves
 
     @classmethod
     def erase(cls, request):
         # Build a list of dependencies
-        deps = set([cls.model])
         # Special case for MO/PO/DO/DLVR that cannot be truncated
         if cls.model.__name__ not in (
             "PurchaseOrder",
@@ -2052,7 +2246,9 @@ class GridReport(View):
             "DistributionOrder",
             "DeliveryOrder",
         ):
-            GridReport.dependent_models(cls.model, deps)
+            deps = GridReport.getDependentModels(cls.model)
+        else:
+            deps = frozenset([cls.model])
 
         # Check the delete permissions for all related objects
         for m in deps:
@@ -2063,26 +2259,35 @@ class GridReport(View):
                 )
 
         # Delete the data records
-        cursor = connections[request.database].cursor()
         with transaction.atomic(using=request.database):
-
-            sql_list = []
-            containsOperationPlan = any(m.__name__ == "OperationPlan" for m in deps)
-            for m in deps:
-                if "getDeleteStatements" in dir(m) and not containsOperationPlan:
-                    sql_list.extend(m.getDeleteStatements())
+            with connections[request.database].cursor() as cursor:
+                containsOperationPlan = any(m.__name__ == "OperationPlan" for m in deps)
+                if not containsOperationPlan and all(
+                    "getDeleteStatements" in dir(m) for m in deps
+                ):
+                    for m in deps:
+                        for sql in m.getDeleteStatements():
+                            cursor.execute(sql)
                 else:
-                    sql_list = connections[request.database].ops.sql_flush(
-                        no_style(), [m._meta.db_table for m in deps], []
+                    # A single statement truncates all tables at once
+                    cursor.execute(
+                        "truncate table %s restart identity"
+                        % ",".join(
+                            connections[request.database].ops.quote_name(
+                                m._meta.db_table
+                            )
+                            for m in deps
+                        )
                     )
-            for sql in sql_list:
-                cursor.execute(sql)
+            TablePresence.invalidate(request.database)
             # Erase comments and history
-            content_ids = [
-                ContentType.objects.get_for_model(m, for_concrete_model=False)
-                for m in deps
-            ]
-            Comment.objects.filter(content_type__in=content_ids).delete()
+            Comment.erase(
+                [
+                    ContentType.objects.get_for_model(m, for_concrete_model=False).pk
+                    for m in deps
+                ],
+                database=request.database,
+            )
             # Prepare message
             for m in deps:
                 messages.add_message(
@@ -2903,49 +3108,59 @@ class GridPivot(GridReport):
         yield '"rows":[\n'
 
         # Generate output
-        currentkey = None
-        r = []
+        first = True
         fields = [i.field_name for i in request.rows if i.field_name]
-        for i in cls.data_query(request, *args, page=page, fields=fields, **kwargs):
-            # We use the first field in the output to recognize new rows.
-            if currentkey != i[request.rows[0].name]:
-                # New line
-                if currentkey:
-                    yield "".join(r)
-                    r = ["},\n{"]
-                else:
-                    r = ["{"]
-                currentkey = i[request.rows[0].name]
-                first2 = True
-                for f in request.rows:
-                    try:
-                        s = cls._getJSONValue(i[f.name], field=f, request=request)
-                        if first2:
-                            r.append('"%s":%s' % (f.name, s))
-                            first2 = False
-                        elif i[f.name] is not None:
-                            r.append(', "%s":%s' % (f.name, s))
-                    except Exception:
-                        pass
-            r.append(', "%s":[' % i["bucket"])
+        for i, buckets, block in cls._pivot(
+            request,
+            cls.data_query(request, *args, page=page, fields=fields, **kwargs),
+            request.crosses,
+        ):
+            r = ["{" if first else ",\n{"]
+            first = False
             first2 = True
-            for f in request.crosses:
-                if i[f[0]] is None:
-                    if first2:
-                        r.append("null")
-                        first2 = False
-                    else:
-                        r.append(",null")
-                else:
+            for f in request.rows:
+                try:
+                    s = cls._getJSONValue(i[f.name], field=f, request=request)
                     if first2:
-                        r.append("%s" % i[f[0]])
+                        r.append('"%s":%s' % (f.name, s))
                         first2 = False
-                    else:
-                        r.append(",%s" % i[f[0]])
-            r.append("]")
-        r.append("}")
-        r.append("\n]}\n")
-        yield "".join(r)
+                    elif i[f.name] is not None:
+                        r.append(', "%s":%s' % (f.name, s))
+                except Exception:
+                    pass
+            r.extend(
+                ', "%s":[%s]'
+                % (b, ",".join("null" if v is None else str(v) for v in values))
+                for b, values in zip(
+                    buckets, zip(*block) if block else itertools.repeat(())
+                )
+            )
+            r.append("}")
+            yield "".join(r)
+        yield "\n]}\n"
+
+    @classmethod
+    def _pivot(cls, request, query, crosses):
+        """
+        Reshapes the query results, which have a row per entity and bucket, into
+        a block per entity.
+        Yields for each entity its first row, the list of bucket names and a list
+        with the values of each cross across all buckets.
+        We use the first field in the output to recognize new entities.
+        """
+        getbucket = operator.itemgetter("bucket")
+        getcrosses = operator.itemgetter(*[c[0] for c in crosses]) if crosses else None
+        for key, rows in itertools.groupby(
+            query, operator.itemgetter(request.rows[0].name)
+        ):
+            rows = list(rows)
+            if not getcrosses:
+                block = []
+            elif len(crosses) == 1:
+                block = [list(map(getcrosses, rows))]
+            else:
+                block = [list(c) for c in zip(*map(getcrosses, rows))]
+            yield rows[0], list(map(getbucket, rows)), block
 
     @classmethod
     def _generate_csv_data(cls, request, scenario_list, *args, **kwargs):
@@ -3046,6 +3261,26 @@ class GridPivot(GridReport):
         writer.writerow(fields)
         yield sf.getvalue()
 
+        # Titles of the crosses in the pivot layout
+        crosstitles = [
+            force_str(
+                capfirst(
+                    _(
+                        (
+                            cross[1]["title"](request)
+                            if callable(cross[1]["title"])
+                            else cross[1]["title"]
+                        )
+                        if "title" in cross[1]
+                        else cross[0]
+                    )
+                ),
+                encoding=settings.CSV_CHARSET,
+                errors="ignore",
+            )
+            for cross in mycrosses
+        ]
+
         # Write the report content
         orginal_database = request.database
         try:
@@ -3131,123 +3366,39 @@ class GridPivot(GridReport):
                         writer.writerow(fields)
                         yield sf.getvalue()
                 else:
-                    currentkey = None
-                    row_of_buckets = None
-                    for row in query:
-                        # We use the first field in the output to recognize new rows.
-                        if not currentkey:
-                            currentkey = row[request.rows[0].name]
-                            row_of_buckets = [row]
-                        elif currentkey == row[request.rows[0].name]:
-                            row_of_buckets.append(row)
-                        else:
-                            # Write an entity
-                            for cross in mycrosses:
-                                # Clear the return string buffer
-                                sf.seek(0)
-                                sf.truncate(0)
-                                fields = [
-                                    cls._getCSVValue(
-                                        row_of_buckets[0][s.name],
-                                        field=s,
-                                        request=request,
-                                        decimal_separator=decimal_separator,
-                                    )
-                                    for s in myrows
-                                    if s.name
-                                ]
-                                fields.extend(
-                                    [
-                                        force_str(
-                                            capfirst(
-                                                _(
-                                                    (
-                                                        cross[1]["title"](request)
-                                                        if callable(cross[1]["title"])
-                                                        else cross[1]["title"]
-                                                    )
-                                                    if "title" in cross[1]
-                                                    else cross[0]
-                                                )
-                                            ),
-                                            encoding=settings.CSV_CHARSET,
-                                            errors="ignore",
-                                        )
-                                    ]
-                                )
-                                fields.extend(
-                                    [
-                                        force_str(
-                                            cls._localize(
-                                                bucket[cross[0]], decimal_separator
-                                            ),
-                                            encoding=settings.CSV_CHARSET,
-                                            errors="ignore",
-                                        )
-                                        if bucket[cross[0]] is not None
-                                        else ""
-                                        for bucket in row_of_buckets
-                                    ]
-                                )
-                                # Return string
-                                if len(scenario_list) > 1:
-                                    fields.insert(0, scenario)
-                                writer.writerow(fields)
-                                yield sf.getvalue()
-                            currentkey = row[request.rows[0].name]
-                            row_of_buckets = [row]
-                    # Write the last entity
-                    if row_of_buckets:
-                        for cross in mycrosses:
-                            # Clear the return string buffer
-                            sf.seek(0)
-                            sf.truncate(0)
-                            fields = [
-                                cls._getCSVValue(
-                                    row_of_buckets[0][s.name],
-                                    field=s,
-                                    request=request,
-                                    decimal_separator=decimal_separator,
-                                )
-                                for s in myrows
-                                if s.name
-                            ]
-                            fields.extend(
-                                [
-                                    force_str(
-                                        capfirst(
-                                            _(
-                                                (
-                                                    cross[1]["title"](request)
-                                                    if callable(cross[1]["title"])
-                                                    else cross[1]["title"]
-                                                )
-                                                if "title" in cross[1]
-                                                else cross[0]
-                                            )
-                                        ),
-                                        encoding=settings.CSV_CHARSET,
-                                        errors="ignore",
-                                    )
-                                ]
+                    for first, buckets, block in cls._pivot(request, query, mycrosses):
+                        # Clear the return string buffer
+                        sf.seek(0)
+                        sf.truncate(0)
+                        entity = [
+                            cls._getCSVValue(
+                                first[s.name],
+                                field=s,
+                                request=request,
+                                decimal_separator=decimal_separator,
                             )
+                            for s in myrows
+                            if s.name
+                        ]
+                        if len(scenario_list) > 1:
+                            entity.insert(0, scenario)
+                        # Write an entity
+                        for title, values in zip(crosstitles, block):
+                            fields = entity + [title]
                             fields.extend(
                                 [
                                     force_str(
-                                        cls._localize(
-                                            bucket[cross[0]], decimal_separator
-                                        ),
+                                        cls._localize(v, decimal_separator),
                                         encoding=settings.CSV_CHARSET,
                                         errors="ignore",
                                     )
-                                    for bucket in row_of_buckets
+                                    if v is not None
+                                    else ""
+                                    for v in values
                                 ]
                             )
-                            # Return string
-                            if len(scenario_list) > 1:
-                                fields.insert(0, scenario)
                             writer.writerow(fields)
-                            yield sf.getvalue()
+                        yield sf.getvalue()
         finally:
             request.database = orginal_database
 
@@ -3410,6 +3561,20 @@ class GridPivot(GridReport):
         # Add an auto-filter to the table
         ws.auto_filter.ref = "A1:%s1048576" % get_column_letter(len(fields))
 
+        # Titles of the crosses in the pivot layout
+        crosstitles = [
+            _getCellValue(
+                capfirst(
+                    cross[1]["title"](request)
+                    if callable(cross[1]["title"])
+                    else cross[1]["title"]
+                )
+                if "title" in cross[1]
+                else capfirst(cross[0])
+            )
+            for cross in mycrosses
+        ]
+
         # Write the report content
         original_database = request.database
         try:
@@ -3444,90 +3609,20 @@ class GridPivot(GridReport):
                             fields.insert(0, scenario)
                         ws.append(fields)
                 else:
-                    currentkey = None
-                    row_of_buckets = None
-                    for row in query:
-                        # We use the first field in the output to recognize new rows.
-                        if not currentkey:
-                            currentkey = row[request.rows[0].name]
-                            row_of_buckets = [row]
-                        elif currentkey == row[request.rows[0].name]:
-                            row_of_buckets.append(row)
-                        else:
-                            # Write a row
-                            for cross in mycrosses:
-                                if not cross[1].get("visible", True):
-                                    continue
-                                fields = [
-                                    _getCellValue(
-                                        row_of_buckets[0][s.name],
-                                        field=s,
-                                        request=request,
-                                    )
-                                    for s in myrows
-                                    if s.name
-                                ]
-                                fields.extend(
-                                    [
-                                        _getCellValue(
-                                            (
-                                                capfirst(
-                                                    cross[1]["title"](request)
-                                                    if callable(cross[1]["title"])
-                                                    else cross[1]["title"]
-                                                )
-                                            )
-                                            if "title" in cross[1]
-                                            else capfirst(cross[0])
-                                        )
-                                    ]
-                                )
-                                fields.extend(
-                                    [
-                                        _getCellValue(bucket[cross[0]])
-                                        for bucket in row_of_buckets
-                                    ]
-                                )
-                                if len(scenario_list) > 1:
-                                    fields.insert(0, scenario)
-                                ws.append(fields)
-                            currentkey = row[request.rows[0].name]
-                            row_of_buckets = [row]
-                    # Write the last row
-                    if row_of_buckets:
-                        for cross in mycrosses:
+                    for first, buckets, block in cls._pivot(request, query, mycrosses):
+                        entity = [
+                            _getCellValue(first[s.name], field=s, request=request)
+                            for s in myrows
+                            if s.name
+                        ]
+                        if len(scenario_list) > 1:
+                            entity.insert(0, scenario)
+                        # Write an entity
+                        for cross, title, values in zip(mycrosses, crosstitles, block):
                             if not cross[1].get("visible", True):
                                 continue
-                            fields = [
-                                _getCellValue(
-                                    row_of_buckets[0][s.name], field=s, request=request
-                                )
-                                for s in myrows
-                                if s.name
-                            ]
-                            fields.extend(
-                                [
-                                    _getCellValue(
-                                        (
-                                            capfirst(
-                                                cross[1]["title"](request)
-                                                if callable(cross[1]["title"])
-                                                else cross[1]["title"]
-                                            )
-                                        )
-                                        if "title" in cross[1]
-                                        else capfirst(cross[0])
-                                    )
-                                ]
-                            )
-                            fields.extend(
-                                [
-                                    _getCellValue(bucket[cross[0]])
-                                    for bucket in row_of_buckets
-                                ]
-                            )
-                            if len(scenario_list) > 1:
-                                fields.insert(0, scenario)
+                            fields = entity + [title]
+                            fields.extend([_getCellValue(v) for v in values])
                             ws.append(fields)
         finally:
             request.database = original_database
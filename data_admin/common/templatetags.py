@@ -2,12 +2,13 @@ from datetime import time
 from decimal import Decimal
 import json
 from pathlib import Path
+from time import monotonic
 
 from django.apps import apps
 from django.contrib.admin.utils import unquote, quote
 from django.template import Library, Node, Variable, TemplateSyntaxError
 from django.conf import settings
-from django.db import models, connections
+from django.db import models
 from django.utils.translation import gettext as _
 from django.utils.http import urlquote
 from django.utils.encoding import iri_to_uri, force_text
@@ -15,7 +16,8 @@ from django.utils.html import escape
 from django.utils.safestring import mark_safe
 from django.utils.text import capfirst
 
-from .models import User, NotificationFactory
+from .auth import MultiDBBackend
+from .models import User, NotificationFactory, TablePresence
 from .. import __version__
 
 MAX_CRUMBS = 10
@@ -473,8 +475,21 @@ register.filter(admin_quote)
 class MenuNode(Node):
     r"""
     A tag to return HTML code for the menu.
+
+    The menu of a user is cached, unless it contains menu items with a callback
+    function or dependency functions. The cache key includes the permission
+    version and the table presence version of the scenario, so the menu is
+    computed again when permissions or the non-empty tables change. Those
+    versions only change in the web server process making the change: other
+    processes recompute the menu after PERMISSION_CACHE_TIMEOUT seconds.
     """
 
+    # Cache of computed menus
+    _cache = {}
+
+    # Maximum number of menus in the cache
+    maxcache = 1000
+
     def __init__(self, varname):
         self.varname = varname
 
@@ -485,30 +500,32 @@ class MenuNode(Node):
             req = context["request"]
         except Exception:
             return ""  # No request found in the context
-        o = []
 
         # Find all tables with data
-        with connections[req.database].cursor() as cursor:
-            cursor.execute(
-                """
-                select table_name from (
-                  select table_name,
-                    query_to_xml(
-                      format('select 1 as cnt from %I.%I limit 1', table_schema, table_name),
-                      false, true, ''
-                      ) as xml_count
-                  from information_schema.tables
-                  where table_schema = 'public' and table_type = 'BASE TABLE'
-                  ) s
-                where xml_count is document
-                """
-            )
-            present = set([i[0] for i in cursor])
+        version, present = TablePresence.get(req.database)
+
+        # Look up the menu in the cache
+        key = (
+            req.database,
+            req.LANGUAGE_CODE,
+            req.user.pk,
+            req.user.is_superuser,
+            MultiDBBackend.getPermissionVersion(req.database),
+            version,
+        )
+        o = MenuNode._cache.get(key, None)
+        if o is not None and o[0] > monotonic():
+            context[self.varname] = o[1]
+            return ""
+        o = []
+        dynamic = False
 
         def generator(i):
+            nonlocal dynamic
             for j in i[1]:
                 if callable(j[2].callback):
                     # Dynamic definition of menu items with a callback function
+                    dynamic = True
                     for x in j[2].callback(req):
                         yield x
                 else:
@@ -525,6 +542,7 @@ class MenuNode(Node):
                     if j[2].dependencies:
                         for dep in j[2].dependencies:
                             if not isinstance(dep, type) and callable(dep):
+                                dynamic = True
                                 ok = dep(req)
                                 if not ok:
                                     break
@@ -554,6 +572,13 @@ class MenuNode(Node):
             if not empty:
                 # At least one item of the group is visible
                 o.append(group)
+        if not dynamic:
+            if len(MenuNode._cache) >= self.maxcache:
+                MenuNode._cache.clear()
+            MenuNode._cache[key] = (
+                monotonic() + getattr(settings, "PERMISSION_CACHE_TIMEOUT", 60),
+                o,
+            )
         context[self.varname] = o
         return ""
 
@@ -640,8 +665,17 @@ register.tag("getModelDependencies", getModelDependencies)
 class DashboardNode(Node):
     r"""
     A tag to return HTML code for the dashboard.
+
+    The widgets a user has access to are cached per permission version, for at
+    most PERMISSION_CACHE_TIMEOUT seconds.
     """
 
+    # Cache of the permitted widgets
+    _cache = {}
+
+    # Maximum number of entries in the cache
+    maxcache = 1000
+
     def __init__(self, varname, hiddenvarname):
         self.varname = varname
         self.hiddenvarname = hiddenvarname
@@ -654,6 +688,25 @@ class DashboardNode(Node):
         except Exception:
             return ""  # No request found in the context
         reg = Dashboard.buildList()
+        key = (
+            req.database,
+            req.user.pk,
+            req.user.is_superuser,
+            MultiDBBackend.getPermissionVersion(req.database),
+        )
+        permitted = DashboardNode._cache.get(key, None)
+        if permitted is not None and permitted[0] > monotonic():
+            permitted = permitted[1]
+        else:
+            permitted = frozenset(
+                i for i, j in reg.items() if j.has_permission(req.user)
+            )
+            if len(DashboardNode._cache) >= self.maxcache:
+                DashboardNode._cache.clear()
+            DashboardNode._cache[key] = (
+                monotonic() + getattr(settings, "PERMISSION_CACHE_TIMEOUT", 60),
+                permitted,
+            )
         mydashboard = req.user.getPreference(
             "data_admin.common.cockpit", database=req.database
         )
@@ -666,7 +719,7 @@ class DashboardNode(Node):
             for j in i["cols"]:
                 widgets = []
                 for k in j["widgets"]:
-                    if k[0] in reg and reg[k[0]].has_permission(req.user):
+                    if k[0] in permitted:
                         widgets.append(reg[k[0]](**k[1]))
                         context[self.hiddenvarname].pop(k[0], None)
                 cols.append({"width": j["width"], "widgets": widgets})
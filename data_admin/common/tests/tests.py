@@ -1,7 +1,21 @@
+import csv
+from datetime import date, datetime, timedelta
+from email.mime.base import MIMEBase
+from email.mime.text import MIMEText
+from io import BytesIO
+from types import SimpleNamespace
+
+from django.core import mail
 from django.http.response import StreamingHttpResponse
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase, override_settings
+from openpyxl import load_workbook
 
-from ..models import User
+from ...execute.management.commands.createbuckets import (
+    Command as CreateBucketsCommand,
+)
+from ...execute.models import Task
+from ..models import MailQueue, User
+from ..report import GridFieldText, GridPivot, GridReport
 
 
 def checkResponse(testcase, response):
@@ -34,3 +48,423 @@ class UserPreferenceTest(TestCase):
         user.setPreference("test", {"a": 1, "b": "c"})
         after = user.getPreference("test")
         self.assertEqual(after, {"a": 1, "b": "c"})
+
+
+class MailQueueTest(TestCase):
+    def test_queue_and_flush(self):
+        email = mail.EmailMessage("subject", "body", to=["user@domain.com"])
+        email.attach("test.txt", "content", "text/plain")
+        MailQueue.enqueue(email)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(MailQueue.flush(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["user@domain.com"])
+        self.assertEqual(mail.outbox[0].attachments[0][0], "test.txt")
+        self.assertFalse(MailQueue.objects.all().exists())
+
+    def test_attachments(self):
+        email = mail.EmailMessage("subject", "body", to=["user@domain.com"])
+        email.attach("test.txt", "content", "text/plain")
+        email.attach("test.bin", b"\x00\x01", "application/octet-stream")
+        email.attach(MIMEText("mime content"))
+        MailQueue.enqueue(email)
+        self.assertEqual(MailQueue.flush(), 1)
+        attachments = mail.outbox[0].attachments
+        self.assertEqual(len(attachments), 3)
+        self.assertEqual(attachments[0][:2], ("test.txt", "content"))
+        self.assertEqual(attachments[1][:2], ("test.bin", b"\x00\x01"))
+        self.assertIsInstance(attachments[2], MIMEBase)
+        self.assertEqual(attachments[2].get_payload(), "mime content")
+
+    def test_retry(self):
+        MailQueue.enqueue(mail.EmailMessage("subject", "body", to=["user@domain.com"]))
+        self.assertEqual(MailQueue.flush(connection=FailingConnection()), 0)
+        m = MailQueue.objects.get()
+        self.assertEqual(m.status, "Q")
+        self.assertEqual(m.attempts, 1)
+        self.assertEqual(m.message, "SMTP failure")
+        self.assertGreater(m.next_attempt, datetime.now())
+        # The retry isn't due yet
+        self.assertEqual(MailQueue.flush(), 0)
+        MailQueue.objects.update(next_attempt=datetime.now())
+        self.assertEqual(MailQueue.flush(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(MailQueue.pending())
+
+    @override_settings(MAIL_RETRIES=2)
+    def test_failure(self):
+        task = Task(name="emailreport", submitted=datetime.now(), status="Done")
+        task.save()
+        email = mail.EmailMessage("subject", "body", to=["user@domain.com"])
+        MailQueue.enqueue(email, task=task.id)
+        for i in range(2):
+            MailQueue.objects.update(next_attempt=datetime.now())
+            self.assertEqual(MailQueue.flush(connection=FailingConnection()), 0)
+        m = MailQueue.objects.get()
+        self.assertEqual(m.status, "F")
+        self.assertEqual(m.attempts, 2)
+        self.assertFalse(MailQueue.pending())
+        task.refresh_from_db()
+        self.assertEqual(task.status, "Failed")
+        self.assertIn("SMTP failure", task.message)
+        # Failed emails are purged after some days
+        MailQueue.objects.update(created=datetime.now() - timedelta(days=31))
+        MailQueue.flush()
+        self.assertFalse(MailQueue.objects.all().exists())
+
+    def test_send(self):
+        email = mail.EmailMessage("subject", "body", to=["user@domain.com"])
+        self.assertIsNone(MailQueue.send(email))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(MailQueue.objects.all().exists())
+
+
+class FailingConnection:
+    """
+    An email connection that can't deliver anything.
+    """
+
+    def send_messages(self, messages):
+        raise Exception("SMTP failure")
+
+    def close(self):
+        pass
+
+
+class AbstractModel:
+    _meta = SimpleNamespace(abstract=True)
+
+
+def fakeModel(name, base=AbstractModel):
+    return type(name, (base,), {"_meta": SimpleNamespace(abstract=False)})
+
+
+class SortModelsTest(SimpleTestCase):
+    def sort(self, dependencies):
+        # Dependencies map every model to the models that depend on it
+        return [
+            m[0]
+            for m in GridReport.sort_models(
+                [(m.__name__.lower(), m, None, deps) for m, deps in dependencies]
+            )
+        ]
+
+    def test_order(self):
+        item = fakeModel("Item")
+        location = fakeModel("Location")
+        buffer = fakeModel("Buffer")
+        demand = fakeModel("Demand")
+        self.assertEqual(
+            self.sort(
+                [
+                    (demand, []),
+                    (buffer, [demand]),
+                    (location, [buffer, demand]),
+                    (item, [buffer]),
+                ]
+            ),
+            ["item", "location", "buffer", "demand"],
+        )
+
+    def test_inheritance(self):
+        # A child model shares its table with its parent: they are not ordered
+        # on their dependencies, and don't form a cycle
+        operation = fakeModel("Operation")
+        routing = fakeModel("Routing", operation)
+        suboperation = fakeModel("SubOperation")
+        self.assertEqual(
+            self.sort(
+                [
+                    (suboperation, []),
+                    (routing, [suboperation, operation]),
+                    (operation, [suboperation, routing]),
+                ]
+            ),
+            ["operation", "routing", "suboperation"],
+        )
+
+    def test_cycle(self):
+        a = fakeModel("A")
+        b = fakeModel("B")
+        c = fakeModel("C")
+        d = fakeModel("D")
+        with self.assertLogs("data_admin.common.report", "WARNING"):
+            self.assertEqual(
+                self.sort([(a, [b]), (b, [a]), (c, [d]), (d, [])]),
+                ["c", "d", "a", "b"],
+            )
+
+    def test_waves(self):
+        # Models sharing a table are never loaded in the same wave
+        item = fakeModel("Item")
+        location = fakeModel("Location")
+        buffer = fakeModel("Buffer")
+        operation = fakeModel("Operation")
+        routing = fakeModel("Routing", operation)
+        waves = GridReport.group_models(
+            [
+                (m.__name__.lower(), m, None, deps)
+                for m, deps in [
+                    (buffer, []),
+                    (location, [buffer]),
+                    (item, [buffer]),
+                    (routing, []),
+                    (operation, []),
+                ]
+            ]
+        )
+        self.assertEqual(
+            [[m[0] for m in wave] for wave in waves],
+            [["item", "location", "operation"], ["buffer", "routing"]],
+        )
+
+
+class CreateBucketsTest(SimpleTestCase):
+    def baselineDates(self, command, curdate, enddate, weekstart, options):
+        # The original day by day loop of the createbuckets command
+        result = []
+        prev_year = prev_quarter = prev_month = prev_week = None
+        while curdate < enddate:
+            month = int(curdate.strftime("%m"))
+            quarter = (month - 1) // 3 + 1
+            year = int(curdate.strftime("%Y"))
+            dayofweek = int(curdate.strftime("%w"))
+            week_start = curdate - timedelta((dayofweek + 6) % 7 + 1 - weekstart)
+            week_end = curdate - timedelta((dayofweek + 6) % 7 - 6 - weekstart)
+            if year != prev_year:
+                prev_year = year
+                result.append(
+                    (
+                        "year",
+                        command.formatDate(curdate, options["format_year"]),
+                        datetime(year, 1, 1),
+                        datetime(year + 1, 1, 1),
+                    )
+                )
+            if quarter != prev_quarter:
+                prev_quarter = quarter
+                result.append(
+                    (
+                        "quarter",
+                        command.formatDate(curdate, options["format_quarter"]),
+                        date(year, quarter * 3 - 2, 1),
+                        date(
+                            year + quarter // 4,
+                            quarter * 3 + 1 - 12 * (quarter // 4),
+                            1,
+                        ),
+                    )
+                )
+            if month != prev_month:
+                prev_month = month
+                result.append(
+                    (
+                        "month",
+                        command.formatDate(curdate, options["format_month"]),
+                        date(year, month, 1),
+                        date(year + month // 12, month + 1 - 12 * (month // 12), 1),
+                    )
+                )
+            if week_start != prev_week:
+                prev_week = week_start
+                result.append(
+                    (
+                        "week",
+                        command.formatDate(
+                            week_start
+                            + timedelta(
+                                days=(
+                                    (10 if command.isoweeknumber else 7)
+                                    - week_start.weekday()
+                                )
+                                % 7
+                            ),
+                            options["format_week"],
+                        ),
+                        week_start,
+                        week_end,
+                    )
+                )
+            result.append(
+                (
+                    "day",
+                    command.formatDate(curdate.date(), options["format_day"]),
+                    curdate,
+                    curdate + timedelta(1),
+                )
+            )
+            curdate += timedelta(1)
+        return result
+
+    def normalize(self, dates):
+        return sorted(
+            (
+                bucket,
+                name,
+                datetime(start.year, start.month, start.day),
+                datetime(end.year, end.month, end.day),
+            )
+            for bucket, name, start, end in dates
+        )
+
+    def test_generate_dates(self):
+        horizons = [
+            ("2019-12-20", "2021-02-03"),
+            ("2020-03-29", "2020-07-02"),
+            ("2023-12-31", "2024-01-02"),
+            ("2021-01-01", "2022-01-01"),
+            ("2026-09-30", "2027-10-01"),
+        ]
+        for format_week in ("%y W%W", "%G W%V"):
+            options = {
+                "format_day": "%Y-%m-%d",
+                "format_week": format_week,
+                "format_month": "%b %y",
+                "format_quarter": "%y Q%q",
+                "format_year": "%Y",
+            }
+            command = CreateBucketsCommand()
+            command.isoweeknumber = "%V" in format_week
+            for weekstart in range(7):
+                for start, end in horizons:
+                    start = datetime.strptime(start, "%Y-%m-%d")
+                    end = datetime.strptime(end, "%Y-%m-%d")
+                    self.assertEqual(
+                        self.normalize(
+                            command.generateDates(start, end, weekstart, options)
+                        ),
+                        self.normalize(
+                            self.baselineDates(command, start, end, weekstart, options)
+                        ),
+                        "Mismatch for %s - %s, week start %s, format %s"
+                        % (start, end, weekstart, format_week),
+                    )
+
+
+class FakePivot(GridPivot):
+    title = "fake pivot"
+    rows = (GridFieldText("item", key=True), GridFieldText("location"))
+    crosses = (("demand", {"title": "demand"}), ("supply", {"title": "supply"}))
+    data = []
+
+    @classmethod
+    def getKey(cls, request, *args, **kwargs):
+        return "fakepivot"
+
+    @classmethod
+    def count_query(cls, request, *args, **kwargs):
+        return len({r["item"] for r in cls.data})
+
+    @classmethod
+    def data_query(cls, request, *args, **kwargs):
+        return iter(cls.data)
+
+
+class PivotOutputTest(SimpleTestCase):
+    data = [
+        {"item": "A", "location": "L", "bucket": "W1", "demand": 1, "supply": 3},
+        {"item": "A", "location": "L", "bucket": "W2", "demand": 2, "supply": 4},
+        {"item": "B", "location": "M", "bucket": "W1", "demand": 5, "supply": 6},
+        {"item": "B", "location": "M", "bucket": "W2", "demand": 7, "supply": 8},
+    ]
+
+    def tearDown(self):
+        FakePivot.data = []
+
+    def getRequest(self, fmt, crosses=FakePivot.crosses):
+        return SimpleNamespace(
+            GET={"format": fmt},
+            LANGUAGE_CODE="en",
+            database="default",
+            pagesize=100,
+            user=SimpleNamespace(getPreference=lambda *args, **kwargs: None),
+            rows=FakePivot.rows,
+            crosses=crosses,
+            report_bucketlist=[{"name": "W1"}, {"name": "W2"}],
+        )
+
+    def getJSON(self, crosses=FakePivot.crosses):
+        return "".join(
+            FakePivot._generate_json_data(self.getRequest("json", crosses))
+        )
+
+    def getCSV(self, crosses=FakePivot.crosses):
+        # Skip the byte order mark
+        output = list(
+            FakePivot._generate_csv_data(
+                self.getRequest("csvtable", crosses), ["default"]
+            )
+        )[1:]
+        return list(csv.reader("".join(output).splitlines()))
+
+    def getSpreadsheet(self, crosses=FakePivot.crosses):
+        output = BytesIO()
+        FakePivot._generate_spreadsheet_data(
+            self.getRequest("spreadsheettable", crosses), ["default"], output
+        )
+        output.seek(0)
+        ws = load_workbook(output, read_only=True).active
+        return [list(row) for row in ws.iter_rows(values_only=True)]
+
+    def test_empty(self):
+        self.assertEqual(
+            self.getJSON(), '{"total":0,\n"page":1,\n"records":0,\n"rows":[\n\n]}\n'
+        )
+        header = ["Item", "Location", "Data field", "W1", "W2"]
+        self.assertEqual(self.getCSV(), [header])
+        self.assertEqual(self.getSpreadsheet(), [header])
+
+    def test_single_cross(self):
+        FakePivot.data = self.data
+        crosses = FakePivot.crosses[:1]
+        self.assertEqual(
+            self.getJSON(crosses),
+            '{"total":1,\n"page":1,\n"records":2,\n"rows":[\n'
+            '{"item":"A", "location":"L", "W1":[1], "W2":[2]},\n'
+            '{"item":"B", "location":"M", "W1":[5], "W2":[7]}\n]}\n',
+        )
+        self.assertEqual(
+            self.getCSV(crosses),
+            [
+                ["Item", "Location", "Data field", "W1", "W2"],
+                ["A", "L", "Demand", "1", "2"],
+                ["B", "M", "Demand", "5", "7"],
+            ],
+        )
+        self.assertEqual(
+            self.getSpreadsheet(crosses),
+            [
+                ["Item", "Location", "Data field", "W1", "W2"],
+                ["A", "L", "Demand", 1, 2],
+                ["B", "M", "Demand", 5, 7],
+            ],
+        )
+
+    def test_crosses(self):
+        FakePivot.data = self.data
+        self.assertEqual(
+            self.getJSON(),
+            '{"total":1,\n"page":1,\n"records":2,\n"rows":[\n'
+            '{"item":"A", "location":"L", "W1":[1,3], "W2":[2,4]},\n'
+            '{"item":"B", "location":"M", "W1":[5,6], "W2":[7,8]}\n]}\n',
+        )
+        self.assertEqual(
+            self.getCSV(),
+            [
+                ["Item", "Location", "Data field", "W1", "W2"],
+                ["A", "L", "Demand", "1", "2"],
+                ["A", "L", "Supply", "3", "4"],
+                ["B", "M", "Demand", "5", "7"],
+                ["B", "M", "Supply", "6", "8"],
+            ],
+        )
+        self.assertEqual(
+            self.getSpreadsheet(),
+            [
+                ["Item", "Location", "Data field", "W1", "W2"],
+                ["A", "L", "Demand", 1, 2],
+                ["A", "L", "Supply", 3, 4],
+                ["B", "M", "Demand", 5, 7],
+                ["B", "M", "Supply", 6, 8],
+            ],
+        )
@@ -1,5 +1,7 @@
+import json
 import os
 import re
+import shutil
 import subprocess
 from datetime import datetime
 
@@ -10,6 +12,7 @@ from django.utils.translation import gettext_lazy as _
 from django.template.loader import render_to_string
 
 from ...models import Task
+from ...tablecopy import connect, getCounts, getTables
 from ....common.middleware import _thread_locals
 from ....common.models import User
 from .... import __version__
@@ -19,7 +22,11 @@ class Command(BaseCommand):
     help = """
       This command creates a database dump of the frePPLe database.
 
-      It also removes dumps older than a month to limit the disk space usage.
+      A manifest with the number of records of every table is saved next to
+      the dump.
+
+      It also removes dumps older than a month, and the oldest dumps exceeding
+      the disk space configured in the setting MAXTOTALBACKUPSIZE.
       If you want to keep dumps for a longer period of time, you'll need to
       copy the dumps to a different location.
 
@@ -44,6 +51,23 @@ class Command(BaseCommand):
             type=int,
             help="Task identifier (generated automatically if not provided)",
         )
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=1,
+            help="Number of parallel jobs, which creates the backup as a folder",
+        )
+        parser.add_argument(
+            "--compress",
+            default="auto",
+            help="Compression method for pg_dump, eg gzip, lz4 or zstd",
+        )
+        parser.add_argument(
+            "--verify",
+            action="store_true",
+            default=False,
+            help="Check that the backup can be read and lists the data of all tables",
+        )
 
     def handle(self, **options):
         # Pick up the options
@@ -85,55 +109,96 @@ class Command(BaseCommand):
             task.save(using=database)
 
             # Choose the backup file name
-            backupfile = now.strftime("database.%s.%%Y%%m%%d.%%H%%M%%S.dump" % database)
-
-            # Run the backup command
-            # Commenting the next line is a little more secure, but requires you to
-            # create a .pgpass file.
-            os.environ["PGPASSWORD"] = settings.DATABASES[database]["PASSWORD"]
-            args = [
-                "pg_dump",
-                "-Fc",
-                "-w",
-                "--username=%s" % settings.DATABASES[database]["USER"],
-                "--file=%s"
-                % os.path.abspath(os.path.join(settings.FREPPLE_LOGDIR, backupfile)),
-            ]
-            if settings.DATABASES[database]["HOST"]:
-                args.append("--host=%s" % settings.DATABASES[database]["HOST"])
-            if settings.DATABASES[database]["PORT"]:
-                args.append("--port=%s" % settings.DATABASES[database]["PORT"])
-            args.append(settings.DATABASES[database]["NAME"])
-            with subprocess.Popen(args) as p:
-                try:
-                    task.processid = p.pid
-                    task.save(using=database)
-                    p.wait()
-                except Exception:
-                    p.kill()
-                    p.wait()
-                    raise Exception("Run of run pg_dump failed")
+            jobs = options["jobs"]
+            backupfile = now.strftime(
+                # A backup with parallel jobs is a folder
+                "database.%s.%%Y%%m%%d.%%H%%M%%S%s"
+                % (database, "" if jobs > 1 else ".dump")
+            )
+            backuppath = os.path.abspath(
+                os.path.join(settings.FREPPLE_LOGDIR, backupfile)
+            )
+
+            # Export a snapshot, to dump the same data as the manifest describes
+            holder = connect(database)
+            try:
+                holder.set_session(isolation_level="REPEATABLE READ", readonly=True)
+                with holder.cursor() as cursor:
+                    cursor.execute("select pg_export_snapshot()")
+                    snapshot = cursor.fetchone()[0]
+
+                # Run the backup command
+                # Commenting the next line is a little more secure, but requires you to
+                # create a .pgpass file.
+                os.environ["PGPASSWORD"] = settings.DATABASES[database]["PASSWORD"]
+                args = [
+                    "pg_dump",
+                    "-Fd" if jobs > 1 else "-Fc",
+                    "-w",
+                    "--username=%s" % settings.DATABASES[database]["USER"],
+                    "--file=%s" % backuppath,
+                    "--snapshot=%s" % snapshot,
+                ]
+                if jobs > 1:
+                    args.append("--jobs=%s" % jobs)
+                if settings.DATABASES[database]["HOST"]:
+                    args.append("--host=%s" % settings.DATABASES[database]["HOST"])
+                if settings.DATABASES[database]["PORT"]:
+                    args.append("--port=%s" % settings.DATABASES[database]["PORT"])
+                args.append(settings.DATABASES[database]["NAME"])
+                compression = self.getCompression(options["compress"])
+                if compression:
+                    returncode, errors = self.dump(
+                        args[:-1] + ["--compress=%s" % compression, args[-1]],
+                        task,
+                        database,
+                    )
+                    if (
+                        returncode
+                        and options["compress"] == "auto"
+                        and compression in errors
+                    ):
+                        # This build of pg_dump doesn't support the compression
+                        self.removeBackup(backuppath)
+                        returncode, errors = self.dump(args, task, database)
+                else:
+                    returncode, errors = self.dump(args, task, database)
+                if returncode:
+                    raise Exception("Run of run pg_dump failed: %s" % errors.strip())
+                task.status = "50%"
+                task.save(using=database)
+
+                # Write a manifest with the number of records of every table
+                with holder.cursor() as cursor:
+                    manifest = {
+                        table: {"records": records}
+                        for table, records in getCounts(
+                            cursor, getTables(database)
+                        ).items()
+                    }
+            finally:
+                holder.close()
+            with open("%s.json" % backuppath, "w") as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+
+            # Verify the table of contents of the archive
+            if options["verify"]:
+                task.status = "90%"
+                task.save(using=database)
+                self.verify(backuppath, manifest)
 
             # Task update
-            task.logfile = backupfile
-            task.message = None
+            if jobs > 1:
+                # A backup folder can't be downloaded
+                task.message = "Backup saved in folder %s" % backupfile
+            else:
+                task.logfile = backupfile
+                task.message = None
             task.processid = None
             task.status = "99%"
             task.save(using=database)
 
-            # Delete backups older than a month
-            pattern = re.compile("database.*.*.*.dump")
-            for f in os.listdir(settings.FREPPLE_LOGDIR):
-                if os.path.isfile(os.path.join(settings.FREPPLE_LOGDIR, f)):
-                    # Note this is NOT 100% correct on UNIX. st_ctime is not alawys the creation date...
-                    created = datetime.fromtimestamp(
-                        os.stat(os.path.join(settings.FREPPLE_LOGDIR, f)).st_ctime
-                    )
-                    if pattern.match(f) and (now - created).days > 31:
-                        try:
-                            os.remove(os.path.join(settings.FREPPLE_LOGDIR, f))
-                        except Exception:
-                            pass
+            self.purge(now)
 
             # Task update
             task.status = "Done"
@@ -153,6 +218,121 @@ class Command(BaseCommand):
                 task.save(using=database)
             setattr(_thread_locals, "database", None)
 
+    @staticmethod
+    def dump(args, task, database):
+        """
+        Runs pg_dump, and returns its exit status and error output.
+        """
+        with subprocess.Popen(
+            args, stderr=subprocess.PIPE, universal_newlines=True
+        ) as p:
+            try:
+                task.processid = p.pid
+                task.save(using=database)
+                errors = p.communicate()[1]
+            except Exception:
+                p.kill()
+                p.wait()
+                raise Exception("Run of run pg_dump failed")
+        return p.returncode, errors or ""
+
+    @staticmethod
+    def removeBackup(path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.isfile(path):
+            os.remove(path)
+
+    @staticmethod
+    def getCompression(compress):
+        """
+        Returns the compression method to pass to pg_dump.
+        The value "auto" selects zstd with pg_dump 16 and higher, and the default
+        compression of pg_dump otherwise. When the pg_dump build doesn't support
+        zstd, the backup falls back to the default compression.
+        """
+        if compress != "auto":
+            return compress
+        try:
+            version = subprocess.run(
+                ["pg_dump", "--version"],
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+            ).stdout
+            if int(re.search(r"(\d+)", version).group(1)) >= 16:
+                return "zstd"
+        except Exception:
+            pass
+        return None
+
+    @staticmethod
+    def verify(backuppath, manifest):
+        """
+        Checks that the table of contents of the backup lists the data of every
+        table in the manifest.
+        """
+        toc = subprocess.run(
+            ["pg_restore", "--list", backuppath],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        if toc.returncode:
+            raise Exception("Backup can't be read: %s" % toc.stderr.strip())
+        tables = set()
+        for line in toc.stdout.splitlines():
+            # Format: "1234; 0 16386 TABLE DATA public item frepple"
+            fields = line.split()
+            if " TABLE DATA public " in line and len(fields) >= 7:
+                tables.add(fields[6])
+        missing = set(manifest.keys()) - tables
+        if missing:
+            raise Exception(
+                "Backup is missing the data of %s" % ", ".join(sorted(missing))
+            )
+
+    @staticmethod
+    def purge(now):
+        """
+        Deletes backups older than a month, and the oldest backups exceeding the
+        disk space configured in the setting MAXTOTALBACKUPSIZE.
+        The most recent backup is always kept.
+        """
+        pattern = re.compile(r"^database\..*\.(\d{8}\.\d{6})(\.dump)?$")
+        backups = []
+        for f in os.listdir(settings.FREPPLE_LOGDIR):
+            match = pattern.match(f)
+            if not match:
+                continue
+            path = os.path.join(settings.FREPPLE_LOGDIR, f)
+            try:
+                if os.path.isdir(path):
+                    size = sum(
+                        os.path.getsize(os.path.join(path, i))
+                        for i in os.listdir(path)
+                    )
+                else:
+                    size = os.path.getsize(path)
+                created = datetime.strptime(match.group(1), "%Y%m%d.%H%M%S")
+            except Exception:
+                continue
+            backups.append((created, size, path))
+        backups.sort(reverse=True)
+        total = 0
+        maxsize = getattr(settings, "MAXTOTALBACKUPSIZE", None)
+        for count, (created, size, path) in enumerate(backups):
+            total += size
+            if count and (
+                (now - created).days > 31
+                or (maxsize and total > maxsize * 1024 * 1024)
+            ):
+                try:
+                    Command.removeBackup(path)
+                    if os.path.isfile("%s.json" % path):
+                        os.remove("%s.json" % path)
+                except Exception:
+                    pass
+
     # accordion template
     title = _("Back up the database")
     index = 1600
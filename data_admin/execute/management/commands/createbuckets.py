@@ -8,7 +8,7 @@ from django.utils.translation import gettext_lazy as _
 from django.template.loader import render_to_string
 
 from ....common.middleware import _thread_locals
-from ....common.models import Bucket, BucketDetail
+from ....common.models import Bucket, BucketCalendar, BucketDetail, TablePresence
 from ...models import Task
 from ....common.models import User
 from .... import __version__
@@ -62,6 +62,12 @@ class Command(BaseCommand):
         parser.add_argument(
             "--format-year", default="%Y", help="Format template for a yearly bucket"
         ),
+        parser.add_argument(
+            "--extend",
+            action="store_true",
+            default=False,
+            help="Keep the existing buckets, and only add the missing dates",
+        )
         parser.add_argument("--user", help="User running the command")
         parser.add_argument(
             "--database",
@@ -82,6 +88,80 @@ class Command(BaseCommand):
             fmt = fmt.replace("%q", str(quarter))
         return curdate.strftime(fmt)
 
+    def generateDates(self, start, end, weekstart, options):
+        """
+        Generates a tuple (bucket, name, start date, end date) for all bucket dates
+        overlapping with the horizon.
+        Each period is computed directly, rather than by walking day by day.
+        """
+        last = end - timedelta(1)
+
+        # Years
+        for year in range(start.year, last.year + 1):
+            yield (
+                "year",
+                self.formatDate(
+                    max(start, datetime(year, 1, 1)), options["format_year"]
+                ),
+                datetime(year, 1, 1),
+                datetime(year + 1, 1, 1),
+            )
+
+        # Quarters and months
+        for bucket, months in (("quarter", 3), ("month", 1)):
+            year = start.year
+            month = (start.month - 1) // months * months + 1
+            while datetime(year, month, 1) <= last:
+                nextyear = year + (month + months - 1) // 12
+                nextmonth = (month + months - 1) % 12 + 1
+                yield (
+                    bucket,
+                    self.formatDate(
+                        max(start, datetime(year, month, 1)),
+                        options["format_%s" % bucket],
+                    ),
+                    datetime(year, month, 1),
+                    datetime(nextyear, nextmonth, 1),
+                )
+                year = nextyear
+                month = nextmonth
+
+        # Weeks
+        # A day belongs to the week starting on the configured weekday before
+        # the monday of the day. We need to avoid weeks 00: we therefore take
+        # the name of the week starting the monday included in that week.
+        monday = start - timedelta(start.weekday())
+        while monday <= last:
+            week_start = monday + timedelta(weekstart - 1)
+            yield (
+                "week",
+                self.formatDate(
+                    week_start
+                    + timedelta(
+                        days=((10 if self.isoweeknumber else 7) - week_start.weekday())
+                        % 7
+                    ),
+                    options["format_week"],
+                ),
+                week_start,
+                week_start + timedelta(7),
+            )
+            monday += timedelta(7)
+
+        # Days
+        iso = options["format_day"] == "%Y-%m-%d"
+        curdate = start
+        while curdate < end:
+            yield (
+                "day",
+                curdate.date().isoformat()
+                if iso
+                else self.formatDate(curdate.date(), options["format_day"]),
+                curdate,
+                curdate + timedelta(1),
+            )
+            curdate += timedelta(1)
+
     def handle(self, **options):
         # Make sure the debug flag is not set!
         # When it is set, the django database wrapper collects a list of all sql
@@ -150,111 +230,69 @@ class Command(BaseCommand):
                 raise CommandError("Date is not matching format YYYY-MM-DD")
 
             with transaction.atomic(using=database, savepoint=False):
-                # Delete previous contents
-                with connections[database].cursor() as cursor:
-                    cursor.execute(
-                        "delete from common_bucketdetail where bucket_id in ('year','quarter','month','week','day')"
-                    )
-                    cursor.execute(
-                        "delete from common_bucket where name in ('year','quarter','month','week','day')"
-                    )
-
-                # Create buckets
-                y = Bucket(name="year", description="Yearly time buckets", level=1)
-                q = Bucket(
-                    name="quarter", description="Quarterly time buckets", level=2
-                )
-                m = Bucket(name="month", description="Monthly time buckets", level=3)
-                w = Bucket(name="week", description="Weeky time buckets", level=4)
-                d = Bucket(name="day", description="Daily time buckets", level=5)
-                y.save(using=database)
-                q.save(using=database)
-                m.save(using=database)
-                w.save(using=database)
-                d.save(using=database)
-
-                # Loop over all days in the chosen horizon
-                prev_year = None
-                prev_quarter = None
-                prev_month = None
-                prev_week = None
-                while curdate < enddate:
-                    month = int(
-                        curdate.strftime("%m")
-                    )  # an integer in the range 1 - 12
-                    quarter = (month - 1) // 3 + 1  # an integer in the range 1 - 4
-                    year = int(curdate.strftime("%Y"))
-                    dayofweek = int(
-                        curdate.strftime("%w")
-                    )  # day of the week, 0 = sunday, 1 = monday, ...
-                    year_start = datetime(year, 1, 1)
-                    year_end = datetime(year + 1, 1, 1)
-                    week_start = curdate - timedelta(
-                        (dayofweek + 6) % 7 + 1 - weekstart
+                buckets = [
+                    ("year", "Yearly time buckets", 1),
+                    ("quarter", "Quarterly time buckets", 2),
+                    ("month", "Monthly time buckets", 3),
+                    ("week", "Weeky time buckets", 4),
+                    ("day", "Daily time buckets", 5),
+                ]
+                existing = set()
+                if options["extend"]:
+                    # Keep the existing buckets, and only add the missing dates
+                    for name, description, level in buckets:
+                        Bucket.objects.using(database).get_or_create(
+                            name=name,
+                            defaults={"description": description, "level": level},
+                        )
+                    existing = set(
+                        BucketDetail.objects.using(database)
+                        .filter(bucket__in=[b[0] for b in buckets])
+                        .values_list("bucket", "startdate")
                     )
-                    week_end = curdate - timedelta((dayofweek + 6) % 7 - 6 - weekstart)
+                    for bucket, startdate in existing:
+                        if (
+                            bucket == "week"
+                            and (startdate.weekday() + 1) % 7 != weekstart
+                        ):
+                            raise CommandError(
+                                "Existing weeks don't start on the requested weekday"
+                            )
+                else:
+                    # Delete previous contents
+                    with connections[database].cursor() as cursor:
+                        cursor.execute(
+                            "delete from common_bucketdetail where bucket_id in ('year','quarter','month','week','day')"
+                        )
+                        cursor.execute(
+                            "delete from common_bucket where name in ('year','quarter','month','week','day')"
+                        )
+                    for name, description, level in buckets:
+                        Bucket(name=name, description=description, level=level).save(
+                            using=database
+                        )
 
-                    # Create buckets
-                    if year != prev_year:
-                        prev_year = year
-                        BucketDetail(
-                            bucket=y,
-                            name=self.formatDate(curdate, options["format_year"]),
-                            startdate=year_start,
-                            enddate=year_end,
-                        ).save(using=database)
-                    if quarter != prev_quarter:
-                        prev_quarter = quarter
+                # Create the bucket dates in bulk
+                BucketDetail.objects.using(database).bulk_create(
+                    (
                         BucketDetail(
-                            bucket=q,
-                            name=self.formatDate(curdate, options["format_quarter"]),
-                            startdate=date(year, quarter * 3 - 2, 1),
-                            enddate=date(
-                                year + quarter // 4,
-                                quarter * 3 + 1 - 12 * (quarter // 4),
-                                1,
-                            ),
-                        ).save(using=database)
-                    if month != prev_month:
-                        prev_month = month
-                        BucketDetail(
-                            bucket=m,
-                            name=self.formatDate(curdate, options["format_month"]),
-                            startdate=date(year, month, 1),
-                            enddate=date(
-                                year + month // 12, month + 1 - 12 * (month // 12), 1
-                            ),
-                        ).save(using=database)
-                    if week_start != prev_week:
-                        prev_week = week_start
-                        # we need to avoid weeks 00
-                        # we will therefore take the name of the week starting the monday
-                        # included in that week
-                        BucketDetail(
-                            bucket=w,
-                            name=self.formatDate(
-                                week_start
-                                + timedelta(
-                                    days=(
-                                        (10 if self.isoweeknumber else 7)
-                                        - week_start.weekday()
-                                    )
-                                    % 7
-                                ),
-                                options["format_week"],
-                            ),
-                            startdate=week_start,
-                            enddate=week_end,
-                        ).save(using=database)
-                    BucketDetail(
-                        bucket=d,
-                        name=self.formatDate(curdate.date(), options["format_day"]),
-                        startdate=curdate,
-                        enddate=curdate + timedelta(1),
-                    ).save(using=database)
+                            bucket_id=bucket,
+                            name=name,
+                            startdate=startdate,
+                            enddate=enddate,
+                            lastmodified=now,
+                        )
+                        for bucket, name, startdate, enddate in self.generateDates(
+                            curdate, enddate, weekstart, options
+                        )
+                        if (bucket, startdate) not in existing
+                    ),
+                    batch_size=5000,
+                )
 
-                    # Next date
-                    curdate = curdate + timedelta(1)
+            # The bulk operations don't send signals
+            BucketCalendar.invalidate(database)
+            TablePresence.invalidate(database)
 
             # Log success
             if task:
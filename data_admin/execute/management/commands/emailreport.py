@@ -13,9 +13,10 @@ from django.db import DEFAULT_DB_ALIAS
 from django.utils.translation import gettext_lazy as _
 from django.template.loader import render_to_string
 
-from ...models import Task
+from ...models import Task, TaskProgress
 from ....common.middleware import _thread_locals
-from ....common.models import User
+from ....common.models import MailQueue, User
+from .runworker import launchWorker
 from ....common.report import GridReport
 from .... import __version__
 
@@ -168,26 +169,34 @@ class Command(BaseCommand):
                 to=correctedRecipients,
             )
 
+            progress = TaskProgress(task, database)
+            progress.update(
+                phase="compressing",
+                total_bytes=sum(os.path.getsize(f) for f in correctedReports),
+                force=True,
+            )
             b = BytesIO()
             with ZipFile(file=b, mode="w", compression=ZIP_DEFLATED) as zf:
                 processedFiles = 0
                 for f in correctedReports:
-                    task.message = "Compressing file %s" % basename(f)
-                    task.status = (
-                        str(int(processedFiles / len(correctedReports) * 90.0)) + "%"
+                    Task.checkCancel()
+                    progress.update(
+                        status="%d%%"
+                        % int(processedFiles / len(correctedReports) * 90.0),
+                        message="Compressing file %s" % basename(f),
                     )
-                    task.save(using=database)
                     zf.write(filename=f, arcname=basename(f))
+                    progress.update(bytes=os.path.getsize(f))
                     processedFiles = processedFiles + 1
                 zf.close()
 
                 # attach zip file
-                task.status = "90%"
-                task.message = "Sending email"
-                task.save(using=database)
+                progress.update(
+                    phase="sending", status="90%", message="Sending email", force=True
+                )
                 message.attach("reports.zip", b.getvalue(), "application/zip")
-                # send email
-                message.send()
+                # send email, a worker retries it when the delivery fails
+                error = MailQueue.send(message, database, task=task.id)
 
             b.close()
 
@@ -196,6 +205,9 @@ class Command(BaseCommand):
             task.message = ""
             task.status = "Done"
             task.finished = datetime.now()
+            if error:
+                task.message = "Email not delivered yet, retrying: %s" % error
+                launchWorker(database)
 
         except Exception as e:
             if task:
@@ -1,10 +1,10 @@
+import logging
 import os
 from datetime import datetime
 
 from django.apps import apps
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
-from django.core.management.color import no_style
 from django.db import connections, transaction, DEFAULT_DB_ALIAS
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import gettext_lazy as _
@@ -12,10 +12,11 @@ from django.template.loader import render_to_string
 
 from ...models import Task
 from ....common.middleware import _thread_locals
-from ....common.models import User
-from ....common.report import EXCLUDE_FROM_BULK_OPERATIONS
+from ....common.models import BucketCalendar, Comment, TablePresence, User
+from ....common.report import EXCLUDE_FROM_BULK_OPERATIONS, GridReport
 from .... import __version__
 
+logger = logging.getLogger(__name__)
 
 class Command(BaseCommand):
 
@@ -49,6 +50,12 @@ class Command(BaseCommand):
             help="Task identifier (generated automatically if not provided)",
         ),
         parser.add_argument("--models", help="Comma-separated list of models to erase")
+        parser.add_argument(
+            "--cascade",
+            action="store_true",
+            default=False,
+            help="Also erase the models depending on the models to erase",
+        )
 
     def handle(self, **options):
         # Pick up options
@@ -90,9 +97,10 @@ class Command(BaseCommand):
                 task = Task(
                     name="empty", submitted=now, started=now, status="0%", user=user
                 )
-                task.arguments = "%s%s" % (
+                task.arguments = "%s%s%s" % (
                     "--user=%s " % options["user"] if options["user"] else "",
                     "--models=%s " % options["models"] if options["models"] else "",
+                    "--cascade " if options["cascade"] else "",
                 )
             task.processid = os.getpid()
             task.save(using=database)
@@ -111,6 +119,8 @@ class Command(BaseCommand):
             # Validate the user list of tables
             if models:
                 models2tables = set()
+                requested = set()
+                dependents = set()
                 admin_log_positive = True
                 for m in models:
                     try:
@@ -118,15 +128,37 @@ class Command(BaseCommand):
                         x = apps.get_model(x[0], x[1])
                         if x in EXCLUDE_FROM_BULK_OPERATIONS:
                             continue
-
-                        ContentTypekeys.add(ContentType.objects.get_for_model(x).pk)
-
-                        x = x._meta.db_table
-                        if x not in tables:
+                        if x._meta.db_table not in tables:
                             raise
-                        models2tables.add(x)
                     except Exception as e:
                         raise CommandError("Invalid model to erase: %s" % m)
+                    requested.add(x)
+
+                    # Find all models depending on this one
+                    for dep in GridReport.getDependentModels(x):
+                        if (
+                            dep not in EXCLUDE_FROM_BULK_OPERATIONS
+                            and dep._meta.db_table in tables
+                        ):
+                            dependents.add(dep)
+
+                # The dependent models can only be erased together
+                extra = sorted(
+                    dep._meta.label_lower
+                    for dep in dependents
+                    if dep not in requested
+                    and dep._meta.db_table not in {r._meta.db_table for r in requested}
+                )
+                if extra and not options["cascade"]:
+                    raise CommandError(
+                        "These models depend on the models to erase, and need to "
+                        "be erased as well: %s" % ", ".join(extra)
+                    )
+                if extra:
+                    logger.info("Also erasing dependent models: %s" % ", ".join(extra))
+                for dep in dependents:
+                    ContentTypekeys.add(ContentType.objects.get_for_model(dep).pk)
+                    models2tables.add(dep._meta.db_table)
                 tables = models2tables
             else:
                 admin_log_positive = False
@@ -145,24 +177,36 @@ class Command(BaseCommand):
             tables.discard("execute_log")
             tables.discard("execute_schedule")
             tables.discard("common_scenario")
+            tables.discard("common_mailqueue")
+            tables.discard("common_userchange")
 
             # Delete all records from the tables.
             with transaction.atomic(using=database, savepoint=False):
+                if not admin_log_positive:
+                    # Erase the history of all other models
+                    ContentTypekeys = set(
+                        ContentType.objects.using(database)
+                        .exclude(pk__in=ContentTypekeys)
+                        .values_list("pk", flat=True)
+                    )
                 if ContentTypekeys:
-                    if admin_log_positive:
-                        cursor.execute(
-                            "delete from common_comment where content_type_id = any(%s) and type in ('add', 'change', 'delete')",
-                            (list(ContentTypekeys),),
-                        )
-                    else:
-                        cursor.execute(
-                            "delete from common_comment where content_type_id != any(%s) and type in ('add', 'change', 'delete')",
-                            (list(ContentTypekeys),),
-                        )
+                    Comment.erase(
+                        ContentTypekeys,
+                        types=("add", "change", "delete"),
+                        database=database,
+                    )
                 if "common_bucket" in tables:
                     cursor.execute("update common_user set horizonbuckets = null")
-                for stmt in connections[database].ops.sql_flush(no_style(), tables, []):
-                    cursor.execute(stmt)
+                if tables:
+                    # A single statement truncates all tables at once
+                    cursor.execute(
+                        "truncate table %s restart identity"
+                        % ",".join(
+                            connections[database].ops.quote_name(t) for t in tables
+                        )
+                    )
+            TablePresence.invalidate(database)
+            BucketCalendar.invalidate(database)
 
             # Task update
             task.status = "Done"
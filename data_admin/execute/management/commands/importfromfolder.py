@@ -9,7 +9,6 @@ import logging
 
 from django.conf import settings
 from django.contrib.auth import get_permission_codename
-from django.contrib.contenttypes.models import ContentType
 from django.core.management.base import BaseCommand, CommandError
 from django.db import connections, DEFAULT_DB_ALIAS, transaction
 from django.template.loader import render_to_string
@@ -17,9 +16,9 @@ from django.utils import translation
 from django.utils.formats import get_format
 from django.utils.translation import gettext_lazy as _
 
-from ...models import Task
+from ...models import Task, TaskCanceled, TaskProgress
 from ....common.middleware import _thread_locals
-from ....common.report import GridReport, matchesModelName
+from ....common.report import GridReport, getModelByName
 from .... import __version__
 from ....common.dataload import parseCSVdata, parseExcelWorksheet
 from ....common.models import User, NotificationFactory
@@ -88,6 +87,8 @@ class Command(BaseCommand):
             print("%s Failed to open logfile %s: %s" % (datetime.now(), logfile, e))
 
         task = None
+        self.progress = None
+        canceled = False
         errors = [0, 0]
         try:
             setattr(_thread_locals, "database", self.database)
@@ -120,6 +121,7 @@ class Command(BaseCommand):
                 )
             task.processid = os.getpid()
             task.save(using=self.database)
+            self.progress = TaskProgress(task, self.database)
 
             # Choose the right self.delimiter and language
             self.delimiter = (
@@ -143,11 +145,6 @@ class Command(BaseCommand):
                     % datetime.now().replace(microsecond=0)
                 )
 
-                all_models = [
-                    (ct.model_class(), ct.pk)
-                    for ct in ContentType.objects.all()
-                    if ct.model_class()
-                ]
                 models = []
                 for ifile in os.listdir(
                     settings.DATABASES[self.database]["FILEUPLOADFOLDER"]
@@ -166,13 +163,7 @@ class Command(BaseCommand):
                         continue
                     filename0 = ifile.split(".")[0].split(" (")[0]
 
-                    model = None
-                    contenttype_id = None
-                    for m, ct in all_models:
-                        if matchesModelName(filename0, m):
-                            model = m
-                            contenttype_id = ct
-                            break
+                    model, contenttype_id = getModelByName(filename0, self.database)
 
                     if not model or model in EXCLUDE_FROM_BULK_OPERATIONS:
                         logger.info(
@@ -192,9 +183,7 @@ class Command(BaseCommand):
                             % (datetime.now().replace(microsecond=0), ifile)
                         )
                     else:
-                        deps = set([model])
-                        GridReport.dependent_models(model, deps)
-
+                        deps = GridReport.getDependentModels(model)
                         models.append((ifile, model, contenttype_id, deps))
 
                 # Sort the list of models, based on dependencies between models
@@ -202,17 +191,25 @@ class Command(BaseCommand):
 
                 i = 0
                 cnt = len(models)
+                uploadfolder = os.path.abspath(
+                    settings.DATABASES[self.database]["FILEUPLOADFOLDER"]
+                )
+                self.progress.update(
+                    total_bytes=sum(
+                        os.path.getsize(os.path.join(uploadfolder, m[0]))
+                        for m in models
+                    )
+                )
                 for ifile, model, contenttype_id, dependencies in models:
-                    task.status = str(int(10 + i / cnt * 80)) + "%"
-                    task.message = "Processing data file %s" % ifile
-                    task.save(using=self.database)
-                    i += 1
-                    filetoparse = os.path.join(
-                        os.path.abspath(
-                            settings.DATABASES[self.database]["FILEUPLOADFOLDER"]
-                        ),
-                        ifile,
+                    Task.checkCancel()
+                    self.progress.update(
+                        phase=ifile,
+                        status=str(int(10 + i / cnt * 80)) + "%",
+                        message="Processing data file %s" % ifile,
+                        force=True,
                     )
+                    i += 1
+                    filetoparse = os.path.join(uploadfolder, ifile)
                     if ifile.lower().endswith((".sql", ".sql.gz")):
                         logger.info(
                             "%s Started executing SQL statements from file: %s"
@@ -257,6 +254,7 @@ class Command(BaseCommand):
                             "%s Finished processing data in CSV file: %s"
                             % (datetime.now().replace(microsecond=0), ifile)
                         )
+                    self.progress.update(bytes=os.path.getsize(filetoparse))
             else:
                 errors[0] += 1
                 cnt = 0
@@ -289,6 +287,11 @@ class Command(BaseCommand):
                 task.message = "Cancelled"
             logger.info("%s Cancelled\n" % datetime.now().replace(microsecond=0))
 
+        except TaskCanceled:
+            canceled = True
+            logger.info("%s Canceled\n" % datetime.now().replace(microsecond=0))
+            raise
+
         except Exception as e:
             logger.error("%s Failed" % datetime.now().replace(microsecond=0))
             if task:
@@ -298,13 +301,20 @@ class Command(BaseCommand):
 
         finally:
             setattr(_thread_locals, "database", None)
+            if self.progress:
+                self.progress.close()
             if task:
-                if errors[0] == 0:
+                if canceled:
+                    task.status = "Canceled"
+                    task.message = "Canceled process"
+                elif errors[0] == 0:
                     task.status = "Done"
                 else:
                     task.status = "Failed"
                 task.processid = None
                 task.finished = datetime.now()
+                if self.progress:
+                    task.progress = self.progress.asDict()
                 task.save(using=self.database)
             logger.info(
                 "%s End of importfromfolder\n" % datetime.now().replace(microsecond=0)
@@ -424,9 +434,15 @@ class Command(BaseCommand):
         datafile = EncodedCSVReader(file, delimiter=self.delimiter)
         try:
             with transaction.atomic(using=self.database):
+                lastrow = 0
                 for error in parseCSVdata(
-                    model, datafile, user=self.user, database=self.database
+                    model, datafile, user=self.user, database=self.database, ping=True
                 ):
+                    if error[0] == logging.DEBUG:
+                        # Ping message with the current row number
+                        self.progress.update(rows=error[1] - lastrow)
+                        lastrow = error[1]
+                        continue
                     if error[0] == logging.ERROR:
                         logger.error(
                             "%s Error: %s%s%s%s"
@@ -482,9 +498,15 @@ class Command(BaseCommand):
                 wb = load_workbook(filename=file, read_only=True, data_only=True)
                 for ws_name in wb.sheetnames:
                     ws = wb[ws_name]
+                    lastrow = 0
                     for error in parseExcelWorksheet(
-                        model, ws, user=self.user, database=self.database
+                        model, ws, user=self.user, database=self.database, ping=True
                     ):
+                        if error[0] == logging.DEBUG:
+                            # Ping message with the current row number
+                            self.progress.update(rows=error[1] - lastrow)
+                            lastrow = error[1]
+                            continue
                         if error[0] == logging.ERROR:
                             logger.error(
                                 "%s Error: %s%s%s%s"
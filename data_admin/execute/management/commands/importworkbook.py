@@ -5,9 +5,7 @@ from openpyxl import load_workbook
 from django.core.management.base import BaseCommand, CommandError
 from django.contrib.auth import get_permission_codename
 from django.contrib.auth.models import Group
-from django.contrib.contenttypes.models import ContentType
 from django.db import DEFAULT_DB_ALIAS
-from django.db import transaction
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 from django.utils.text import capfirst
@@ -17,8 +15,8 @@ from django.template.loader import render_to_string
 from .... import __version__
 from ....common.middleware import _thread_locals
 from ....common.models import User, Comment
-from ....common.report import GridReport, matchesModelName
-from ....common.dataload import parseExcelWorksheet
+from ....common.report import GridReport, getModelByName
+from ....common.dataload import loadWorkbook
 from ...models import Task
 
 
@@ -31,8 +29,10 @@ EXCLUDE_FROM_BULK_OPERATIONS = (Group, User, Comment)
 
 class Command(BaseCommand):
 
-    # help = "Loads XLS workbook file into the frePPLe database"
-    help = "command not implemented yet"
+    help = """
+      Loads the worksheets of spreadsheet files into the database.
+      Independent worksheets are loaded in parallel worker processes.
+      """
 
     requires_system_checks = False
 
@@ -48,6 +48,12 @@ class Command(BaseCommand):
             type=int,
             help="Task identifier (generated automatically if not provided)",
         )
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=getattr(settings, "IMPORT_JOBS", 1),
+            help="Number of worksheets loaded in parallel",
+        )
         parser.add_argument("file", nargs="+", help="workbook file name")
 
     def get_version(self):
@@ -107,173 +113,73 @@ class Command(BaseCommand):
             task.arguments = " ".join(options["file"])
             task.save(using=self.database)
 
-            all_models = [
-                (ct.model_class(), ct.pk)
-                for ct in ContentType.objects.all()
-                if ct.model_class()
-            ]
-            try:
-                with transaction.atomic(using=self.database):
-                    # Find all models in the workbook
-                    if "filename" not in locals():
-                        filename = options["file"]
-                    for file in filename:
-                        wb = load_workbook(
-                            filename=file, read_only=True, data_only=True
+            # Find all models in the workbook
+            for idx, file in enumerate(options["file"]):
+                wb = load_workbook(filename=file, read_only=True, data_only=True)
+                models = []
+                for ws_name in wb.sheetnames:
+                    # Find the model
+                    model, contenttype_id = getModelByName(ws_name, self.database)
+                    if not model or model in EXCLUDE_FROM_BULK_OPERATIONS:
+                        print(force_text(_("Ignoring data in worksheet: %s") % ws_name))
+                    elif self.user and not self.user.has_perm(
+                        "%s.%s"
+                        % (
+                            model._meta.app_label,
+                            get_permission_codename("add", model._meta),
                         )
-                        models = []
-                        for ws_name in wb.sheetnames:
-                            # Find the model
-                            model = None
-                            contenttype_id = None
-                            for m, ct in all_models:
-                                if matchesModelName(ws_name, m):
-                                    model = m
-                                    contenttype_id = ct
-                                    break
-                            if not model or model in EXCLUDE_FROM_BULK_OPERATIONS:
-                                print(
-                                    force_text(
-                                        _("Ignoring data in worksheet: %s") % ws_name
-                                    )
-                                )
-                                # yield '<div class="alert alert-warning">' + force_text(_("Ignoring data in worksheet: %s") % ws_name) + '</div>'
-                            elif not self.user.has_perm(
-                                "%s.%s"
-                                % (
-                                    model._meta.app_label,
-                                    get_permission_codename("add", model._meta),
-                                )
-                            ):
-                                # Check permissions
-                                print(
-                                    force_text(
-                                        _("You don't permissions to add: %s") % ws_name
-                                    )
-                                )
-                                # yield '<div class="alert alert-danger">' + force_text(_("You don't permissions to add: %s") % ws_name) + '</div>'
-                            else:
-                                deps = set([model])
-                                GridReport.dependent_models(model, deps)
-                                models.append((ws_name, model, contenttype_id, deps))
-
-                        # Sort the list of models, based on dependencies between models
-                        models = GridReport.sort_models(models)
-
-                        # Process all rows in each worksheet
-                        for ws_name, model, contenttype_id, dependencies in models:
-                            print(
-                                force_text(
-                                    _("Processing data in worksheet: %s") % ws_name
-                                )
+                    ):
+                        # Check permissions
+                        print(
+                            force_text(_("You don't permissions to add: %s") % ws_name)
+                        )
+                    else:
+                        deps = GridReport.getDependentModels(model)
+                        models.append((ws_name, model, contenttype_id, deps))
+
+                # Process all rows in each worksheet, in waves of independent models
+                for ws_name, error in loadWorkbook(
+                    wb,
+                    models,
+                    filename=file,
+                    user=self.user,
+                    database=self.database,
+                    jobs=options["jobs"],
+                ):
+                    if error is None:
+                        print(
+                            force_text(_("Processing data in worksheet: %s") % ws_name)
+                        )
+                    elif error[0] == logging.ERROR:
+                        print(
+                            "%s %s %s %s %s: %s"
+                            % (
+                                ws_name,
+                                error[1] if error[1] else "",
+                                error[2] if error[2] else "",
+                                error[3] if error[3] else "",
+                                capfirst(_("error")),
+                                error[4],
                             )
-                            # yield '<strong>' + force_text(_("Processing data in worksheet: %s") % ws_name) + '</strong><br>'
-                            # yield ('<div class="table-responsive">'
-                            # '<table class="table table-condensed" style="white-space: nowrap;"><tbody>')
-                            numerrors = 0
-                            numwarnings = 0
-                            firsterror = True
-                            ws = wb[ws_name]
-                            for error in parseExcelWorksheet(
-                                model,
-                                ws,
-                                user=self.user,
-                                database=self.database,
-                                ping=True,
-                            ):
-                                if error[0] == logging.DEBUG:
-                                    # Yield some result so we can detect disconnect clients and interrupt the upload
-                                    # yield ' '
-                                    continue
-                                if firsterror and error[0] in (
-                                    logging.ERROR,
-                                    logging.WARNING,
-                                ):
-                                    print(
-                                        "%s %s %s %s %s%s%s"
-                                        % (
-                                            capfirst(_("worksheet")),
-                                            capfirst(_("row")),
-                                            capfirst(_("field")),
-                                            capfirst(_("value")),
-                                            capfirst(_("error")),
-                                            " / ",
-                                            capfirst(_("warning")),
-                                        )
-                                    )
-                                    # yield '<tr><th class="sr-only">%s</th><th>%s</th><th>%s</th><th>%s</th><th>%s%s%s</th></tr>' % (
-                                    #   capfirst(_("worksheet")), capfirst(_("row")),
-                                    #   capfirst(_("field")), capfirst(_("value")),
-                                    #   capfirst(_("error")), " / ", capfirst(_("warning"))
-                                    #   )
-                                    firsterror = False
-                                if error[0] == logging.ERROR:
-                                    print(
-                                        "%s %s %s %s %s: %s"
-                                        % (
-                                            ws_name,
-                                            error[1] if error[1] else "",
-                                            error[2] if error[2] else "",
-                                            error[3] if error[3] else "",
-                                            capfirst(_("error")),
-                                            error[4],
-                                        )
-                                    )
-                                    # yield '<tr><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s: %s</td></tr>' % (
-                                    #   ws_name,
-                                    #   error[1] if error[1] else '',
-                                    #   error[2] if error[2] else '',
-                                    #   error[3] if error[3] else '',
-                                    #   capfirst(_('error')),
-                                    #   error[4]
-                                    #   )
-                                    numerrors += 1
-                                elif error[1] == logging.WARNING:
-                                    print(
-                                        "%s %s %s %s %s: %s"
-                                        % (
-                                            ws_name,
-                                            error[1] if error[1] else "",
-                                            error[2] if error[2] else "",
-                                            error[3] if error[3] else "",
-                                            capfirst(_("warning")),
-                                            error[4],
-                                        )
-                                    )
-                                    # yield '<tr><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s: %s</td></tr>' % (
-                                    #   ws_name,
-                                    #   error[1] if error[1] else '',
-                                    #   error[2] if error[2] else '',
-                                    #   error[3] if error[3] else '',
-                                    #   capfirst(_('warning')),
-                                    #   error[4]
-                                    #   )
-                                    numwarnings += 1
-                                else:
-                                    print(
-                                        "%s %s %s %s %s %s"
-                                        % (
-                                            "danger" if numerrors > 0 else "success",
-                                            ws_name,
-                                            error[1] if error[1] else "",
-                                            error[2] if error[2] else "",
-                                            error[3] if error[3] else "",
-                                            error[4],
-                                        )
-                                    )
-                            #     yield '<tr class=%s><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>' % (
-                            #       "danger" if numerrors > 0 else 'success',
-                            #       ws_name,
-                            #       error[1] if error[1] else '',
-                            #       error[2] if error[2] else '',
-                            #       error[3] if error[3] else '',
-                            #       error[4]
-                            #       )
-                            # yield '</tbody></table></div>'
-                        print("%s" % _("Done"))
-                        # yield '<div><strong>%s</strong></div>' % _("Done")
-            except GeneratorExit:
-                logger.warning("Connection Aborted")
+                        )
+                    elif error[0] == logging.WARNING:
+                        print(
+                            "%s %s %s %s %s: %s"
+                            % (
+                                ws_name,
+                                error[1] if error[1] else "",
+                                error[2] if error[2] else "",
+                                error[3] if error[3] else "",
+                                capfirst(_("warning")),
+                                error[4],
+                            )
+                        )
+                    else:
+                        print("%s %s" % (ws_name, error[4]))
+                wb.close()
+                print("%s" % _("Done"))
+                task.status = "%d%%" % (100 * (idx + 1) // len(options["file"]))
+                task.save(using=self.database, update_fields=["status"])
         except Exception as e:
             if task:
                 task.status = "Failed"
@@ -25,7 +25,7 @@ from django.core.management.commands import loaddata
 from django.template.loader import render_to_string
 from django.utils.translation import gettext_lazy as _
 
-from ....common.models import User
+from ....common.models import TablePresence, User
 from ....common.middleware import _thread_locals
 from ...models import Task
 
@@ -124,6 +124,7 @@ class Command(loaddata.Command):
 
             # Excecute the standard django command
             super().handle(*fixture_labels, **options)
+            TablePresence.invalidate(database)
 
             # Task update
             task.status = "Done"
@@ -7,7 +7,7 @@ from django.conf import settings
 from django.db import DEFAULT_DB_ALIAS
 
 from ...models import Task
-from ....common.models import User
+from ....common.models import BucketCalendar, TablePresence, User
 from .... import __version__
 
 
@@ -37,6 +37,9 @@ class Command(BaseCommand):
             type=int,
             help="Task identifier (generated automatically if not provided)",
         )
+        parser.add_argument(
+            "--jobs", type=int, default=1, help="Number of parallel jobs"
+        )
         parser.add_argument("dump", help="Database dump file to restore.")
 
     def handle(self, **options):
@@ -83,25 +86,26 @@ class Command(BaseCommand):
             dumpfile = os.path.abspath(
                 os.path.join(settings.FREPPLE_LOGDIR, options["dump"])
             )
-            if not os.path.isfile(dumpfile):
+            if not os.path.isfile(dumpfile) and not os.path.isdir(dumpfile):
                 raise CommandError("Dump file not found")
 
             # Run the restore command
             # Commenting the next line is a little more secure, but requires you to create a .pgpass file.
             if settings.DATABASES[database]["PASSWORD"]:
                 os.environ["PGPASSWORD"] = settings.DATABASES[database]["PASSWORD"]
-            cmd = ["pg_restore", "-n", "public", "-Fc", "-c", "--if-exists"]
+            cmd = ["pg_restore", "-n", "public", "-c", "--if-exists"]
+            if options["jobs"] > 1:
+                cmd.append("--jobs=%s" % options["jobs"])
             if settings.DATABASES[database]["USER"]:
                 cmd.append("--username=%s" % settings.DATABASES[database]["USER"])
             if settings.DATABASES[database]["HOST"]:
                 cmd.append("--host=%s" % settings.DATABASES[database]["HOST"])
             if settings.DATABASES[database]["PORT"]:
-                cmd.append("--port=%s " % settings.DATABASES[database]["PORT"])
+                cmd.append("--port=%s" % settings.DATABASES[database]["PORT"])
             cmd.append("-d")
             cmd.append(settings.DATABASES[database]["NAME"])
-            cmd.append("<%s" % dumpfile)
-            # Shell needs to be True in order to interpret the < character
-            with subprocess.Popen(cmd, shell=True) as p:
+            cmd.append(dumpfile)
+            with subprocess.Popen(cmd) as p:
                 try:
                     task.processid = p.pid
                     task.save(using=database)
@@ -110,6 +114,9 @@ class Command(BaseCommand):
                     p.kill()
                     p.wait()
                     raise Exception("Database restoration failed")
+            TablePresence.invalidate(database)
+            User.clearPreferenceCache(database)
+            BucketCalendar.invalidate(database)
 
             # Task update
             # We need to recreate a new task record, since the previous one is lost during the restoration.
@@ -3,7 +3,9 @@ import logging
 from multiprocessing import Process
 import operator
 import os
+import psutil
 import shlex
+import signal
 from subprocess import Popen
 import sys
 from threading import Thread
@@ -15,7 +17,7 @@ from django.core.management.base import BaseCommand, CommandError
 from django.db import DEFAULT_DB_ALIAS, connections
 
 from .... import __version__, runCommand
-from ....common.models import Parameter
+from ....common.models import MailQueue, Parameter
 from ....common.middleware import _thread_locals
 from ...models import Task
 
@@ -84,6 +86,41 @@ def launchWorker(database=DEFAULT_DB_ALIAS):
             Popen(["frepplectl", "runworker", "--database=%s" % database])
 
 
+def flushMailQueue(database=DEFAULT_DB_ALIAS):
+    """
+    Delivers the emails queued by the tasks.
+    """
+    try:
+        MailQueue.flush(database)
+    except Exception as e:
+        logger.error("Error mailing messages: %s" % e)
+
+
+def killProcessTree(pid):
+    """
+    Kills a process and all its descendants. Descendants running in their own
+    process group, such as the pg_dump and psql pipes of scenario_copy, get
+    their complete group killed.
+    """
+    try:
+        proc = psutil.Process(pid)
+        procs = proc.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return
+    if os.name != "nt":
+        for p in procs:
+            try:
+                if os.getpgid(p.pid) == p.pid:
+                    os.killpg(p.pid, signal.SIGKILL)
+            except OSError:
+                pass
+    for p in [proc] + procs:
+        try:
+            p.kill()
+        except psutil.Error:
+            pass
+
+
 def runTask(task, database):
     task.started = datetime.now()
     # Verify the command exists
@@ -127,14 +164,32 @@ def runTask(task, database):
         task.processid = child.pid
         task.save(update_fields=["processid"], using=database)
 
-        # Wait for the child to finish
-        child.join()
+        # Wait for the child to finish. A canceled task that doesn't stop
+        # within the grace period is killed.
+        canceled = None
+        grace = getattr(settings, "TASK_CANCEL_GRACE_PERIOD", 30)
+        while True:
+            child.join(5)
+            if not child.is_alive():
+                break
+            if canceled is None:
+                if (
+                    Task.objects.using(database)
+                    .filter(pk=task.id, cancel=True)
+                    .exists()
+                ):
+                    canceled = time.time()
+            elif time.time() - canceled > grace:
+                logger.warning("Killing task %s which didn't stop in time" % task.id)
+                killProcessTree(child.pid)
+                child.join()
+                break
 
         # Read the task again from the database and update it
         task = Task.objects.all().using(database).get(pk=task.id)
         task.processid = None
         if (
-            task.status not in ("Done", "Failed")
+            task.status not in ("Done", "Failed", "Canceled")
             or not task.finished
             or not task.started
         ):
@@ -144,7 +199,10 @@ def runTask(task, database):
             if not background:
                 if not task.finished:
                     task.finished = now
-                if task.status not in ("Done", "Failed"):
+                if task.cancel:
+                    task.status = "Canceled"
+                    task.message = "Canceled process"
+                elif task.status not in ("Done", "Failed", "Canceled"):
                     task.status = "Done"
             task.save(using=database)
         if "FREPPLE_TEST" not in os.environ:
@@ -228,6 +286,7 @@ class Command(BaseCommand):
                 idle_loop_done = False
             except Exception:
                 # No more tasks found
+                flushMailQueue(database)
                 if continuous:
                     time.sleep(5)
                     continue
@@ -235,7 +294,8 @@ class Command(BaseCommand):
                     # Special case: we need to permit a single idle loop before shutting down
                     # the worker. If we shut down immediately, a newly launched task could think
                     # that a worker is already running - while it just shut down.
-                    if idle_loop_done:
+                    # The worker also keeps running while emails wait for a retry.
+                    if idle_loop_done and not MailQueue.pending(database):
                         break
                     else:
                         idle_loop_done = True
@@ -273,6 +333,7 @@ class Command(BaseCommand):
                             datetime.now(),
                         )
                     )
+            flushMailQueue(database)
         # Remove the parameter again
         try:
             Parameter.objects.all().using(database).get(pk="Worker alive").delete()
@@ -280,6 +341,12 @@ class Command(BaseCommand):
             pass
         setattr(_thread_locals, "database", None)
 
+        # Remove tasks exceeding the configured history length
+        try:
+            Task.purgeHistory(database)
+        except Exception as e:
+            logger.warning("Couldn't purge the task history: %s" % e)
+
         # Remove log files exceeding the configured disk space allocation
         totallogs = 0
         filelist = []
@@ -1,25 +1,39 @@
+import logging
 import os
+import shutil
+import signal
 import subprocess
+import tempfile
 from datetime import datetime
+from threading import Thread
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
-from django.db import DEFAULT_DB_ALIAS
+from django.db import connections, DEFAULT_DB_ALIAS, transaction
 from django.utils.translation import gettext_lazy as _
 from django.template.loader import render_to_string
 
-from ...models import Task, ScheduledTask
-from ....common.models import User, Scenario
+from ...models import Task, TaskCanceled, ScheduledTask
+from ...tablecopy import (
+    copyTables,
+    getFingerprints,
+    getSharedTables,
+    streamTables,
+)
+from ....common.models import BucketCalendar, User, Scenario, TablePresence
 from .... import __version__
 
+logger = logging.getLogger(__name__)
+
 
 class Command(BaseCommand):
     help = """
       This command copies the contents of a database into another.
       The original data in the destination database are lost.
     
-      The pg_dump and psql commands need to be in the path, otherwise
-      this command will fail.
+      When the destination database has the same tables as the source, the
+      data are streamed between the databases. Otherwise the pg_dump and
+      pg_restore commands need to be in the path, or this command will fail.
       """
 
     requires_system_checks = False
@@ -54,6 +68,18 @@ class Command(BaseCommand):
             default=False,
             help="promotes a scenario to production",
         )
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            help="Number of tables copied in parallel, when streaming the tables or "
+            "when dumping and restoring the database",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            default=False,
+            help="Only copy the tables that are different in the destination",
+        )
         parser.add_argument("source", help="source database to copy")
         parser.add_argument("destination", help="destination database to copy")
 
@@ -120,6 +146,8 @@ class Command(BaseCommand):
                 )
             if force:
                 task.arguments += " --force"
+            if options["incremental"]:
+                task.arguments += " --incremental"
             task.save(using=source)
             try:
                 destinationscenario = Scenario.objects.using(DEFAULT_DB_ALIAS).get(
@@ -172,72 +200,82 @@ class Command(BaseCommand):
                 "reportmanager_report",
                 "reportmanager_column",
                 "execute_schedule",
+                "common_mailqueue",
+                "common_userchange",
             ]
 
+            # Queues that are only processed in the database they are created in
+            queueTables = ["common_mailqueue", "common_userchange"]
+
             # Copying the data
             # Commenting the next line is a little more secure, but requires you to create a .pgpass file.
             if settings.DATABASES[source]["PASSWORD"]:
                 os.environ["PGPASSWORD"] = settings.DATABASES[source]["PASSWORD"]
-            if os.name == "nt":
-                # On windows restoring with pg_restore over a pipe is broken :-(
-                cmd = "pg_dump -c -Fp %s%s%s%s%s | psql %s%s%s%s"
-            else:
-                cmd = "pg_dump -Fc %s%s%s%s%s | pg_restore -n public -Fc -c --if-exists %s%s%s -d %s"
-            commandline = cmd % (
-                settings.DATABASES[source]["USER"]
-                and ("-U %s " % settings.DATABASES[source]["USER"])
-                or "",
-                settings.DATABASES[source]["HOST"]
-                and ("-h %s " % settings.DATABASES[source]["HOST"])
-                or "",
-                settings.DATABASES[source]["PORT"]
-                and ("-p %s " % settings.DATABASES[source]["PORT"])
-                or "",
+            jobs = options["jobs"] or settings.DATABASES[source].get("COPY_JOBS", 1)
+            excluded = (
                 ("%s " % (" -T ".join(["", *excludedTables])))
                 if destination == DEFAULT_DB_ALIAS
-                else "",
-                test
-                and settings.DATABASES[source]["TEST"]["NAME"]
-                or settings.DATABASES[source]["NAME"],
-                settings.DATABASES[destination]["USER"]
-                and ("-U %s " % settings.DATABASES[destination]["USER"])
-                or "",
-                settings.DATABASES[destination]["HOST"]
-                and ("-h %s " % settings.DATABASES[destination]["HOST"])
-                or "",
-                settings.DATABASES[destination]["PORT"]
-                and ("-p %s " % settings.DATABASES[destination]["PORT"])
-                or "",
-                test
-                and settings.DATABASES[destination]["TEST"]["NAME"]
-                or settings.DATABASES[destination]["NAME"],
+                else ""
             )
-            with subprocess.Popen(
-                commandline,
-                shell=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.STDOUT,
-            ) as p:
-                try:
-                    task.processid = p.pid
-                    task.save(using=source)
-                    p.wait()
-                    # Deactivated because a successful copy can still leave warnings and errors
-                    # if p.returncode and destination != DEFAULT_DB_ALIAS:
-                    #    # Consider the destination database free again
-                    #    destinationscenario.status = "Free"
-                    #    destinationscenario.lastrefresh = datetime.today()
-                    #    destinationscenario.save(using=DEFAULT_DB_ALIAS)
-                    #    raise Exception("Database copy failed")
-                except Exception:
-                    p.kill()
-                    p.wait()
-                    # Consider the destination database free again
-                    if destination != DEFAULT_DB_ALIAS:
-                        destinationscenario.status = "Free"
-                        destinationscenario.lastrefresh = datetime.today()
-                        destinationscenario.save(using=DEFAULT_DB_ALIAS)
-                    raise Exception("Database copy failed")
+            try:
+                exclude = excludedTables if destination == DEFAULT_DB_ALIAS else ()
+                if options["incremental"] and self.copyIncremental(
+                    source, destination, exclude
+                ):
+                    logger.info(
+                        "Copied changed tables of scenario '%s' into '%s'"
+                        % (source, destination)
+                    )
+                elif destination != DEFAULT_DB_ALIAS and self.cloneDatabase(
+                    source, destination, test
+                ):
+                    logger.info(
+                        "Cloned scenario '%s' into '%s'" % (source, destination)
+                    )
+                elif self.copyNative(task, source, destination, exclude, jobs):
+                    logger.info(
+                        "Streamed scenario '%s' into '%s'" % (source, destination)
+                    )
+                elif jobs > 1:
+                    self.copyParallel(task, source, destination, excluded, jobs, test)
+                else:
+                    if os.name == "nt":
+                        # On windows restoring with pg_restore over a pipe is broken :-(
+                        cmd = "pg_dump -c -Fp %s%s%s | psql %s%s"
+                    else:
+                        cmd = "pg_dump -Fc %s%s%s | pg_restore -n public -Fc -c --if-exists %s-d %s"
+                    self.runCommand(
+                        cmd
+                        % (
+                            self.connectionArguments(source),
+                            excluded,
+                            self.databaseName(source, test),
+                            self.connectionArguments(destination),
+                            self.databaseName(destination, test),
+                        )
+                    )
+            except TaskCanceled:
+                destinationscenario.status = (
+                    "In use" if destination == DEFAULT_DB_ALIAS else "Free"
+                )
+                destinationscenario.save(using=DEFAULT_DB_ALIAS)
+                raise
+            except Exception:
+                # Consider the destination database free again
+                if destination != DEFAULT_DB_ALIAS:
+                    destinationscenario.status = "Free"
+                    destinationscenario.lastrefresh = datetime.today()
+                    destinationscenario.save(using=DEFAULT_DB_ALIAS)
+                raise Exception("Database copy failed")
+
+            if destination != DEFAULT_DB_ALIAS:
+                # Don't process the queue of the source database a second time
+                with connections[destination].cursor() as cursor:
+                    cursor.execute("truncate table %s" % ",".join(queueTables))
+
+            TablePresence.invalidate(destination)
+            User.clearPreferenceCache(destination)
+            BucketCalendar.invalidate(destination)
 
             # Update the scenario table
             destinationscenario.status = "In use"
@@ -313,6 +351,278 @@ class Command(BaseCommand):
                 task.save(using=source)
             settings.DEBUG = tmp_debug
 
+    @staticmethod
+    def connectionArguments(database):
+        """
+        Returns the user, host and port arguments of the PostgreSQL command line
+        tools for a database.
+        """
+        db = settings.DATABASES[database]
+        return "%s%s%s" % (
+            db["USER"] and ("-U %s " % db["USER"]) or "",
+            db["HOST"] and ("-h %s " % db["HOST"]) or "",
+            db["PORT"] and ("-p %s " % db["PORT"]) or "",
+        )
+
+    @staticmethod
+    def databaseName(database, test=False):
+        return (
+            test
+            and settings.DATABASES[database]["TEST"]["NAME"]
+            or settings.DATABASES[database]["NAME"]
+        )
+
+    def runCommand(self, commandline, progress=None):
+        """
+        Runs a shell command, while watching for cancellation of the task, and
+        returns its exit status.
+        The optional progress function is called every second with the number of
+        lines written by the command that contain a marker string.
+        It's passed as a tuple (marker, function).
+        """
+        with subprocess.Popen(
+            commandline,
+            shell=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE if progress else subprocess.STDOUT,
+            universal_newlines=True,
+            # A separate process group allows to stop the complete pipe
+            start_new_session=os.name != "nt",
+        ) as p:
+            counter = [0]
+            if progress:
+
+                def reader():
+                    for line in p.stderr:
+                        if progress[0] in line:
+                            counter[0] += 1
+
+                Thread(target=reader, daemon=True).start()
+            try:
+                # Wait for the copy to finish, while watching for cancellation
+                reported = 0
+                while True:
+                    try:
+                        p.wait(timeout=1)
+                        break
+                    except subprocess.TimeoutExpired:
+                        Task.checkCancel()
+                        if progress and counter[0] != reported:
+                            reported = counter[0]
+                            progress[1](reported)
+                # The caller checks the exit status: pg_restore reports warnings
+                # and errors of a successful copy with a non-zero status.
+                return p.returncode
+            except TaskCanceled:
+                if os.name == "nt":
+                    p.kill()
+                else:
+                    os.killpg(p.pid, signal.SIGTERM)
+                p.wait()
+                raise
+            except Exception:
+                p.kill()
+                p.wait()
+                raise
+
+    def copyIncremental(self, source, destination, exclude):
+        """
+        Copies only the tables of which the contents are different.
+        Returns False when the databases don't have the same tables, and the
+        caller should fall back to a full copy.
+        """
+        # Read the source from a single snapshot
+        with transaction.atomic(using=source):
+            with connections[source].cursor() as cursor:
+                cursor.execute("set transaction isolation level repeatable read")
+            tables = getSharedTables(source, destination, exclude)
+            if not tables:
+                return False
+            before = getFingerprints(destination, tables)
+            after = getFingerprints(source, tables)
+            changed = {
+                table: columns
+                for table, columns in tables.items()
+                if before[table] != after[table]
+            }
+            try:
+                copyTables(source, destination, changed)
+            except Exception as e:
+                logger.warning(
+                    "Can't copy the changed tables of scenario '%s': %s" % (source, e)
+                )
+                return False
+        return True
+
+    def copyNative(self, task, source, destination, exclude, jobs):
+        """
+        Streams all tables into a destination database with the same tables,
+        without the PostgreSQL command line tools.
+        Returns False when the destination doesn't have the same tables, and the
+        caller should fall back to a dump and restore.
+        """
+        tables = getSharedTables(source, destination, exclude)
+        if not tables:
+            return False
+
+        def progress(count):
+            Task.checkCancel()
+            task.status = "%d%%" % (100 * count / len(tables))
+            task.save(using=source, update_fields=["status"])
+
+        streamTables(source, destination, tables, jobs, progress)
+        return True
+
+    def cloneDatabase(self, source, destination, test):
+        """
+        Copies a database on the same PostgreSQL cluster as a file-level copy with
+        "create database ... template".
+        The key COPY_TEMPLATE of the source database enables this:
+          - True uses the source database itself as template. Its connections
+            are terminated during the copy.
+          - A database name uses that database as template. It is meant to be a
+            snapshot of the source that nobody connects to.
+        Returns False when the database can't be cloned, and the caller should
+        fall back to a dump and restore.
+        """
+        template = settings.DATABASES[source].get("COPY_TEMPLATE", False)
+        if not template:
+            return False
+        src = settings.DATABASES[source]
+        dest = settings.DATABASES[destination]
+        if (src["HOST"], src["PORT"]) != (dest["HOST"], dest["PORT"]):
+            return False
+        if template is True:
+            template = self.databaseName(source, test)
+        name = self.databaseName(destination, test)
+        tmpname = "%s_clone" % name
+
+        import psycopg2
+
+        conn_params = {"database": "template1"}
+        if dest["USER"]:
+            conn_params["user"] = dest["USER"]
+        if dest["PASSWORD"]:
+            conn_params["password"] = dest["PASSWORD"]
+        if dest["HOST"]:
+            conn_params["host"] = dest["HOST"]
+        if dest["PORT"]:
+            conn_params["port"] = dest["PORT"]
+        terminate = """
+            select pg_terminate_backend(pid) from pg_stat_activity
+            where datname = %s and pid <> pg_backend_pid()
+            """
+        try:
+            connection = psycopg2.connect(**conn_params)
+        except Exception as e:
+            logger.warning("Can't clone database '%s': %s" % (template, e))
+            return False
+        try:
+            connection.set_isolation_level(0)  # autocommit
+            with connection.cursor() as cursor:
+                cursor.execute('drop database if exists "%s"' % tmpname)
+
+                # Clone into a new database, so the destination remains intact
+                # when the template can't be used.
+                # Connections reopened in the meantime make the statement fail,
+                # and we retry a few times.
+                sql = 'create database "%s" template "%s"' % (tmpname, template)
+                if settings.DEFAULT_TABLESPACE:
+                    sql += " tablespace = %s" % settings.DEFAULT_TABLESPACE
+                connections[source].close()
+                for attempt in range(3):
+                    cursor.execute(terminate, (template,))
+                    try:
+                        cursor.execute(sql)
+                        break
+                    except psycopg2.Error as e:
+                        if attempt == 2:
+                            logger.warning(
+                                "Can't clone database '%s': %s" % (template, e)
+                            )
+                            return False
+
+                # Replace the destination with the clone
+                connections[destination].close()
+                cursor.execute(terminate, (name,))
+                cursor.execute('drop database if exists "%s"' % name)
+                cursor.execute('alter database "%s" rename to "%s"' % (tmpname, name))
+            return True
+        finally:
+            connection.close()
+
+    def copyParallel(self, task, source, destination, excluded, jobs, test):
+        """
+        Copies a database with a parallel dump in directory format into a
+        temporary folder, followed by a parallel restore.
+        The dump reports the progress from 0 to 50%, and the restore from 50 to
+        100%.
+        """
+
+        def setProgress(start, total):
+            def report(count):
+                task.status = "%d%%" % (start + 50 * min(count, total) / total)
+                task.save(using=source, update_fields=["status"])
+
+            return report
+
+        # Count the tables to dump
+        with connections[source].cursor() as cursor:
+            cursor.execute("select count(*) from pg_tables where schemaname = 'public'")
+            total = cursor.fetchone()[0] or 1
+
+        folder = tempfile.mkdtemp(prefix="scenario_copy_")
+        try:
+            dumpfolder = os.path.join(folder, "dump")
+            returncode = self.runCommand(
+                "pg_dump -v -Fd -j %s -f %s %s%s%s"
+                % (
+                    jobs,
+                    dumpfolder,
+                    self.connectionArguments(source),
+                    excluded,
+                    self.databaseName(source, test),
+                ),
+                progress=("dumping contents of table", setProgress(0, total)),
+            )
+            # Never restore an incomplete dump over the destination
+            if returncode:
+                raise CommandError(
+                    "Dump of scenario '%s' failed with exit status %s"
+                    % (source, returncode)
+                )
+
+            # Count the data items in the table of contents of the dump
+            toc = subprocess.run(
+                ["pg_restore", "-l", dumpfolder],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+            )
+            if toc.returncode:
+                raise CommandError(
+                    "Can't read the dump of scenario '%s': %s"
+                    % (source, toc.stderr.strip())
+                )
+            total = sum(1 for i in toc.stdout.splitlines() if " TABLE DATA " in i)
+            if not total:
+                raise CommandError("The dump of scenario '%s' has no data" % source)
+            task.status = "50%"
+            task.save(using=source, update_fields=["status"])
+
+            self.runCommand(
+                "pg_restore -v -n public -Fd -c --if-exists -j %s %s-d %s %s"
+                % (
+                    jobs,
+                    self.connectionArguments(destination),
+                    self.databaseName(destination, test),
+                    dumpfolder,
+                ),
+                progress=("processing data for table", setProgress(50, total)),
+            )
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
     # accordion template
     title = _("scenario management")
     index = 1500
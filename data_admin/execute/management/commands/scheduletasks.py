@@ -18,7 +18,7 @@ from django.utils.translation import gettext_lazy as _
 from ...models import ScheduledTask, Task
 from .... import __version__
 from ....common.middleware import _thread_locals
-from ....common.models import User
+from ....common.models import MailQueue, User
 from ....common.report import GridReport
 from .runworker import launchWorker, runTask
 
@@ -117,6 +117,7 @@ class Command(BaseCommand):
             idx = 1
             failed = []
             for step in tasklist:
+                Task.checkCancel()
                 steptask = Task(
                     name=step.get("name"),
                     submitted=datetime.now(),
@@ -186,13 +187,20 @@ class Command(BaseCommand):
                     )
                 else:
                     try:
-                        EmailMessage(
-                            subject="FrePPLe successfully executed %s" % schedule.name,
-                            body="Task %s completed succesfully" % task.id,
-                            to=correctedRecipients,
-                        ).send()
+                        MailQueue.enqueue(
+                            EmailMessage(
+                                subject="FrePPLe successfully executed %s"
+                                % schedule.name,
+                                body="Task %s completed succesfully" % task.id,
+                                to=correctedRecipients,
+                            ),
+                            database,
+                            task=task.id,
+                        )
+                        # The worker delivers the email, and retries on failures
+                        launchWorker(database)
                     except Exception as e:
-                        task.message = "Can't send failure e-mail: %s" % e
+                        task.message = "Can't send success e-mail: %s" % e
                         task.save(
                             using=database,
                             update_fields=[
@@ -248,11 +256,18 @@ class Command(BaseCommand):
                         )
                     else:
                         try:
-                            EmailMessage(
-                                subject="FrePPLe failed executing %s" % schedule.name,
-                                body="Task %s failed: %s" % (task.id, e),
-                                to=correctedRecipients,
-                            ).send()
+                            MailQueue.enqueue(
+                                EmailMessage(
+                                    subject="FrePPLe failed executing %s"
+                                    % schedule.name,
+                                    body="Task %s failed: %s" % (task.id, e),
+                                    to=correctedRecipients,
+                                ),
+                                database,
+                                task=task.id,
+                            )
+                            # The worker delivers the email, and retries on failures
+                            launchWorker(database)
                         except Exception as e:
                             task.message = "Can't send failure e-mail: %s" % e
                             task.save(
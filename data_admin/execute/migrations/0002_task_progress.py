@@ -0,0 +1,17 @@
+import data_admin.common.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("execute", "0001_initial")]
+
+    operations = [
+        migrations.AddField(
+            model_name="task",
+            name="progress",
+            field=data_admin.common.fields.JSONBField(
+                blank=True, editable=False, null=True, verbose_name="progress"
+            ),
+        ),
+    ]
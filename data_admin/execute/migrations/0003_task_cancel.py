@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("execute", "0002_task_progress")]
+
+    operations = [
+        migrations.AddField(
+            model_name="task",
+            name="cancel",
+            field=models.BooleanField(
+                default=False, editable=False, verbose_name="cancel"
+            ),
+        ),
+    ]
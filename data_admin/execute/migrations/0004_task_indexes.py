@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("execute", "0003_task_cancel")]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="task",
+            index=models.Index(fields=["status", "id"], name="execute_log_status"),
+        ),
+        migrations.AddIndex(
+            model_name="task",
+            index=models.Index(
+                condition=models.Q(finished__isnull=True),
+                fields=["id"],
+                name="execute_log_unfinished",
+            ),
+        ),
+    ]
@@ -1,6 +1,12 @@
 from datetime import datetime, timedelta
+import json
+import os
+import psutil
+import signal
+import time
 
-from django.db import models
+from django.conf import settings
+from django.db import models, connections, DEFAULT_DB_ALIAS
 from django.utils.translation import gettext_lazy as _
 
 from ..common.fields import JSONBField
@@ -11,6 +17,18 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+class TaskCanceled(BaseException):
+    """
+    Raised at a batch boundary of a task that is requested to stop.
+
+    Like KeyboardInterrupt, it doesn't inherit from Exception: the many
+    "except Exception" clauses in the data loading code shouldn't swallow it.
+    Open transactions are rolled back while the exception propagates.
+    """
+
+    pass
+
+
 class Task(models.Model):
     """
     Expected status values are:
@@ -46,6 +64,14 @@ class Task(models.Model):
         on_delete=models.CASCADE,
     )
     processid = models.IntegerField("processid", editable=False, null=True)
+    progress = JSONBField(_("progress"), blank=True, null=True, editable=False)
+    cancel = models.BooleanField(_("cancel"), default=False, editable=False)
+
+    # Cancellation state of the task running in this process
+    _current = None
+    _cancel_requested = False
+    _cancel_checked = 0
+    _cooperative = False
 
     def __str__(self):
         return "%s - %s - %s" % (self.id, self.name, self.status)
@@ -55,6 +81,16 @@ class Task(models.Model):
         verbose_name_plural = _("tasks")
         verbose_name = _("task")
         default_permissions = ["view"]
+        indexes = [
+            # Supports the worker queue and the last completed task lookup
+            models.Index(fields=["status", "id"], name="execute_log_status"),
+            # Supports the status API listing the active tasks
+            models.Index(
+                fields=["id"],
+                name="execute_log_unfinished",
+                condition=models.Q(finished__isnull=True),
+            ),
+        ]
 
     @staticmethod
     def submitTask():
@@ -62,6 +98,252 @@ class Task(models.Model):
         # Check if a worker is present. If not launch one.
         return 1
 
+    @staticmethod
+    def purgeHistory(database=DEFAULT_DB_ALIAS):
+        """
+        Removes finished tasks older than the number of days configured in
+        the setting TASK_HISTORY_DAYS. A value of 0 keeps the history forever.
+        """
+        days = getattr(settings, "TASK_HISTORY_DAYS", 0)
+        if not days:
+            return 0
+        return (
+            Task.objects.using(database)
+            .filter(finished__lt=datetime.now() - timedelta(days=days))
+            .delete()[0]
+        )
+
+    def isRunning(self):
+        """
+        Returns True when the task is started and its process is still alive.
+        A waiting task, or a task whose process crashed, isn't running.
+        """
+        if (
+            self.finished
+            or not self.processid
+            or self.status in ("Waiting", "Done", "Failed", "Canceled")
+        ):
+            return False
+        try:
+            return psutil.Process(self.processid).is_running()
+        except psutil.Error:
+            return False
+
+    @classmethod
+    def installCancelHandler(cls, taskid, database=DEFAULT_DB_ALIAS):
+        """
+        Called in the process executing a task. Once the command called the
+        checkCancel method, a SIGTERM signal only flags the task for
+        cancellation and the command stops at its next call to checkCancel.
+        A command that never calls checkCancel is interrupted right away.
+        """
+        cls._current = (taskid, database) if taskid else None
+        cls._cancel_requested = False
+        cls._cooperative = False
+
+        def handler(signum, frame):
+            cls._cancel_requested = True
+            if not cls._cooperative:
+                raise TaskCanceled("Canceled process")
+
+        try:
+            signal.signal(signal.SIGTERM, handler)
+        except ValueError:
+            # Not running in the main thread
+            pass
+
+    @classmethod
+    def checkCancel(cls):
+        """
+        Long running loops call this method at their batch boundaries.
+        It raises TaskCanceled when the task is requested to stop, either by
+        a signal or by the cancel flag in the database. The database is polled
+        at most every few seconds.
+        """
+        cls._cooperative = True
+        if cls._cancel_requested:
+            raise TaskCanceled("Canceled process")
+        if cls._current and time.time() - cls._cancel_checked > 5:
+            cls._cancel_checked = time.time()
+            try:
+                cls._cancel_requested = (
+                    Task.objects.using(cls._current[1])
+                    .filter(pk=cls._current[0], cancel=True)
+                    .exists()
+                )
+            except Exception:
+                pass
+            if cls._cancel_requested:
+                raise TaskCanceled("Canceled process")
+
+    def requestCancel(self, database=DEFAULT_DB_ALIAS):
+        """
+        Cooperative cancellation of a running task:
+          - the cancel flag of the task is set
+          - a SIGTERM signal is sent to the process
+          - when the process is still alive after the grace period configured
+            in the setting TASK_CANCEL_GRACE_PERIOD, the worker kills it.
+        A waiting task is canceled immediately.
+        Raises PermissionError when we're not allowed to signal the process.
+        """
+        if not self.processid:
+            if self.status != "Waiting":
+                return False
+            self.status = "Canceled"
+            self.save(using=database)
+            return True
+        try:
+            proc = psutil.Process(self.processid)
+        except psutil.NoSuchProcess:
+            # Already dead, just clean up from task table
+            Task._markCanceled(self.id, database)
+            return True
+        self.cancel = True
+        self.message = "Canceling process"
+        self.save(using=database, update_fields=["cancel", "message"])
+        try:
+            proc.terminate()
+        except psutil.NoSuchProcess:
+            Task._markCanceled(self.id, database)
+        except psutil.AccessDenied:
+            if os.name == "nt":
+                # Windows doesn't report us why it failed. We just clean things up.
+                Task._markCanceled(self.id, database)
+            else:
+                raise PermissionError("No permission to kill this task")
+        return True
+
+    @staticmethod
+    def _markCanceled(taskid, database):
+        Task.objects.using(database).filter(pk=taskid).exclude(
+            status__in=("Done", "Failed", "Canceled")
+        ).update(
+            status="Canceled",
+            message="Canceled process",
+            processid=None,
+            finished=datetime.now(),
+        )
+
+
+class TaskProgress:
+    """
+    Buffered progress reporting for long running commands.
+
+    Commands report the number of rows processed, the bytes read and the
+    current phase as often as they like. The numbers are only written to the
+    progress field of the task at most once every "interval" seconds, which
+    keeps the number of database updates independent of the data volume.
+
+    The progress field contains a dictionary with the keys:
+      - phase: free text describing the current step
+      - rows, total_rows: number of records processed and expected
+      - bytes, total_bytes: number of bytes read and expected
+      - rate: number of rows (or bytes when no rows are reported) per second
+      - eta: estimated number of seconds till completion
+      - updated: timestamp of the last flush
+    """
+
+    def __init__(self, task, database=DEFAULT_DB_ALIAS, interval=5):
+        self.task = task
+        self.database = database
+        self.interval = interval
+        self.phase = None
+        self.rows = 0
+        self.total_rows = None
+        self.bytes = 0
+        self.total_bytes = None
+        self.started = time.time()
+        self.lastflush = 0
+        self.connection = None
+
+    def update(
+        self,
+        phase=None,
+        rows=0,
+        bytes=0,
+        total_rows=None,
+        total_bytes=None,
+        status=None,
+        message=None,
+        force=False,
+    ):
+        """
+        Increment the counters and flush them to the database if the interval
+        has elapsed since the previous flush.
+        """
+        if phase is not None:
+            self.phase = phase
+        self.rows += rows
+        self.bytes += bytes
+        if total_rows is not None:
+            self.total_rows = total_rows
+        if total_bytes is not None:
+            self.total_bytes = total_bytes
+        if status is not None:
+            self.task.status = status
+        if message is not None:
+            self.task.message = message
+        if force or time.time() - self.lastflush >= self.interval:
+            self.flush()
+
+    def asDict(self):
+        elapsed = time.time() - self.started
+        if self.total_rows:
+            done, total = self.rows, self.total_rows
+        else:
+            done, total = self.bytes, self.total_bytes
+        rate = done / elapsed if elapsed > 0 else None
+        return {
+            "phase": self.phase,
+            "rows": self.rows,
+            "total_rows": self.total_rows,
+            "bytes": self.bytes,
+            "total_bytes": self.total_bytes,
+            "rate": round(rate, 1) if rate is not None else None,
+            "eta": int((total - done) / rate)
+            if rate and total and total >= done
+            else None,
+            "updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+    def flush(self):
+        """
+        Write the progress, status and message of the task with a single update
+        statement.
+        """
+        self.lastflush = time.time()
+        self.task.progress = self.asDict()
+        if not self.task.id:
+            return
+        if connections[self.database].in_atomic_block:
+            # Updates inside a transaction only become visible when it commits.
+            # We use a separate connection to report progress while loading data.
+            if not self.connection:
+                from ..common.report import create_connection
+
+                self.connection = create_connection(self.database)
+            with self.connection.cursor() as cursor:
+                cursor.execute(
+                    "update execute_log set progress=%s, status=%s, message=%s where id=%s",
+                    (
+                        json.dumps(self.task.progress),
+                        self.task.status,
+                        self.task.message,
+                        self.task.id,
+                    ),
+                )
+        else:
+            Task.objects.using(self.database).filter(pk=self.task.id).update(
+                progress=self.task.progress,
+                status=self.task.status,
+                message=self.task.message,
+            )
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
 
 class ScheduledTask(models.Model):
 
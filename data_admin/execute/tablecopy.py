@@ -0,0 +1,368 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import logging
+import os
+from tempfile import SpooledTemporaryFile
+from threading import Thread
+
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+# Size above which a table is buffered on disk rather than in memory
+BUFFER_SIZE = 64 * 1024 * 1024
+
+_checksum = """
+    select
+      count(*),
+      md5(string_agg(md5(t::text), ',' order by md5(t::text)))
+    from "%s" t
+    """
+
+
+def getTables(database, exclude=()):
+    """
+    Returns a dictionary with the columns of every table in the public schema.
+    """
+    with connections[database].cursor() as cursor:
+        cursor.execute(
+            """
+            select table_name, column_name from information_schema.columns
+            where table_schema = 'public'
+            and table_name in (
+              select tablename from pg_tables where schemaname = 'public'
+              )
+            order by table_name, ordinal_position
+            """
+        )
+        tables = {}
+        for table, column in cursor.fetchall():
+            if table not in exclude:
+                tables.setdefault(table, []).append(column)
+        return tables
+
+
+def getSharedTables(source, destination, exclude=()):
+    """
+    Returns the tables of the source database when the destination database has
+    the same tables and columns, and None otherwise.
+    """
+    tables = getTables(source, exclude)
+    try:
+        if getTables(destination, exclude) == tables:
+            return tables
+    except Exception:
+        # The destination database isn't initialized
+        pass
+
+
+def getCounts(cursor, tables):
+    """
+    Returns a dictionary with the number of records of every table.
+    """
+    result = {}
+    for table in tables:
+        cursor.execute('select count(*) from "%s"' % table)
+        result[table] = cursor.fetchone()[0]
+    return result
+
+
+def getFingerprints(database, tables):
+    """
+    Returns a dictionary with a fingerprint of every table.
+    Tables with a lastmodified field are compared on the number of records and the
+    most recent change. Other tables are compared on a checksum of all records.
+    """
+    result = {}
+    with connections[database].cursor() as cursor:
+        for table, columns in tables.items():
+            if "lastmodified" in columns:
+                cursor.execute('select count(*), max(lastmodified) from "%s"' % table)
+            else:
+                cursor.execute(_checksum % table)
+            result[table] = cursor.fetchone()
+    return result
+
+
+def copyTables(source, destination, tables):
+    """
+    Replaces the contents of some tables in the destination database with the
+    records from the source database, and aligns all sequences.
+    This happens in a single transaction on the destination, so the deferred
+    foreign key constraints are only validated when all tables are copied.
+    """
+    with transaction.atomic(using=destination):
+        with connections[source].cursor() as src, connections[
+            destination
+        ].cursor() as dest:
+            dest.execute("set constraints all deferred")
+            for table, columns in tables.items():
+                fields = ",".join('"%s"' % c for c in columns)
+                dest.execute('delete from "%s"' % table)
+                with SpooledTemporaryFile(max_size=BUFFER_SIZE) as buf:
+                    src.copy_expert(
+                        'copy "%s" (%s) to stdout (format binary)' % (table, fields),
+                        buf,
+                    )
+                    buf.seek(0)
+                    dest.copy_expert(
+                        'copy "%s" (%s) from stdin (format binary)' % (table, fields),
+                        buf,
+                    )
+
+            copySequences(src, dest)
+
+
+def copySequences(src, dest):
+    """
+    Sets all sequences on the destination cursor to their value on the source
+    cursor.
+    """
+    src.execute(
+        """
+        select relname from pg_class
+        inner join pg_namespace on pg_namespace.oid = pg_class.relnamespace
+        where relkind = 'S' and nspname = 'public'
+        """
+    )
+    for (sequence,) in src.fetchall():
+        src.execute('select last_value, is_called from "%s"' % sequence)
+        last_value, is_called = src.fetchone()
+        dest.execute(
+            "select setval('\"%s\"', %%s, %%s)" % sequence, (last_value, is_called)
+        )
+
+
+def connect(database):
+    """
+    Opens a new database connection, independent of the connection that Django
+    manages for the current thread.
+    """
+    return connections[database].get_new_connection(
+        connections[database].get_connection_params()
+    )
+
+
+def _streamTable(source, destination, snapshot, table, columns, active):
+    """
+    Streams a table from the source to the destination through a pipe.
+    The source is read in the exported snapshot, and the destination is written
+    in its own transaction.
+    The connections are registered in the active list while the table is copied,
+    such that an aborted copy can interrupt them.
+    """
+    fields = ",".join('"%s"' % c for c in columns)
+    src = connect(source)
+    dest = connect(destination)
+    active.extend((src, dest))
+    errors = []
+    try:
+        src.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        with src.cursor() as cursor:
+            cursor.execute("set transaction snapshot %s", (snapshot,))
+        readfd, writefd = os.pipe()
+        with open(readfd, "rb") as reader, open(writefd, "wb", 0) as writer:
+
+            def load():
+                try:
+                    with dest.cursor() as cursor:
+                        cursor.copy_expert(
+                            'copy "%s" (%s) from stdin (format binary)'
+                            % (table, fields),
+                            reader,
+                        )
+                    dest.commit()
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    # Unblocks the writer when loading fails
+                    reader.close()
+
+            loader = Thread(target=load, daemon=True)
+            loader.start()
+            try:
+                with src.cursor() as cursor:
+                    cursor.copy_expert(
+                        'copy "%s" (%s) to stdout (format binary)' % (table, fields),
+                        writer,
+                    )
+            except Exception:
+                # A failing load breaks the pipe: we report the load error instead
+                if not errors:
+                    raise
+            finally:
+                writer.close()
+                loader.join()
+        if errors:
+            raise errors[0]
+    finally:
+        active.remove(src)
+        active.remove(dest)
+        src.close()
+        dest.close()
+
+
+def streamTables(source, destination, tables, jobs=1, progress=None):
+    """
+    Copies tables between databases with the same schema, without any external
+    tool. The destination tables are emptied first.
+    The tables are streamed with binary COPY statements, with a number of
+    tables in parallel. All tables are read from the same snapshot of the source.
+    The foreign keys and indexes on the destination are dropped during the load,
+    and recreated afterwards. When one of them can't be recreated, an exception
+    is raised after all others are recreated.
+    The optional progress function is called every second with the number of
+    copied tables. It can interrupt the copy by raising an exception.
+    """
+    names = list(tables.keys())
+    holder = connect(source)
+    try:
+        # Export a snapshot, which stays valid until this transaction finishes
+        holder.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        with holder.cursor() as cursor:
+            cursor.execute("select pg_export_snapshot()")
+            snapshot = cursor.fetchone()[0]
+
+            # Start with the biggest tables
+            cursor.execute(
+                """
+                select relname from pg_class
+                inner join pg_namespace on pg_namespace.oid = pg_class.relnamespace
+                where relkind = 'r' and nspname = 'public' and relname = any(%s)
+                order by relpages desc
+                """,
+                (names,),
+            )
+            names = [i[0] for i in cursor.fetchall()]
+
+        # Drop the foreign keys and indexes, and empty the tables.
+        # This is a single transaction: a failure leaves the schema untouched.
+        with transaction.atomic(using=destination):
+            with connections[destination].cursor() as cursor:
+                cursor.execute(
+                    """
+                    select distinct tbl.relname, pg_constraint.conname,
+                      pg_get_constraintdef(pg_constraint.oid)
+                    from pg_constraint
+                    inner join pg_class tbl on tbl.oid = pg_constraint.conrelid
+                    inner join pg_class ref on ref.oid = pg_constraint.confrelid
+                    inner join pg_namespace on pg_namespace.oid = tbl.relnamespace
+                    where pg_constraint.contype = 'f' and nspname = 'public'
+                    and (tbl.relname = any(%s) or ref.relname = any(%s))
+                    """,
+                    (names, names),
+                )
+                constraints = cursor.fetchall()
+                cursor.execute(
+                    """
+                    select idx.relname, pg_get_indexdef(pg_index.indexrelid)
+                    from pg_index
+                    inner join pg_class idx on idx.oid = pg_index.indexrelid
+                    inner join pg_class tbl on tbl.oid = pg_index.indrelid
+                    inner join pg_namespace on pg_namespace.oid = tbl.relnamespace
+                    where nspname = 'public' and tbl.relname = any(%s)
+                    and not exists (
+                      select 1 from pg_constraint
+                      where pg_constraint.conindid = pg_index.indexrelid
+                      )
+                    """,
+                    (names,),
+                )
+                indexes = cursor.fetchall()
+                for table, name, definition in constraints:
+                    cursor.execute(
+                        'alter table "%s" drop constraint "%s"' % (table, name)
+                    )
+                for name, definition in indexes:
+                    cursor.execute('drop index "%s"' % name)
+                if names:
+                    cursor.execute(
+                        "truncate table %s" % ",".join('"%s"' % t for t in names)
+                    )
+
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            futures = []
+            active = []
+            try:
+                # Copy the data
+                futures = [
+                    executor.submit(
+                        _streamTable,
+                        source,
+                        destination,
+                        snapshot,
+                        t,
+                        tables[t],
+                        active,
+                    )
+                    for t in names
+                ]
+                while True:
+                    done, pending = wait(futures, timeout=1)
+                    for f in done:
+                        # Raises the exception of a failed table
+                        f.result()
+                    if not pending:
+                        break
+                    if progress:
+                        progress(len(done))
+            except BaseException:
+                # Also a canceled task stops the copy as soon as possible
+                for f in futures:
+                    f.cancel()
+                for conn in list(active):
+                    try:
+                        conn.cancel()
+                    except Exception:
+                        pass
+                raise
+            finally:
+                wait(futures)
+                # Restore the schema, also when the copy failed or was canceled
+                failures = _rebuild(executor, destination, indexes, constraints)
+            if failures:
+                # The destination isn't usable without its indexes and constraints
+                raise Exception("Can't restore the schema: %s" % "; ".join(failures))
+            with holder.cursor() as src, connections[destination].cursor() as dest:
+                copySequences(src, dest)
+    finally:
+        holder.close()
+
+
+def _rebuild(executor, database, indexes, constraints):
+    """
+    Creates the indexes in parallel, and then the foreign keys one by one.
+    Failures are logged, and don't stop the other statements: the data of an
+    excluded table can for instance break a foreign key.
+    Returns the list of failures.
+    """
+    failures = []
+    statements = [
+        executor.submit(_execute, database, definition)
+        for name, definition in indexes
+    ]
+    for (name, definition), f in zip(indexes, statements):
+        try:
+            f.result()
+        except Exception as e:
+            logger.error("Can't create index %s: %s" % (name, e))
+            failures.append("index %s: %s" % (name, e))
+    for table, name, definition in constraints:
+        try:
+            _execute(
+                database,
+                'alter table "%s" add constraint "%s" %s' % (table, name, definition),
+            )
+        except Exception as e:
+            logger.error("Can't create constraint %s on %s: %s" % (name, table, e))
+            failures.append("constraint %s on %s: %s" % (name, table, e))
+    return failures
+
+
+def _execute(database, sql):
+    conn = connect(database)
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(sql)
+    finally:
+        conn.close()
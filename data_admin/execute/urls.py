@@ -27,6 +27,11 @@ urlpatterns = [
         views.DownloadLogFile,
         name="execute_download_log",
     ),
+    url(
+        r"^execute/logdata/(.+)/$",
+        views.LogFileData,
+        name="execute_log_data",
+    ),
     url(r"^execute/api/(.+)/$", views.APITask, name="execute_api"),
     url(
         r"^execute/uploadtofolder/(.+)/$",
@@ -11,13 +11,11 @@ import operator
 import os
 import re
 import shlex
-from time import sleep
 from zipfile import ZipFile, ZIP_DEFLATED
 
 from django.apps import apps
 from django.conf import settings
 from django.contrib.auth import get_permission_codename
-from django.contrib.contenttypes.models import ContentType
 from django.db import transaction
 from django.db.models.fields.related import ForeignKey
 from django.views.decorators.cache import never_cache
@@ -27,7 +25,9 @@ from django.db import DEFAULT_DB_ALIAS
 from django.contrib.admin.views.decorators import staff_member_required
 from django.views.decorators.csrf import csrf_protect, csrf_exempt
 from django.http import (
+    FileResponse,
     Http404,
+    HttpResponseBadRequest,
     HttpResponseRedirect,
     HttpResponseServerError,
     HttpResponse,
@@ -42,7 +42,7 @@ from django.core.management import get_commands, call_command
 
 from ..admin import data_site
 from ..common.auth import basicauthentication
-from ..common.dataload import parseExcelWorksheet
+from ..common.dataload import loadWorkbook
 from ..common.models import Scenario, HierarchyModel
 from ..common.report import (
     GridFieldDuration,
@@ -51,9 +51,10 @@ from ..common.report import (
     GridReport,
     GridFieldText,
     GridFieldInteger,
+    GridFieldJSON,
     EXCLUDE_FROM_BULK_OPERATIONS,
     _getCellValue,
-    matchesModelName,
+    getModelByName,
 )
 from ..common.views import sendStaticFile
 from .models import Task, ScheduledTask
@@ -65,6 +66,34 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+class LogFileIndex:
+    """
+    Cached list of the files in the log directory.
+
+    Creating or removing a file updates the modification time of the directory.
+    We only rescan the directory when that timestamp changes, which replaces a
+    directory listing per request with a single stat call.
+    """
+
+    _files = frozenset()
+    _mtime = None
+
+    @classmethod
+    def files(cls):
+        try:
+            mtime = os.stat(settings.FREPPLE_LOGDIR).st_mtime_ns
+        except OSError:
+            return frozenset()
+        if mtime != cls._mtime:
+            cls._files = frozenset(
+                x
+                for x in os.listdir(settings.FREPPLE_LOGDIR)
+                if x.endswith(".log") or x.lower().endswith(".dump")
+            )
+            cls._mtime = mtime
+        return cls._files
+
+
 class TaskReport(GridReport):
     """
     A list report to review the history of actions.
@@ -140,6 +169,14 @@ class TaskReport(GridReport):
             editable=False,
             align="center",
         ),
+        GridFieldJSON(
+            "progress",
+            title=_("progress"),
+            search=False,
+            editable=False,
+            initially_hidden=True,
+            extra="formatter:progress",
+        ),
         GridFieldBool("cancelable", title="cancelable", hidden=True),
     )
 
@@ -171,17 +208,8 @@ class TaskReport(GridReport):
 
     @classmethod
     def query(reportclass, request, basequery, sortsql="1 asc"):
-        logfileslist = set(
-            [
-                x
-                for x in os.listdir(settings.FREPPLE_LOGDIR)
-                if x.endswith(".log")
-                or (
-                    x.lower().endswith(".dump")
-                    and request.user.username in settings.SUPPORT_USERS
-                )
-            ]
-        )
+        logfileslist = LogFileIndex.files()
+        support_user = request.user.username in settings.SUPPORT_USERS
         for rec in basequery:
             yield {
                 "id": rec.id,
@@ -190,11 +218,15 @@ class TaskReport(GridReport):
                 "started": rec.started,
                 "finished": rec.finished,
                 "status": rec.status,
-                "logfile": rec.logfile if rec.logfile in logfileslist else None,
+                "logfile": rec.logfile
+                if rec.logfile in logfileslist
+                and (support_user or not rec.logfile.lower().endswith(".dump"))
+                else None,
                 "message": rec.message,
                 "arguments": rec.arguments,
                 "user__username": rec.user.username if rec.user else None,
                 "duration": rec.duration,
+                "progress": rec.progress,
                 "cancelable": rec.processid is not None or rec.status == "Waiting",
             }
 
@@ -240,6 +272,7 @@ def APITask(request, action):
                     "message": t.message,
                     "user": t.user.username if t.user else None,
                     "logfile": t.logfile,
+                    "progress": t.progress,
                 }
         elif action == "cancel":
             response = {}
@@ -252,16 +285,12 @@ def APITask(request, action):
                     .filter(id__in=args)
                 ):
                     if request.user.is_superuser or t.user == request.user:
-                        if t.processid:
-                            # Kill the process with signal 9
-                            os.kill(t.processid, 9)
-                            sleep(1)  # Wait for it to die
-                            t.message = "Canceled process"
-                            t.processid = None
-                        elif t.status != "Waiting":
+                        try:
+                            if not t.requestCancel(database=request.database):
+                                continue
+                        except PermissionError as e:
+                            logger.error("Error canceling task %s: %s" % (t.id, e))
                             continue
-                        t.status = "Canceled"
-                        t.save(using=request.database)
                         response[t.id] = {
                             "name": t.name,
                             "submitted": str(t.submitted),
@@ -348,6 +377,9 @@ def wrapTask(request, action):
         models = ",".join(args.getlist("models"))
         if models:
             task.arguments = "--models=%s" % (models)
+            if args.get("cascade"):
+                # The execution screen also selects the dependent models
+                task.arguments += " --cascade"
         task.save(using=request.database)
     # D
     elif action == "loaddata":
@@ -466,6 +498,8 @@ def wrapTask(request, action):
         format_year = args.get("format-year", None)
         if format_year:
             arguments.append('--format-year="%s"' % format_year)
+        if args.get("extend", None):
+            arguments.append("--extend")
         if arguments:
             task.arguments = " ".join(arguments)
         task.save(using=request.database)
@@ -525,56 +559,44 @@ def CancelTask(request, taskid):
         raise Http404("Only ajax post requests allowed")
     try:
         task = Task.objects.all().using(request.database).get(pk=taskid)
-        if task.processid:
-            # Kill the process with signal 9
-            os.kill(task.processid, 9)
-            task.message = "Canceled process"
-            task.processid = None
-        elif task.status != "Waiting":
+        if not task.requestCancel(database=request.database):
             return HttpResponseServerError("Task isn't running or waiting to run")
-        task.status = "Canceled"
-        task.save(using=request.database)
         # Just in case, to cover corner cases
         launchWorker(database=request.database)
         return HttpResponse(content="OK")
-    except ProcessLookupError:
-        # Already dead, just clean up from task table
-        task.message = "Canceled process"
-        task.processid = None
-        task.status = "Canceled"
-        task.save(using=request.database)
-        return HttpResponse(content="OK")
     except PermissionError:
-        if os.name == "nt":
-            # Windows doesn't report us why it failed. We just clean things up.
-            task.message = "Canceled process"
-            task.processid = None
-            task.status = "Canceled"
-            task.save(using=request.database)
-            return HttpResponse(content="OK")
-        else:
-            return HttpResponseServerError("No permission to kill this task")
+        return HttpResponseServerError("No permission to kill this task")
     except Exception as e:
-        if os.name == "nt":
-            # Windows doesn't report us why it failed. We just clean things up.
-            task.message = "Canceled process"
-            task.processid = None
-            task.status = "Canceled"
-            task.save(using=request.database)
-            return HttpResponse(content="OK")
-        else:
-            logger.error("Error canceling task: %s" % e)
-            return HttpResponseServerError("Error canceling task")
+        logger.error("Error canceling task: %s" % e)
+        return HttpResponseServerError("Error canceling task")
 
 
-@staff_member_required
-@never_cache
-def DownloadLogFile(request, taskid):
-    filename = Task.objects.using(request.database).get(id=taskid).logfile
+def getLogFile(request, taskid):
+    """
+    Returns the name of the log file of a task, or None when the user can't
+    access it.
+    """
+    try:
+        filename = Task.objects.using(request.database).get(id=taskid).logfile
+    except Exception:
+        return None
+    if not filename or not filename.lower().endswith((".log", ".dump")):
+        return None
     if (
         filename.lower().endswith(".dump")
         and request.user.username not in settings.SUPPORT_USERS
-    ) or not filename.lower().endswith((".log", ".dump")):
+    ):
+        return None
+    return filename
+
+
+@staff_member_required
+@never_cache
+def DownloadLogFile(request, taskid):
+    if "HTTP_RANGE" in request.META:
+        return LogFileData(request, taskid)
+    filename = getLogFile(request, taskid)
+    if not filename:
         return HttpResponseNotFound(force_text(_("Error")))
     return sendStaticFile(
         request,
@@ -583,28 +605,143 @@ def DownloadLogFile(request, taskid):
         headers={
             "Content-Type": "application/octet-stream",
             "Content-Disposition": 'inline; filename="%s"' % filename,
+            "Accept-Ranges": "bytes",
         },
     )
 
 
+class FileSlice:
+    """
+    A read-only file object limited to a number of bytes from the current
+    position of a file.
+    The file descriptor remains available, such that the web server can send the
+    slice with the sendfile system call rather than through python.
+    """
+
+    def __init__(self, f, length):
+        self.file = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+rangepattern = re.compile(r"^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$")
+
+
+@staff_member_required
+@never_cache
+def LogFileData(request, taskid):
+    """
+    Returns a part of the log file of a task, without reading it in memory.
+    The part is selected with either:
+      - a HTTP Range header with a single range, eg "bytes=1000-1999" or
+        "bytes=-5000"
+      - the offset and length query parameters. A negative offset counts from
+        the end of the file.
+    A range that can't be satisfied is ignored, and the complete file is
+    returned.
+    A client tails the log file by polling with the size of the file as the
+    next offset, for as long as the X-Task-Running header is "1". The X-Log-Size
+    header returns the size of the file, and the X-Task-Status header the
+    status of the task.
+    """
+    filename = getLogFile(request, taskid)
+    if not filename:
+        return HttpResponseNotFound(force_text(_("Error")))
+    # Check the status before measuring the file, so a client doesn't stop
+    # before receiving the last lines of the log
+    task = Task.objects.using(request.database).filter(id=taskid).first()
+    running = task.isRunning() if task else False
+    try:
+        f = open(os.path.join(settings.FREPPLE_LOGDIR, filename), "rb")
+    except OSError:
+        return HttpResponseNotFound(force_text(_("File not found")))
+    try:
+        size = os.fstat(f.fileno()).st_size
+        match = rangepattern.match(request.META.get("HTTP_RANGE", ""))
+        if match and (match.group(1) or match.group(2)):
+            if not match.group(1):
+                start = max(size - int(match.group(2)), 0)
+                end = size
+            elif match.group(2):
+                start = int(match.group(1))
+                end = min(int(match.group(2)) + 1, size)
+            else:
+                start = int(match.group(1))
+                end = size
+            if start >= end:
+                # Unsatisfiable range: ignore the header
+                match = None
+                start = 0
+                end = size
+        else:
+            match = None
+            offset = int(request.GET.get("offset", 0))
+            if offset < 0:
+                offset = max(size + offset, 0)
+            start = min(offset, size)
+            end = size
+            if "length" in request.GET:
+                end = min(start + max(int(request.GET["length"]), 0), size)
+    except ValueError:
+        f.close()
+        return HttpResponseBadRequest("Invalid offset or length")
+    except Exception:
+        f.close()
+        raise
+
+    f.seek(start)
+    response = FileResponse(
+        FileSlice(f, end - start),
+        status=206 if match else 200,
+        content_type="text/plain; charset=utf-8"
+        if filename.lower().endswith(".log")
+        else "application/octet-stream",
+    )
+    response["Content-Length"] = end - start
+    response["Content-Disposition"] = 'inline; filename="%s"' % filename
+    response["Accept-Ranges"] = "bytes"
+    if match:
+        response["Content-Range"] = "bytes %s-%s/%s" % (start, end - 1, size)
+    response["X-Log-Size"] = size
+    response["X-Task-Status"] = task.status if task else None
+    response["X-Task-Running"] = 1 if running else 0
+    return response
+
+
 @staff_member_required
 @never_cache
 def logfile(request, taskid):
     """
     This view shows the frePPLe log file of the last planning run in this database.
+    The page only reads the end of the log file, and then tails the file for as
+    long as the task is running.
     """
+    logsize = 0
+    running = False
     try:
-        filename = Task.objects.using(request.database).get(id=taskid).logfile
-        if not filename.lower().endswith(".log"):
+        task = Task.objects.using(request.database).get(id=taskid)
+        if not task.logfile or not task.logfile.lower().endswith(".log"):
             return HttpResponseNotFound(force_text(_("Error")))
-
-        f = open(os.path.join(settings.FREPPLE_LOGDIR, filename), "rb")
+        running = task.isRunning()
+        f = open(os.path.join(settings.FREPPLE_LOGDIR, task.logfile), "rb")
     except Exception:
         logdata = "File not found"
     else:
         try:
-            f.seek(-1, os.SEEK_END)
-            if f.tell() >= 50000:
+            logsize = os.fstat(f.fileno()).st_size
+            if logsize > 50000:
                 # Too big to display completely
                 f.seek(-50000, os.SEEK_END)
                 d = f.read(50000)
@@ -616,7 +753,6 @@ def logfile(request, taskid):
                 )
             else:
                 # Displayed completely
-                f.seek(0, os.SEEK_SET)
                 logdata = f.read(50000).decode("utf8", "ignore")
         finally:
             f.close()
@@ -627,6 +763,8 @@ def logfile(request, taskid):
         {
             "title": " ".join([force_text(capfirst(_("log file"))), taskid]),
             "logdata": logdata,
+            "logsize": logsize,
+            "running": running,
             "taskid": taskid,
         },
     )
@@ -1107,12 +1245,6 @@ def importWorkbook(request):
     Each entity has a tab in the spreadsheet, and the first row contains
     the fields names.
     """
-    # Build a list of all contenttypes
-    all_models = [
-        (ct.model_class(), ct.pk)
-        for ct in ContentType.objects.all()
-        if ct.model_class()
-    ]
     try:
         # Find all models in the workbook
         for filename, file in request.FILES.items():
@@ -1134,13 +1266,7 @@ def importWorkbook(request):
             models = []
             for ws_name in wb.sheetnames:
                 # Find the model
-                model = None
-                contenttype_id = None
-                for m, ct in all_models:
-                    if matchesModelName(ws_name, m):
-                        model = m
-                        contenttype_id = ct
-                        break
+                model, contenttype_id = getModelByName(ws_name, request.database)
                 if not model or model in EXCLUDE_FROM_BULK_OPERATIONS:
                     yield '<div class="alert alert-warning">' + force_text(
                         _("Ignoring data in worksheet: %s") % ws_name
@@ -1157,16 +1283,28 @@ def importWorkbook(request):
                         _("You don't permissions to add: %s") % ws_name
                     ) + "</div>"
                 else:
-                    deps = set([model])
-                    GridReport.dependent_models(model, deps)
+                    deps = GridReport.getDependentModels(model)
                     models.append((ws_name, model, contenttype_id, deps))
 
-            # Sort the list of models, based on dependencies between models
-            models = GridReport.sort_models(models)
-
-            # Process all rows in each worksheet
-            for ws_name, model, contenttype_id, dependencies in models:
-                with transaction.atomic(using=request.database):
+            # Process all rows in each worksheet, in waves of independent models.
+            # Large uploads are stored in a temporary file, which the worker
+            # processes can read.
+            ws_current = None
+            for ws_name, error in loadWorkbook(
+                wb,
+                models,
+                filename=file.temporary_file_path()
+                if hasattr(file, "temporary_file_path")
+                else None,
+                user=request.user,
+                database=request.database,
+                jobs=getattr(settings, "IMPORT_JOBS", 1),
+                ping=True,
+            ):
+                if error is None:
+                    if ws_current:
+                        yield "</tbody></table></div>"
+                    ws_current = ws_name
                     yield "<strong>" + force_text(
                         _("Processing data in worksheet: %s") % ws_name
                     ) + "</strong><br>"
@@ -1177,59 +1315,53 @@ def importWorkbook(request):
                     numerrors = 0
                     numwarnings = 0
                     firsterror = True
-                    ws = wb[ws_name]
-                    for error in parseExcelWorksheet(
-                        model,
-                        ws,
-                        user=request.user,
-                        database=request.database,
-                        ping=True,
-                    ):
-                        if error[0] == logging.DEBUG:
-                            # Yield some result so we can detect disconnect clients and interrupt the upload
-                            yield " "
-                            continue
-                        if firsterror and error[0] in (logging.ERROR, logging.WARNING):
-                            yield '<tr><th class="sr-only">%s</th><th>%s</th><th>%s</th><th>%s</th><th>%s%s%s</th></tr>' % (
-                                capfirst(_("worksheet")),
-                                capfirst(_("row")),
-                                capfirst(_("field")),
-                                capfirst(_("value")),
-                                capfirst(_("error")),
-                                " / ",
-                                capfirst(_("warning")),
-                            )
-                            firsterror = False
-                        if error[0] == logging.ERROR:
-                            yield '<tr><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s: %s</td></tr>' % (
-                                ws_name,
-                                error[1] if error[1] else "",
-                                error[2] if error[2] else "",
-                                error[3] if error[3] else "",
-                                capfirst(_("error")),
-                                error[4],
-                            )
-                            numerrors += 1
-                        elif error[1] == logging.WARNING:
-                            yield '<tr><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s: %s</td></tr>' % (
-                                ws_name,
-                                error[1] if error[1] else "",
-                                error[2] if error[2] else "",
-                                error[3] if error[3] else "",
-                                capfirst(_("warning")),
-                                error[4],
-                            )
-                            numwarnings += 1
-                        else:
-                            yield '<tr class=%s><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>' % (
-                                "danger" if numerrors > 0 else "success",
-                                ws_name,
-                                error[1] if error[1] else "",
-                                error[2] if error[2] else "",
-                                error[3] if error[3] else "",
-                                error[4],
-                            )
-                    yield "</tbody></table></div>"
+                    continue
+                if error[0] == logging.DEBUG:
+                    # Yield some result so we can detect disconnect clients and interrupt the upload
+                    yield " "
+                    continue
+                if firsterror and error[0] in (logging.ERROR, logging.WARNING):
+                    yield '<tr><th class="sr-only">%s</th><th>%s</th><th>%s</th><th>%s</th><th>%s%s%s</th></tr>' % (
+                        capfirst(_("worksheet")),
+                        capfirst(_("row")),
+                        capfirst(_("field")),
+                        capfirst(_("value")),
+                        capfirst(_("error")),
+                        " / ",
+                        capfirst(_("warning")),
+                    )
+                    firsterror = False
+                if error[0] == logging.ERROR:
+                    yield '<tr><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s: %s</td></tr>' % (
+                        ws_name,
+                        error[1] if error[1] else "",
+                        error[2] if error[2] else "",
+                        error[3] if error[3] else "",
+                        capfirst(_("error")),
+                        error[4],
+                    )
+                    numerrors += 1
+                elif error[1] == logging.WARNING:
+                    yield '<tr><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s: %s</td></tr>' % (
+                        ws_name,
+                        error[1] if error[1] else "",
+                        error[2] if error[2] else "",
+                        error[3] if error[3] else "",
+                        capfirst(_("warning")),
+                        error[4],
+                    )
+                    numwarnings += 1
+                else:
+                    yield '<tr class=%s><td class="sr-only">%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>' % (
+                        "danger" if numerrors > 0 else "success",
+                        ws_name,
+                        error[1] if error[1] else "",
+                        error[2] if error[2] else "",
+                        error[3] if error[3] else "",
+                        error[4],
+                    )
+            if ws_current:
+                yield "</tbody></table></div>"
             yield "<div><strong>%s</strong><br><br></div>" % _("Done")
     except GeneratorExit:
         logger.warning("Connection Aborted")
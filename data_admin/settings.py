@@ -409,6 +409,19 @@ EMAIL_HOST = None
 EMAIL_PORT = 25
 EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
 
+# Number of attempts to deliver a queued email, and the number of seconds
+# before the first retry. The delay doubles after every failed attempt.
+MAIL_RETRIES = 5
+MAIL_RETRY_DELAY = 60
+
+# Number of days emails that couldn't be delivered are kept in the queue.
+MAIL_FAILED_DAYS = 30
+
+# Number of attempts to replicate a user change to a scenario, and the number of
+# seconds before the first retry. The delay doubles after every failed attempt.
+USER_SYNC_RETRIES = 5
+USER_SYNC_RETRY_DELAY = 60
+
 # Port number when not using Apache
 PORT = 8000
 
@@ -592,6 +605,47 @@ GLOBAL_PREFERENCES = {}
 # Max total log files size in MB, if the limit is reached deletes the oldest.
 MAXTOTALLOGFILESIZE = 200
 
+# Max total size of the database backups in MB, if the limit is reached the
+# backup command deletes the oldest. The most recent backup is always kept.
+MAXTOTALBACKUPSIZE = 10000
+
+# Number of worker processes loading the worksheets of a spreadsheet upload in
+# parallel. The value 1 loads all worksheets in the web server process.
+# The worker processes are started on the first upload, and kept running.
+IMPORT_JOBS = 1
+
+# Python interpreter running the worker processes of IMPORT_JOBS. This is only
+# needed when the web server embeds python, eg with mod_wsgi.
+IMPORT_PYTHON = None
+
+# Number of days finished tasks are kept in the task history.
+# The value 0 keeps the complete history. Set it to eg 365 to purge older tasks.
+TASK_HISTORY_DAYS = 0
+
+# Number of seconds a canceled task gets to stop cleanly before it is killed.
+TASK_CANCEL_GRACE_PERIOD = 30
+
+# Number of seconds the list of scenarios accessible to a user is cached.
+# When running multiple web server processes, configure a shared CACHES backend
+# to make changes to users and scenarios visible immediately in all processes.
+SCENARIO_CACHE_TIMEOUT = 60
+
+# Number of seconds the permissions, the menu and the dashboard widgets of a user
+# in a scenario are cached. The same remark on a shared CACHES backend applies.
+PERMISSION_CACHE_TIMEOUT = 60
+
+# Number of seconds the list of non-empty tables of a scenario is cached.
+# The menu uses it to mark the tables without data.
+TABLE_PRESENCE_CACHE_TIMEOUT = 60
+
+# Number of seconds the preferences of a user are cached.
+# The remark on a shared CACHES backend applies here as well.
+PREFERENCE_CACHE_TIMEOUT = 60
+
+# Number of seconds the time buckets and the current date of a scenario are
+# kept in memory.
+BUCKET_CACHE_TIMEOUT = 60
+
 # Google analytics code to report usage statistics to.
 # The default value of None disables this feature.
 GOOGLE_ANALYTICS = None
@@ -7,7 +7,9 @@ from .models import (
 )
 
 
-@NotificationFactory.register(Location, [Location, Demand])
+@NotificationFactory.register(
+    Location, [Location, Demand], match={Location: "pk", Demand: "location"}
+)
 def LocationNotification(flw, msg):
     if flw.content_type == msg.content_type:
         return flw.object_pk == msg.object_pk
@@ -19,7 +21,9 @@ def LocationNotification(flw, msg):
             return msg.model_name() in args if args else True
 
 
-@NotificationFactory.register(Customer, [Customer, Demand])
+@NotificationFactory.register(
+    Customer, [Customer, Demand], match={Customer: "pk", Demand: "customer"}
+)
 def CustomerNotification(flw, msg):
     if flw.content_type == msg.content_type:
         return flw.object_pk == msg.object_pk
@@ -36,6 +40,7 @@ def CustomerNotification(flw, msg):
         Item,
         Demand,
     ],
+    match={Item: "pk", Demand: "item"},
 )
 def ItemNotification(flw, msg):
     if flw.content_type == msg.content_type:
@@ -49,6 +54,6 @@ def ItemNotification(flw, msg):
         return msg.model_name() in args if args else True
 
 
-@NotificationFactory.register(Demand, [Demand])
+@NotificationFactory.register(Demand, [Demand], match={Demand: "pk"})
 def DemandNotification(flw, msg):
     return flw.content_type == msg.content_type and flw.object_pk == msg.object_pk